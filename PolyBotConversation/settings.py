@@ -84,13 +84,51 @@ WSGI_APPLICATION = "PolyBotConversation.wsgi.application"
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
+# SQLite (default) is tuned for concurrent web requests, django-q workers and LLM logging: with WAL, readers
+# no longer block the writer, writers wait for the lock instead of failing with "database is locked", and
+# transactions take the write lock upfront so that it is never upgraded mid-transaction.
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",  # safe with WAL, only fsyncs at checkpoints
+    "busy_timeout": 20000,  # ms
+}
+
 DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
         "NAME": BASE_DIR / "db.sqlite3",
+        "OPTIONS": {
+            # Run on every new connection
+            "init_command": ";".join(f"PRAGMA {name}={value}" for name, value in SQLITE_PRAGMAS.items()),
+            "transaction_mode": "IMMEDIATE",
+        },
     }
 }
 
+# Production: PostgreSQL with persistent connections, e.g. DB_ENGINE=postgresql POSTGRES_HOST=db
+if os.environ.get("DB_ENGINE") == "postgresql":
+    DATABASES["default"] = {
+        "ENGINE": "django.db.backends.postgresql",
+        "NAME": os.environ.get("POSTGRES_DB", "polybot"),
+        "USER": os.environ.get("POSTGRES_USER", "polybot"),
+        "PASSWORD": os.environ.get("POSTGRES_PASSWORD", ""),
+        "HOST": os.environ.get("POSTGRES_HOST", "localhost"),
+        "PORT": os.environ.get("POSTGRES_PORT", "5432"),
+        "CONN_MAX_AGE": int(os.environ.get("POSTGRES_CONN_MAX_AGE", 600)),  # seconds, reused across requests and tasks
+        "CONN_HEALTH_CHECKS": True,  # check reused connections before each request
+    }
+
+# Optional separate databases, so that chat writes don't wait behind logging and broker writes (see chat.routers):
+# "logs" holds the LLM requests and "tasks" the django-q tables, e.g. DB_SEPARATE=logs,tasks
+# Move existing rows with `python manage.py split_databases` after enabling them
+SEPARATE_DATABASES = [alias for alias in os.environ.get("DB_SEPARATE", "").split(",") if alias in ("logs", "tasks")]
+for alias in SEPARATE_DATABASES:
+    DATABASES[alias] = {
+        **DATABASES["default"],
+        "NAME": BASE_DIR / f"{alias}.sqlite3" if DATABASES["default"]["ENGINE"].endswith("sqlite3") else f"{DATABASES['default']['NAME']}_{alias}",
+    }
+DATABASE_ROUTERS = ["chat.routers.SeparateDatabaseRouter"]
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -144,7 +182,7 @@ Q_CLUSTER = {
     "retry": 120,
     "queue_limit": 50,
     "bulk": 10,
-    "orm": "default",
+    "orm": "tasks" if "tasks" in SEPARATE_DATABASES else "default",
     "sync": True,  # True only for debugging/Windows
 }
 
@@ -166,8 +204,143 @@ MUCA = {
     "temperature": 0.8
 }
 
+# Model routing (see chat.llm.route_model)
+LLM_ROUTING = {
+    "tiers": {
+        "classifier": "ministral-8b-latest",  # short yes/no and tagging prompts
+        "reply": LLM["mistral_basic_model"],  # persona replies
+        "analysis": MUCA["model"],  # titles, summaries, subtopics and evaluations
+    },
+    "request_types": {
+        "is_turn_mention": "classifier",
+        "is_turn": "classifier",
+        "is_question": "classifier",
+        "arbitrate_turns": "classifier",
+        "update_subtopics": "classifier",
+        "conversation_summary": "analysis",
+        "summarize": "analysis",
+        "history_summary": "analysis",
+        "generate_segments": "analysis",
+        "generate_subtopics": "analysis",
+        "evaluation": "analysis",
+        "overall_evaluation": "analysis",
+        "baseline": "analysis",
+    },
+    "default_tier": "reply",
+    # Tiers in which a bot's own model (Bot.model) replaces the tier model
+    "bot_override_tiers": ["reply"],
+    # Models a bot may override with
+    "bot_models": [
+        "mistral-small-latest",
+        "mistral-medium-latest",
+        "mistral-large-latest",
+        "ministral-8b-latest",
+        "ministral-3b-latest",
+        "open-mistral-nemo",
+    ],
+}
+
+# Long-lived HTTP clients shared by all LLM calls of a process (see chat.llm.LLMClientPool)
+LLM_CLIENT = {
+    "max_connections": 20,
+    "max_keepalive_connections": 10,
+    "keepalive_expiry": 60,  # seconds
+    "timeout": 60,  # seconds
+}
+
+# Concurrent LLM calls (see chat.llm.run_concurrently)
+LLM_ASYNC = {
+    "max_concurrency": 8,
+    # Send a bot's turn check and its reply together and drop the reply if the check says no
+    "speculative": True,
+}
+
+# Response cache for classifier prompts (see chat.llm.ResponseCache)
+LLM_CACHE = {
+    "request_types": ["is_turn_mention", "is_turn", "is_question", "update_subtopics", "arbitrate_turns"],
+    "max_entries": 1024,
+    "ttl": 600,  # seconds
+}
+
+# Stream bot replies into MessageDraft rows while they are generated
+STREAMING = {
+    "enabled": True,
+    "interval": 1,  # seconds between draft updates
+    "stale_after": 120,  # seconds after which an abandoned draft is no longer shown
+    "watch": 30,  # seconds the pages poll drafts after a new message, when no bot starts typing
+}
+
+# Server-sent events telling the open chat pages what changed, instead of polling (see chat.push).
+# Needs an ASGI server, e.g. PUSH=1 uvicorn PolyBotConversation.asgi:application; pages fall back to polling otherwise
+PUSH = {
+    "enabled": os.environ.get("PUSH") == "1",
+    "interval": 0.5,  # seconds between checks for events published by other processes (task workers)
+    "keepalive": 15,  # seconds between keepalive comments on idle connections
+    "retry": 3000,  # ms before the browser reconnects
+    "event_ttl": 300,  # seconds events are kept for, they are pruned with the histories (see RETENTION)
+}
+
+# Messages shown when a chat page opens, and loaded each time the user scrolls to the top of the history
+MESSAGES_PAGE_SIZE = 50
+
+# Rate limits shared by all workers (see chat.rate_limit)
+LLM_RATE_LIMIT = {
+    "enabled": True,
+    "default": {"requests_per_minute": 60, "tokens_per_minute": 500000},
+    "models": {},  # per-model overrides, e.g. {"mistral-large-latest": {"requests_per_minute": 30}}
+    "completion_tokens": 300,  # expected completion size, added to the prompt estimate
+    # Share of capacity that only interactive (user-facing) requests may use
+    "reserve": 0.25,
+    "background_request_types": ["conversation_summary", "summarize", "history_summary", "generate_subtopics", "generate_segments", "evaluation", "overall_evaluation", "baseline"],
+    "max_wait": 40,  # seconds a request may spend waiting for capacity or backing off, well below Q_CLUSTER["timeout"]
+    # Share of capacity a process takes from the shared buckets at once and spends without touching the database
+    "lease": 0.1,
+    "lease_ttl": 10,  # seconds after which the unspent part of a lease is given up
+    "backoff_base": 1,  # seconds
+    "backoff_max": 20,  # seconds
+}
+
+# Write-behind logging of LLMRequest rows (see chat.audit)
+LLM_AUDIT = {
+    "write_behind": True,
+    "batch_size": 50,
+    "interval": 2,  # seconds between flushes
+    "max_queued": 5000,  # oldest rows are dropped beyond this
+}
+
+# Retention of the LLM request log and the django-q task history (see chat.retention), pruned every hour
+RETENTION = {
+    "compress_after": 1,  # days after which prompts and responses are compressed in place
+    "ttl": 30,  # days LLM requests are kept before being archived, unless set in ttls
+    "ttls": {  # per request type
+        "is_turn": 7,
+        "is_turn_mention": 7,
+        "is_question": 7,
+        "arbitrate_turns": 7,
+        "evaluation": 90,
+        "overall_evaluation": 90,
+    },
+    "task_ttl": 7,  # days django-q task results are kept (successes are also capped by Q_CLUSTER["save_limit"])
+    "archive_dir": BASE_DIR / "archive",  # append-only gzipped JSONL, one file per month
+    "batch_size": 500,  # rows per query
+    "max_batches": 20,  # per run and per step, so that a run stays short when catching up
+}
+
 MAX_RETRIES = 5
-RETRY_DELAY = 10
+
+# Generation runs of a conversation (see chat.scheduler): at most one queued and one running
+# Messages arriving during a run obsolete it and are answered by a single follow-up run
+GENERATION = {
+    # seconds without new messages before a queued generation starts. Delayed runs go through the django-q scheduler,
+    # which only checks every 30 seconds or so: 0 answers right away
+    "quiet_window": 0,
+}
+
+# Refresh of the title, summary and metrics of the conversations that changed since the last sweep (see chat.sweeper)
+SWEEP = {
+    "interval": 2,  # minutes between sweeps, scheduled by the setup command
+    "batch_size": 20,  # conversations refreshed per sweep, in parallel on the task workers; the oldest changes first
+}
 
 # Turn Checks
 NEW_CHAT_GRACE = 5
@@ -177,10 +350,29 @@ MIN_HUMAN_REPLIES_LAST_10 = 2
 
 MAX_INDIRECT_ANSWERS = 2
 
+# Decide whether to speak and write a strategy message in one structured request, instead of a turn check
+# followed by a generation. The separate calls remain the fallback; see GenerationTiming for the latency of each path.
+STRATEGY_GENERATION = {
+    "fused": True,
+}
+
+# Decide who speaks with one structured request for all bots instead of one turn check per bot
+TURN_ARBITRATION = {
+    "enabled": True,
+}
+
 # Dialog Analyzer
 SHORT_TERM_CONTEXT = 8
 LONG_TERM_CONTEXT = 12
 
+# Prompt history: rolling summary plus recent messages (see chat.context)
+CONTEXT = {
+    "window": LONG_TERM_CONTEXT,  # most recent messages always kept verbatim
+    "summary_batch": SHORT_TERM_CONTEXT,  # messages that must leave the window before the summary is updated
+    "max_messages": 3 * LONG_TERM_CONTEXT,  # verbatim messages kept while the summary lags behind
+    "token_budget": 6000,  # per prompt, including system messages
+}
+
 ACTIVE_PARTICIPANT_THRESHOLD = 1
 LURKER_THRESHOLD_RATIO = 0.8
 LURKER_THRESHOLD_COUNT = 2
@@ -1,9 +1,14 @@
 from django.contrib import admin
 
-from chat.models import Bot, Conversation, LLMRequest, Message, Participant, Strategy, SubTopic, Segment, Settings
+from chat.models import Bot, Conversation, GenerationTiming, LLMRequest, Message, Participant, Strategy, SubTopic, Segment, Settings
 
 class LLMRequestAdmin(admin.ModelAdmin):
-    readonly_fields = ("total_tokens", "completion_tokens")
+    readonly_fields = ("total_tokens", "completion_tokens", "full_prompt")
+    exclude = ("messages",)
+
+    @admin.display(description="Messages")
+    def full_prompt(self, obj):
+        return "\n\n".join(f"[{message['role']}] {message['content']}" for message in obj.get_messages())
 
 
 admin.site.register(Conversation)
@@ -13,5 +18,6 @@ admin.site.register(Message)
 admin.site.register(Strategy)
 admin.site.register(SubTopic)
 admin.site.register(LLMRequest, LLMRequestAdmin)
+admin.site.register(GenerationTiming)
 admin.site.register(Segment)
 admin.site.register(Settings)
@@ -0,0 +1,88 @@
+import atexit
+import logging
+import os
+import threading
+from collections import deque
+
+from django.conf import settings
+
+from chat.models import LLMRequest, PromptBlob
+
+logger = logging.getLogger(__name__)
+
+
+class LLMRequestBuffer:
+    """
+    Write-behind queue for LLMRequest rows. Rows are queued in memory and written with bulk_create by a
+    background thread every LLM_AUDIT["interval"] seconds, or as soon as LLM_AUDIT["batch_size"] rows are queued.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._queue = deque()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._pid = None
+        self.flushed = 0
+        self.dropped = 0
+        self.failed_flushes = 0
+
+    def _ensure_thread(self):
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        if self._pid is not None and self._pid != os.getpid():
+            # Rows queued before a fork belong to the parent process
+            self._queue.clear()
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._run, name="llm-request-buffer", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(settings.LLM_AUDIT["interval"])
+            self._wakeup.clear()
+            self.flush()
+
+    def append(self, request):
+        if not settings.LLM_AUDIT["write_behind"]:
+            request.save()
+            return
+        with self._lock:
+            self._ensure_thread()
+            if len(self._queue) >= settings.LLM_AUDIT["max_queued"]:
+                self._queue.popleft()
+                self.dropped += 1
+            self._queue.append(request)
+            full = len(self._queue) >= settings.LLM_AUDIT["batch_size"]
+        if full:
+            self._wakeup.set()
+
+    def flush(self):
+        """
+        Writes all queued rows and returns how many were written. Failed batches are put back in the queue.
+        """
+        with self._lock:
+            batch = list(self._queue)
+            self._queue.clear()
+        if not batch:
+            return 0
+        try:
+            PromptBlob.store({digest: text for request in batch for digest, text in getattr(request, "_blobs", {}).items()})
+            LLMRequest.objects.bulk_create(batch, batch_size=settings.LLM_AUDIT["batch_size"])
+        except Exception as e:
+            logger.warning(f"[LLM] Failed to write {len(batch)} LLM requests, will retry: {e}")
+            with self._lock:
+                self._queue.extendleft(reversed(batch))
+                self.failed_flushes += 1
+            return 0
+        with self._lock:
+            self.flushed += len(batch)
+        return len(batch)
+
+    def stats(self):
+        with self._lock:
+            return {"queued": len(self._queue), "flushed": self.flushed, "dropped": self.dropped, "failed_flushes": self.failed_flushes}
+
+
+request_buffer = LLMRequestBuffer()
+atexit.register(request_buffer.flush)
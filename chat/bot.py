@@ -1,17 +1,30 @@
+import asyncio
+import json
 import logging
+import time
+from contextlib import contextmanager
 
 from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
 
+from chat.context import build_history, to_llm_message
 from chat.helpers import get_system_prompt, strategies_to_prompt, judge_bot_determination, get_current_segment, has_participated, detect_human_mention
-from chat.llm import prompt_llm_messages
-from chat.models import Message
+from chat.llm import prompt_llm_messages, aprompt_llm_messages, run_concurrently
+from chat.models import GenerationTiming, Message, MessageDraft
 from chat.prompt_templates import prompts, items
+from chat.push import publish
+from chat.scheduler import GenerationObsolete, check_generation
+from chat.signals import count_messages, evaluate_conversation
+from chat.rate_limit import count_tokens
+from chat.snapshot import get_snapshot
 
 logger = logging.getLogger(__name__)
 
 
 def check_turn(conversation, bot):
-    messages = list(conversation.messages.all())
+    snapshot = get_snapshot(conversation)
+    messages = snapshot.recent_messages(10)
 
     # Human goes first
     if len(messages) == 0:
@@ -24,7 +37,7 @@ def check_turn(conversation, bot):
 
         # Make sure the user has replied enough times; but allow answers after a user has replied
         human_replies = [msg for msg in messages[-10:] if msg.participant.user]
-        if len(human_replies) < settings.MIN_HUMAN_REPLIES_LAST_10 and len(messages) > settings.NEW_CHAT_GRACE and not messages[-1].participant.user:
+        if len(human_replies) < settings.MIN_HUMAN_REPLIES_LAST_10 and snapshot.message_count > settings.NEW_CHAT_GRACE and not messages[-1].participant.user:
             logger.info(f"[INFO] User has not replied enough times ({len(human_replies)} < {settings.MIN_HUMAN_REPLIES_LAST_10})")
             return False
 
@@ -35,25 +48,28 @@ def check_turn(conversation, bot):
 
     return True
 
-def check_turn_mention(conversation, bot):
-    last_message = conversation.messages.order_by("timestamp").last()
-    messages = [
+def turn_mention_messages(bot, last_message):
+    return [
         {
             "role": "user",
             "name": "System",
             "content": prompts["is_turn_mention"].format(bot_name=bot.name, message=last_message.message),
         }
     ]
-    bot_response = prompt_llm_messages(messages, model=bot.model, temperature=bot.temperature)
+
+def check_turn_mention(conversation, bot):
+    last_message = get_snapshot(conversation).last_message
+    messages = turn_mention_messages(bot, last_message)
+    bot_response = prompt_llm_messages(messages, model=bot.model, temperature=bot.temperature, request_type="is_turn_mention")
     return judge_bot_determination(bot_response)
 
-def check_turn_indirect(conversation, bot):
-    last_message = conversation.messages.order_by("timestamp").last()
+def turn_indirect_messages(conversation, bot, last_message):
     system_prompt = get_system_prompt(conversation, bot)
     messages = [{"role": "system", "name": "system", "content": system_prompt}]
     
-    if conversation.settings and conversation.settings.context:
-        messages.append({"role": "system", "name": "system", "content": conversation.settings.context})
+    conversation_settings = get_snapshot(conversation).conversation_settings
+    if conversation_settings and conversation_settings.context:
+        messages.append({"role": "system", "name": "system", "content": conversation_settings.context})
         
     segment = get_current_segment(conversation)
     if segment:
@@ -66,8 +82,6 @@ def check_turn_indirect(conversation, bot):
                 "content": last_message.message,
             })
     
-    if messages is False:
-        return False
     messages.append(
         {
             "role": "user",
@@ -75,8 +89,132 @@ def check_turn_indirect(conversation, bot):
             "content": prompts["is_turn"].format(bot_name=bot.name),
         }
     )
-    bot_response = prompt_llm_messages(messages, model=bot.model, temperature=bot.temperature)
+    return messages
+
+def check_turn_indirect(conversation, bot):
+    last_message = get_snapshot(conversation).last_message
+    messages = turn_indirect_messages(conversation, bot, last_message)
+    bot_response = prompt_llm_messages(messages, model=bot.model, temperature=bot.temperature, request_type="is_turn")
     return judge_bot_determination(bot_response)
+
+ARBITRATION_FORMAT = '{"bots": [{"name": "<bot name>", "speak": true, "priority": 3}]}'
+
+def arbitration_messages(conversation, bots):
+    personas = "; ".join(f"{bot.name}: {bot.description or bot.prompt}" for bot in bots)
+    messages = [{"role": "system", "name": "system", "content": prompts["muca"]}]
+    conversation_settings = get_snapshot(conversation).conversation_settings
+    if conversation_settings and conversation_settings.context:
+        messages.append({"role": "system", "name": "system", "content": conversation_settings.context})
+
+    messages += [to_llm_message(msg) for msg in get_snapshot(conversation).recent_messages(settings.SHORT_TERM_CONTEXT)]
+    messages.append(
+        {
+            "role": "user",
+            "name": "System",
+            "content": prompts["arbitrate_turns"].format(personas=personas, format=ARBITRATION_FORMAT),
+        }
+    )
+    return messages
+
+def parse_arbitration(bot_response, bots):
+    """
+    Parses the JSON answer of an arbitration request into {bot: {"speak": bool, "priority": int}}.
+    Bots missing from the answer do not speak. Returns None if the answer is not valid.
+    """
+    try:
+        entries = json.loads(bot_response)["bots"]
+        decisions = {str(entry["name"]).strip().lstrip("@").lower(): entry for entry in entries}
+        return {
+            bot: {
+                "speak": decisions.get(bot.name.lower(), {}).get("speak") is True,
+                "priority": int(decisions.get(bot.name.lower(), {}).get("priority", 0)),
+            }
+            for bot in bots
+        }
+    except (TypeError, ValueError, KeyError, AttributeError):
+        return None
+
+def arbitrate_turns(conversation):
+    """
+    Decides in a single structured request which bots should reply to the last message, and with
+    which priority. Returns {bot: {"speak": bool, "priority": int}}, or None if arbitration is disabled
+    or failed, in which case callers fall back to the per-bot turn checks.
+    """
+    if not settings.TURN_ARBITRATION["enabled"]:
+        return None
+    bots = get_snapshot(conversation).bots
+    if not bots:
+        return None
+    messages = arbitration_messages(conversation, bots)
+    bot_response = prompt_llm_messages(messages, model=settings.MUCA["model"], temperature=0, response_format={"type": "json_object"}, request_type="arbitrate_turns")
+    if bot_response is False:
+        return None
+    decisions = parse_arbitration(bot_response, bots)
+    if decisions is None:
+        logger.info(f"[INFO] Invalid turn arbitration, falling back to turn checks: {bot_response}")
+    else:
+        logger.info(f"[INFO] Turn arbitration: {({bot.name: decision for bot, decision in decisions.items()})}")
+    return decisions
+
+async def acheck_and_generate(bot, turn_messages, messages, turn_request_type, request_type, on_delta=None):
+    """
+    Runs a turn check and the generation it gates. In speculative mode both calls are sent at once
+    and the generated reply is dropped if the check says no; its partial content is only passed
+    on to `on_delta` once the check has said yes.
+    """
+    if settings.LLM_ASYNC["speculative"]:
+        approved = False
+        latest = ""
+
+        def gated_delta(content):
+            nonlocal latest
+            latest = content
+            if approved:
+                on_delta(content)
+
+        async def check():
+            nonlocal approved
+            turn_response = await aprompt_llm_messages(turn_messages, model=bot.model, temperature=bot.temperature, request_type=turn_request_type)
+            approved = judge_bot_determination(turn_response)
+            if approved and latest:
+                await asyncio.to_thread(on_delta, latest)
+            return approved
+
+        approved_turn, bot_response = await asyncio.gather(
+            check(),
+            aprompt_llm_messages(messages, model=bot.model, temperature=bot.temperature, request_type=request_type, on_delta=gated_delta if on_delta else None),
+        )
+        return bot_response if approved_turn else False
+
+    turn_response = await aprompt_llm_messages(turn_messages, model=bot.model, temperature=bot.temperature, request_type=turn_request_type)
+    if not judge_bot_determination(turn_response):
+        return False
+    return await aprompt_llm_messages(messages, model=bot.model, temperature=bot.temperature, request_type=request_type, on_delta=on_delta)
+
+def draft_writer(conversation, bot):
+    """
+    Returns a callback that stores the partial reply of `bot` as a MessageDraft, at most once every
+    STREAMING["interval"] seconds, or None if streaming is disabled.
+    """
+    if not settings.STREAMING["enabled"]:
+        return None
+    participant = get_snapshot(conversation).participant_for(bot)
+    last_write = 0
+
+    def write(content):
+        nonlocal last_write
+        if time.monotonic() - last_write < settings.STREAMING["interval"]:
+            return
+        last_write = time.monotonic()
+        _, created = MessageDraft.objects.update_or_create(conversation=conversation, participant=participant, defaults={"message": content})
+        if created:
+            # The pages only poll drafts while a bot is typing
+            publish(conversation.id, "drafts")
+
+    return write
+
+def discard_draft(conversation, bot):
+    MessageDraft.objects.filter(conversation=conversation, participant__bot=bot).delete()
     
 
 def check_message(new_message, bot):
@@ -98,27 +236,17 @@ def set_up(conversation, bot, override_turn=False):
     system_prompt = get_system_prompt(conversation, bot)
     messages = [{"role": "system", "name": "system", "content": system_prompt}]
     
-    if conversation.settings and conversation.settings.context:
-        messages.append({"role": "system", "name": "system", "content": conversation.settings.context})
+    conversation_settings = get_snapshot(conversation).conversation_settings
+    if conversation_settings and conversation_settings.context:
+        messages.append({"role": "system", "name": "system", "content": conversation_settings.context})
         
     segment = get_current_segment(conversation)
     if segment:
         logger.info(f'[INFO] Segment: {segment.name}')
         messages.append({"role": "system", "name": "system", "content": segment.prompt})
         
-    # Retrieve all messages for the conversation ordered by timestamp
-    conversation_messages = Message.objects.filter(conversation=conversation).order_by("timestamp")
-
-    # Convert each message into the format required by LLM
-    for msg in conversation_messages:
-        role = "user" if msg.participant.participant_type == "user" else "assistant"
-        messages.append(
-            {
-                "role": role,
-                "name": msg.participant.user.username if msg.participant.participant_type == "user" else msg.participant.bot.name,
-                "content": msg.message,
-            }
-        )
+    # Rolling summary of older messages followed by the recent ones, within the prompt's token budget
+    messages += build_history(conversation, reserved_tokens=count_tokens(messages))
     return messages
 
 def synthesize(conversation, bot, reply, strat_response):
@@ -126,8 +254,9 @@ def synthesize(conversation, bot, reply, strat_response):
     system_prompt = get_system_prompt(conversation, bot)
     messages = [{"role": "system", "name": "system", "content": system_prompt}]
     
-    if conversation.settings and conversation.settings.context:
-        messages.append({"role": "system", "name": "system", "content": conversation.settings.context})
+    conversation_settings = get_snapshot(conversation).conversation_settings
+    if conversation_settings and conversation_settings.context:
+        messages.append({"role": "system", "name": "system", "content": conversation_settings.context})
     
     segment = get_current_segment(conversation)
     if segment:
@@ -158,25 +287,79 @@ def synthesize(conversation, bot, reply, strat_response):
             "content": prompts["combine_answers"].format(bot_name=bot.name),
         }
     )
-    bot_response = prompt_llm_messages(messages, model=bot.model, temperature=bot.temperature)
+    bot_response = prompt_llm_messages(messages, model=bot.model, temperature=bot.temperature, request_type="combine_answers", on_delta=draft_writer(conversation, bot))
     if not check_message(bot_response, bot):
         logger.info(f"[INFO][FINAL] Failed 'check_message' for {bot.name}. Bot response: {bot_response}")
+        discard_draft(conversation, bot)
         return False
     logger.info(f"[INFO][FINAL] Generating a new message as {bot.name}")
     return post_message(conversation, bot, bot_response)
 
+FUSED_FORMAT = '{"speak": true, "reply": "<your message>"}'
+
+def parse_fused_response(bot_response):
+    """
+    Parses the JSON answer of a fused request into (speak, reply). Returns None if the answer is not valid.
+    """
+    try:
+        data = json.loads(bot_response)
+        speak, reply = data["speak"], data.get("reply") or ""
+    except (TypeError, ValueError, KeyError, AttributeError):
+        return None
+    if not isinstance(speak, bool) or not isinstance(reply, str) or (speak and not reply.strip()):
+        return None
+    return speak, reply.strip()
+
+def fused_strategy_message(bot, messages, strategies_list):
+    """
+    Decides whether `bot` should speak and writes its strategy message in a single structured request.
+    Returns (speak, reply), or None if the request or its answer failed.
+    """
+    fused_messages = messages + [
+        {
+            "role": "user",
+            "name": "System",
+            "content": prompts["fused_strategy"].format(bot_name=bot.name, strategies_list=strategies_list, format=FUSED_FORMAT),
+        }
+    ]
+    bot_response = prompt_llm_messages(fused_messages, model=bot.model, temperature=bot.temperature, response_format={"type": "json_object"}, request_type="fused_strategy")
+    if bot_response is False:
+        return None
+    return parse_fused_response(bot_response)
+
+def record_timing(conversation, bot, path, started, succeeded):
+    latency = time.monotonic() - started
+    logger.info(f"[INFO][STRAT] {path} path for {bot.name} took {latency:.2f}s")
+    GenerationTiming.objects.create(conversation=conversation, bot=bot, path=path, latency=latency, succeeded=succeeded)
+
 def generate_strategy_message(conversation, bot, strategies):
     messages = set_up(conversation, bot)
     if messages is False:
         return False
-    last_message = conversation.messages.order_by("timestamp").last()
-    if detect_human_mention(last_message):
+    snapshot = get_snapshot(conversation)
+    last_message = snapshot.last_message
+    if detect_human_mention(last_message, snapshot.human_usernames):
         logger.info(f"[INFO] Human Mention detected, not bot turn")
         return False
-    if not check_turn(conversation, bot) or not check_turn_indirect(conversation, bot):
+    if not check_turn(conversation, bot):
         logger.info(f"[INFO] No reason to speak, not bot turn")
         return False
     strategies_list = strategies_to_prompt(strategies)
+    if settings.STRATEGY_GENERATION["fused"]:
+        started = time.monotonic()
+        decision = fused_strategy_message(bot, messages, strategies_list)
+        if decision is not None:
+            speak, bot_response = decision
+            accepted = not speak or check_message(bot_response, bot)
+            record_timing(conversation, bot, "fused", started, succeeded=accepted)
+            if not speak:
+                logger.info("[INFO] No reason to speak, not bot turn")
+                return False
+            return bot_response if accepted else False
+        record_timing(conversation, bot, "fused", started, succeeded=False)
+        logger.info(f"[INFO][STRAT] Fused generation failed for {bot.name}, falling back to separate calls")
+
+    started = time.monotonic()
     messages.append(
         {
             "role": "user",
@@ -184,14 +367,29 @@ def generate_strategy_message(conversation, bot, strategies):
             "content": prompts["combine_strategies"].format(bot_name=bot.name, strategies_list=strategies_list),
         }
     )
-    bot_response = prompt_llm_messages(messages, model=bot.model, temperature=bot.temperature)
+    decisions = arbitrate_turns(conversation)
+    if decisions and bot in decisions:
+        if not decisions[bot]["speak"]:
+            logger.info("[INFO] No reason to speak, not bot turn")
+            record_timing(conversation, bot, "multi_step", started, succeeded=True)
+            return False
+        bot_response = prompt_llm_messages(messages, model=bot.model, temperature=bot.temperature, request_type="combine_strategies")
+    else:
+        turn_messages = turn_indirect_messages(conversation, bot, last_message)
+        [bot_response] = run_concurrently([acheck_and_generate(bot, turn_messages, messages, "is_turn", "combine_strategies")])
+    if bot_response is False:
+        logger.info("[INFO] No reason to speak, not bot turn")
+        record_timing(conversation, bot, "multi_step", started, succeeded=True)
+        return False
     if not check_message(bot_response, bot):
         logger.info(f"[INFO][STRAT] Failed 'check_message' for {bot.name}. Bot response: {bot_response}")
+        record_timing(conversation, bot, "multi_step", started, succeeded=False)
         return False
 
+    record_timing(conversation, bot, "multi_step", started, succeeded=True)
     return bot_response
 
-def generate_message(conversation, bot, strategy, override_turn=False, post=False, **kwargs):
+def prepare_message(conversation, bot, strategy, override_turn=False, **kwargs):
     messages = set_up(conversation, bot, override_turn)
     if messages is False:
         logger.info("[INFO] Messages is False")
@@ -204,18 +402,77 @@ def generate_message(conversation, bot, strategy, override_turn=False, post=Fals
             "content": prompts[strategy].format(bot_name=bot.name, if_intro=introduction, **kwargs),
         }
     )
-    bot_response = prompt_llm_messages(messages, model=bot.model, temperature=bot.temperature)
+    return messages
+
+def finalize_message(conversation, bot, strategy, bot_response, post=False):
     if not check_message(bot_response, bot):
         logger.info(f"[INFO][{strategy}] Failed 'check_message' for {bot.name}. Bot response: {bot_response}")
+        discard_draft(conversation, bot)
         return False
     if post: 
         post_message(conversation, bot, bot_response)
         logger.info(f"[INFO][{strategy}] Generating a new message as {bot.name}: {bot_response}")
     return bot_response
 
+def generate_message(conversation, bot, strategy, override_turn=False, post=False, **kwargs):
+    messages = prepare_message(conversation, bot, strategy, override_turn, **kwargs)
+    if messages is False:
+        return False
+    bot_response = prompt_llm_messages(messages, model=bot.model, temperature=bot.temperature, request_type=strategy, on_delta=draft_writer(conversation, bot))
+    return finalize_message(conversation, bot, strategy, bot_response, post)
+
 def post_message(conversation, bot, msg):
-    Message.objects.create(
-        conversation=conversation,
-        participant=conversation.participants.get(bot__id=bot.id),
-        message=msg,
-    )
\ No newline at end of file
+    # Raises GenerationObsolete if a newer message arrived while the reply was generated
+    try:
+        check_generation(conversation)
+    except GenerationObsolete:
+        discard_draft(conversation, bot)
+        raise
+    snapshot = get_snapshot(conversation)
+    participant = snapshot.participant_for(bot)
+    batch = getattr(conversation, "_message_batch", None)
+    if batch is not None:
+        # Inserted when the batch ends, its draft is shown until then
+        message = Message(conversation=conversation, participant=participant, message=msg, timestamp=timezone.now())
+        batch.append(message)
+    else:
+        with transaction.atomic():
+            message = Message.objects.create(
+                conversation=conversation,
+                participant=participant,
+                message=msg,
+            )
+            MessageDraft.objects.filter(conversation=conversation, participant=participant).delete()
+    snapshot.add_message(message)
+
+@contextmanager
+def batch_messages(conversation):
+    """
+    Collects the messages posted in `conversation` within the block and inserts them together when it ends,
+    so that they trigger a single evaluation of the pipeline instead of one each (see chat.signals).
+    """
+    conversation._message_batch = batch = []
+    try:
+        yield batch
+    except GenerationObsolete:
+        # Nothing was shown yet but the drafts
+        MessageDraft.objects.filter(conversation=conversation, participant__in=[message.participant for message in batch]).delete()
+        batch.clear()
+        raise
+    finally:
+        del conversation._message_batch
+        if batch:
+            insert_messages(conversation, batch)
+
+def insert_messages(conversation, messages):
+    """Inserts the messages posted in a batch, then publishes them and evaluates the pipeline once they are committed"""
+    for message in messages:
+        message.render()
+    with transaction.atomic():
+        # Sets the final timestamps, in posting order
+        Message.objects.bulk_create(messages)
+        MessageDraft.objects.filter(conversation=conversation, participant__in=[message.participant for message in messages]).delete()
+        count_messages(conversation, messages)
+    transaction.on_commit(lambda: publish(conversation.id, "message"))
+    # Bot messages do not obsolete the running generation
+    transaction.on_commit(lambda: evaluate_conversation(conversation, obsolete=False))
\ No newline at end of file
@@ -0,0 +1,81 @@
+import logging
+
+from django.conf import settings
+
+from chat.llm import prompt_llm_messages
+from chat.models import Conversation
+from chat.prompt_templates import prompts
+from chat.rate_limit import count_tokens
+from chat.snapshot import get_snapshot
+
+logger = logging.getLogger(__name__)
+
+
+def to_llm_message(msg):
+    """Converts a Message into the format required by the LLM"""
+    if msg.participant.participant_type == "user":
+        return {"role": "user", "name": msg.participant.user.username, "content": msg.message}
+    return {"role": "assistant", "name": msg.participant.bot.name, "content": msg.message}
+
+
+def unsummarized_messages(conversation, limit):
+    """Returns the last `limit` messages not covered by the rolling summary, oldest first"""
+    # Messages covered by the summary are all older than the ones it does not cover. Messages posted in a batch
+    # (see chat.bot.batch_messages) have no id until the batch ends, and are not covered either
+    return [msg for msg in get_snapshot(conversation).recent_messages(limit) if msg.id is None or msg.id > conversation.history_summary_cursor]
+
+
+def build_history(conversation, reserved_tokens=0):
+    """
+    Returns the conversation history to append to a prompt: the rolling summary of older messages followed by
+    the messages it does not cover yet, verbatim. The oldest verbatim messages are dropped (down to the last one)
+    until the history fits in CONTEXT["token_budget"] minus the `reserved_tokens` already used by the prompt.
+    """
+    budget = settings.CONTEXT["token_budget"] - reserved_tokens
+    history = [to_llm_message(msg) for msg in unsummarized_messages(conversation, settings.CONTEXT["max_messages"])]
+
+    summary = []
+    if conversation.history_summary:
+        summary = [{"role": "system", "name": "system", "content": prompts["previous_messages"].format(summary=conversation.history_summary)}]
+        budget -= count_tokens(summary)
+
+    while len(history) > 1 and count_tokens(history) > budget:
+        history.pop(0)
+    return summary + history
+
+
+def update_history_summary(conversation):
+    """
+    Folds the messages that have left the verbatim window into the conversation's rolling summary, once at least
+    CONTEXT["summary_batch"] of them are pending. At most CONTEXT["window"] messages are folded per call, oldest first,
+    so a summary lagging far behind catches up over several calls without skipping any. Returns True if it was updated.
+    """
+    window = settings.CONTEXT["window"]
+    pending = conversation.messages.filter(id__gt=conversation.history_summary_cursor)
+    foldable = pending.count() - window
+    if foldable < settings.CONTEXT["summary_batch"]:
+        return False
+    to_fold = list(pending.select_related("participant__user", "participant__bot").order_by("id")[:min(foldable, window)])
+
+    messages = [to_llm_message(msg) for msg in to_fold]
+    messages.append(
+        {
+            "role": "user",
+            "name": "System",
+            "content": prompts["history_summary"].format(summary=conversation.history_summary or "Nothing yet", max_words=200),
+        }
+    )
+    bot_response = prompt_llm_messages(messages, model=settings.MUCA["model"], temperature=0.2, request_type="history_summary")
+    if bot_response is False:
+        return False
+
+    cursor = max(msg.id for msg in to_fold)
+    # Only move the cursor forward if no other worker updated the summary meanwhile
+    updated = Conversation.objects.filter(id=conversation.id, history_summary_cursor=conversation.history_summary_cursor).update(
+        history_summary=bot_response, history_summary_cursor=cursor
+    )
+    if updated:
+        conversation.history_summary = bot_response
+        conversation.history_summary_cursor = cursor
+        logger.info(f"[INFO] Folded {len(to_fold)} messages into the history summary")
+    return bool(updated)
@@ -7,6 +7,8 @@ from chat.llm import prompt_llm_messages
 from chat.prompt_templates import prompts
 from collections import Counter
 from chat.helpers import get_last_active_bot
+from chat.context import build_history
+from chat.snapshot import get_snapshot
 from datetime import datetime
 
 logger = logging.getLogger(__name__)
@@ -18,7 +20,7 @@ def update_sub_topics_status(conversation):
 
     # Retrieve N messages for the conversation ordered by timestamp
     N = settings.SHORT_TERM_CONTEXT
-    conversation_messages = conversation.messages.order_by("-timestamp")[:N]
+    conversation_messages = get_snapshot(conversation).recent_messages(N)[::-1]
 
     messages = []
     for msg in conversation_messages:
@@ -38,7 +40,7 @@ def update_sub_topics_status(conversation):
             "content": prompts["update_subtopics"].format(list_of_sub_topics=[t.name for t in conversation.sub_topics.all()]),
         }
     )
-    bot_response = prompt_llm_messages(messages, model=settings.MUCA["model"], temperature=settings.MUCA["temperature"])
+    bot_response = prompt_llm_messages(messages, model=settings.MUCA["model"], temperature=settings.MUCA["temperature"], request_type="update_subtopics")
     
     if bot_response is False:
         return False
@@ -71,20 +73,9 @@ def update_accumulative_summary(conversation):
     """
     messages = []
     bot = get_last_active_bot(conversation)
-    participants = [p.user.username if p.user else p.bot.name for p in conversation.participants.all()]
-    # Retrieve all messages for the conversation ordered by timestamp
-    conversation_messages = conversation.messages.order_by("timestamp")
-
-    # Convert each message into the format required by LLM
-    for msg in conversation_messages:
-        role = "user" if msg.participant.participant_type == "user" else "assistant"
-        messages.append(
-            {
-                "role": role,
-                "name": msg.participant.user.username if msg.participant.participant_type == "user" else msg.participant.bot.name,
-                "content": msg.message,
-            }
-        )
+    participants = [p.user.username if p.user else p.bot.name for p in get_snapshot(conversation).participants]
+    # Rolling summary of older messages followed by the recent ones
+    messages += build_history(conversation)
     messages.append(
         {
             "role": "user",
@@ -92,21 +83,23 @@ def update_accumulative_summary(conversation):
             "content": prompts["summarize"].format(names=participants, if_intro=""),
         }
     )
-    bot_response = prompt_llm_messages(messages, model=bot.model, temperature=bot.temperature)
+    bot_response = prompt_llm_messages(messages, model=bot.model, temperature=bot.temperature, request_type="summarize")
     if bot_response is False:
         return False
     else:
         conversation.summary = bot_response
         conversation.summary_update_date = timezone.now()
-        conversation.save()
+        # title_update_date is auto_now too, a full save would make the title look fresh
+        conversation.save(update_fields=["summary", "summary_update_date"])
         return True
 
 def extract_participant_features(conversation, context=settings.SHORT_TERM_CONTEXT):
     """
     Extracts participants statistics like frequency and message length.
     """
-    messages = conversation.messages.all().order_by("-timestamp")[:context]
-    participants = conversation.participants.all()
+    snapshot = get_snapshot(conversation)
+    messages = snapshot.recent_messages(context)
+    participants = snapshot.participants
     user_message_count = Counter()
     user_word_count = Counter()
     user_stats = {participant:{"freq": 0, "len": 0} for participant in participants}
@@ -125,25 +118,19 @@ def extract_participant_features(conversation, context=settings.SHORT_TERM_CONTE
     return user_stats
 
 def get_active_participants(conversation, time=None):
-    messages = conversation.messages.all()
+    snapshot = get_snapshot(conversation)
     
     if time is None:
-        return set(message.participant for message in messages)
+        return snapshot.active_participants()
 
     elif isinstance(time, datetime):
-        if not messages or time <= messages.first().timestamp:
-            return set(message.participant for message in messages)
-        else:
-            return set(
-                message.participant for message in messages.filter(timestamp__gte=time)
-            )
+        return snapshot.active_participants(since=time)
 
     elif isinstance(time, int):
-        if time >= messages.count():
-            return set(message.participant for message in messages)
+        if time >= snapshot.message_count:
+            return snapshot.active_participants()
 
-        recent_messages = conversation.messages.all().order_by("-timestamp")[:time]
-        return set(message.participant for message in recent_messages)
+        return set(message.participant for message in snapshot.recent_messages(time))
 
     else:
         raise ValueError("`time` must be None, a datetime object, or an integer.")
@@ -15,7 +15,7 @@ from chat.prompt_templates import prompts, items
 logger = logging.getLogger(__name__)
 
 def get_metrics(conversation):
-    if conversation.messages.count() != 0:
+    if conversation.message_count != 0:
         metrics = {
             "Avg words/conv: ": engt_words_conv(conversation),
             "Avg words/utterance: ": engt_words_utt(conversation),
@@ -34,44 +34,47 @@ def get_metrics_baseline(conversation_dict):
     return metrics
         
 
+def count_words(text):
+    return len(text.split())
+
+def bot_activity(conversation):
+    """Word and message counts of the conversation's bots, maintained on every new message"""
+    return list(conversation.activity.filter(participant__participant_type="bot").values_list("word_count", "message_count"))
+
 def engt_words_conv(conversation, baseline=False):
     """Average number of words exchanged per conversation"""
     if baseline:
         messages = list(chain.from_iterable(conversation.values()))
-        word_count = [len(msg["content"].split()) for msg in messages]
+        word_count = [count_words(msg["content"]) for msg in messages]
     else:
-        messages = conversation.messages.filter(participant__participant_type="bot")
-        word_count = [len(msg.message.split()) for msg in messages]
+        word_count = [words for words, _ in bot_activity(conversation)]
     return int(np.sum(word_count))
 
 def engt_words_utt(conversation, baseline=False):
     """Average number of words per utterance """
     if baseline:
         messages = list(chain.from_iterable(conversation.values()))
-        word_count = [len(msg["content"].split()) for msg in messages]
-    else:
-        messages = conversation.messages.filter(participant__participant_type="bot")
-        word_count = [len(msg.message.split()) for msg in messages]
-    return round(float(np.mean(word_count)), 2)
+        word_count = [count_words(msg["content"]) for msg in messages]
+        return round(float(np.mean(word_count)), 2)
+    activity = bot_activity(conversation)
+    utterances = sum(messages for _, messages in activity)
+    if not utterances:
+        return float("nan")
+    return round(sum(words for words, _ in activity) / utterances, 2)
 
 def evenness(conversation, baseline=False):
     """Evenness is assessed by calculating the sample standard deviation 
     (STD) of the word count input by each participant, expressed as a percentage of the mean."""
     word_counts = {}
     if baseline:
-        messages = list(chain.from_iterable(conversation.values()))
-    else:
-        messages = conversation.messages.all()
-    for msg in messages:
-        participant = msg["name"] if baseline else msg.participant
-        if not participant:
-            continue
-        if baseline:
+        for msg in chain.from_iterable(conversation.values()):
+            participant = msg["name"]
+            if not participant:
+                continue
             word_counts.setdefault(participant, 0)
-            word_counts[participant] += len(msg["content"].split())
-        else:
-            word_counts.setdefault(participant.id, 0)
-            word_counts[participant.id] += len(msg.message.split())
+            word_counts[participant] += count_words(msg["content"])
+    else:
+        word_counts = dict(conversation.activity.values_list("participant", "word_count"))
     counts = list(word_counts.values())
     if not counts or np.mean(counts) == 0:
         return 0.0
@@ -257,7 +260,7 @@ def run_baseline(conversation):
                 ),
             }
         )]
-        baseline_response = prompt_llm_messages(messages, model=settings.MUCA["model"], temperature=settings.MUCA["temperature"])
+        baseline_response = prompt_llm_messages(messages, model=settings.MUCA["model"], temperature=settings.MUCA["temperature"], request_type="baseline")
         
         bot_responses = []
         baseline_response = baseline_response.split("\n")
@@ -295,7 +298,7 @@ def evaluate_per_message(conversation_dict, conversation, metric):
             }
         )
     
-        bot_response = prompt_llm_messages(messages, model=settings.MUCA["model"], temperature=settings.MUCA["temperature"])
+        bot_response = prompt_llm_messages(messages, model=settings.MUCA["model"], temperature=settings.MUCA["temperature"], request_type="evaluation")
         bot_response = bot_response.strip('\'"')
         bot_response = bot_response.strip(".")
         if bot_response is False:
@@ -319,7 +322,7 @@ def evaluate_overall(conversation_dict, conversation, metric):
             ),
         }
     )
-    bot_response = prompt_llm_messages(messages, model=settings.MUCA["model"], temperature=settings.MUCA["temperature"])
+    bot_response = prompt_llm_messages(messages, model=settings.MUCA["model"], temperature=settings.MUCA["temperature"], request_type="overall_evaluation")
     bot_response = bot_response.strip('\'"')
     
     return bot_response
@@ -5,6 +5,7 @@ from django.conf import settings
 from chat.prompt_templates import prompts, items
 from chat.llm import prompt_llm_messages
 from chat.models import Participant
+from chat.snapshot import get_snapshot
 from django.utils import timezone
 from django.utils.safestring import mark_safe
 
@@ -19,24 +20,22 @@ def strategies_to_prompt(strategies):
     return prompt
 
 def get_last_active_bot(conversation):
-    last_message = conversation.messages.filter(participant__participant_type="bot").order_by("timestamp").last()
-    if last_message:
-        return last_message.participant.bot 
-    else:
-        return [participant.bot for participant in conversation.participants.filter(participant_type="bot")][0]
+    snapshot = get_snapshot(conversation)
+    return snapshot.last_active_bot() or snapshot.bots[0]
         
 def get_random_bot(conversation):
     # last_message = conversation.messages.filter(participant__participant_type="bot").order_by("timestamp").last()
     # if last_message:
     #     return last_message.participant.bot 
     # else:
-    return random.choice([participant.bot for participant in conversation.participants.filter(participant_type="bot")])
+    return random.choice(get_snapshot(conversation).bots)
 
 def detect_mention(bot_name, message):
     return True if f"@{bot_name.lower()}" in message.message.lower() else False
 
-def detect_human_mention(msg):
-    humans = [participant.user.username for participant in Participant.objects.filter(participant_type="user")]
+def detect_human_mention(msg, humans=None):
+    if humans is None:
+        humans = Participant.objects.filter(participant_type="user").values_list("user__username", flat=True)
     for human in humans:
         if f"@{human.lower()}" in msg.message.lower(): return True
     return False
@@ -52,7 +51,7 @@ def detect_question(msg):
             "role": "user",
             "name": "System",
             "content": prompts['is_question'],
-        }], model=settings.MUCA["model"], temperature=settings.MUCA["temperature"])
+        }], model=settings.MUCA["model"], temperature=settings.MUCA["temperature"], request_type="is_question")
     return judge_bot_determination(bot_response)
 
 
@@ -63,15 +62,15 @@ def judge_bot_determination(bot_response):
         return False
 
 def get_current_segment(conversation):
-    if not conversation.settings:
-        return None
-    
-    if not conversation.settings.segments.all():
+    snapshot = get_snapshot(conversation)
+    segments = snapshot.segments
+    if not segments:
         return None
     
-    segments = conversation.settings.segments.order_by('order')
-    first_message = conversation.messages.order_by("timestamp").first()
-    elapsed_minutes = (timezone.now() - first_message.timestamp).total_seconds() / 60
+    first_message_at = snapshot.first_message_at
+    if first_message_at is None:
+        return segments[0]
+    elapsed_minutes = (timezone.now() - first_message_at).total_seconds() / 60
     cumulative_time = 0
 
     for segment in segments:
@@ -79,23 +78,24 @@ def get_current_segment(conversation):
         if elapsed_minutes < cumulative_time:
             return segment
 
-    return segments.last()
+    return segments[-1]
 
 def has_participated(conversation, bot):
-    return conversation.messages.filter(participant__bot=bot).exists()
+    return get_snapshot(conversation).has_participated(bot)
 
 def get_system_prompt(conversation, bot):
+    snapshot = get_snapshot(conversation)
     system_prompt = prompts["bots_in_conversation"].format(
         bot_name=bot.name,
-        list_of_bots=conversation.list_of_bots(),
-        list_of_humans=conversation.list_of_humans(),
+        list_of_bots=snapshot.names("bot"),
+        list_of_humans=snapshot.names("user"),
         bot_prompt=bot.prompt,
     )
 
     return system_prompt
 
 def estimate_delay(conversation):
-    last_message = conversation.messages.order_by("timestamp").last()
+    last_message = get_snapshot(conversation).last_message
     if not last_message: # no messages need to send message now
         return 0
     if last_message.participant.bot: # last message was from a bot, need to wait for the user's input
@@ -106,9 +106,10 @@ def estimate_delay(conversation):
 def check_waiting(conversation, triggered_at):
     if not triggered_at:
         return True
-    if conversation.messages.all().count() <= settings.WAITING_MESSAGE_NB:
+    snapshot = get_snapshot(conversation)
+    if snapshot.message_count <= settings.WAITING_MESSAGE_NB:
         return False
-    waiting_timestamp = conversation.messages.order_by("-timestamp")[settings.WAITING_MESSAGE_NB].timestamp
+    waiting_timestamp = snapshot.recent_messages(settings.WAITING_MESSAGE_NB + 1)[0].timestamp
     return triggered_at <= waiting_timestamp
 
 import re
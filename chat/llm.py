@@ -1,72 +1,421 @@
+import asyncio
+import hashlib
+import json
 import logging
+import os
+import threading
 import time
+import weakref
+from collections import OrderedDict
 
 #import openai
+import httpx
 import mistralai
 import re
 from django.conf import settings
 from django.utils import timezone
 
+from chat.audit import request_buffer
 from chat.models import LLMRequest, SubTopic
 from chat.prompt_templates import prompts
+from chat.rate_limit import aacquire, acquire, backoff_delay, estimate_tokens, get_priority, pause, settle
 
 logger = logging.getLogger(__name__)
 
 
+def build_mistral_client(api_key):
+    limits = httpx.Limits(
+        max_connections=settings.LLM_CLIENT["max_connections"],
+        max_keepalive_connections=settings.LLM_CLIENT["max_keepalive_connections"],
+        keepalive_expiry=settings.LLM_CLIENT["keepalive_expiry"],
+    )
+    timeout = settings.LLM_CLIENT["timeout"]
+    return mistralai.Mistral(
+        api_key=api_key,
+        client=httpx.Client(limits=limits, timeout=timeout),
+        async_client=httpx.AsyncClient(limits=limits, timeout=timeout),
+    )
+
+
+CLIENT_BUILDERS = {
+    "mistral": build_mistral_client,
+}
+
+
+class LLMClientPool:
+    """
+    Process-wide registry of long-lived LLM clients, one per (provider, model, API key).
+    Reusing a client keeps its HTTP connection pool (and TLS sessions) warm between calls.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._pid = os.getpid()
+        self.hits = 0
+        self.misses = 0
+
+    def _reset_after_fork(self):
+        # django-q forks its workers; sockets inherited from the parent must not be shared
+        if self._pid != os.getpid():
+            self._clients = {}
+            self._pid = os.getpid()
+            self.hits = 0
+            self.misses = 0
+
+    def get(self, provider, model, api_key):
+        if provider not in CLIENT_BUILDERS:
+            raise ValueError(f"Unknown LLM provider: {provider}")
+        key = (provider, model, hashlib.sha256((api_key or "").encode()).hexdigest())
+        with self._lock:
+            self._reset_after_fork()
+            client = self._clients.get(key)
+            if client is not None:
+                self.hits += 1
+                return client
+            self.misses += 1
+            client = CLIENT_BUILDERS[provider](api_key)
+            self._clients[key] = client
+            logger.info(f"[LLM] Created {provider} client for {model} (pool size: {len(self._clients)})")
+            return client
+
+    def stats(self):
+        with self._lock:
+            self._reset_after_fork()
+            return {"hits": self.hits, "misses": self.misses, "clients": len(self._clients)}
+
+    def close(self):
+        with self._lock:
+            clients, self._clients = self._clients, {}
+        for client in clients.values():
+            try:
+                client.sdk_configuration.client.close()
+            except Exception as e:
+                logger.warning(f"[LLM] Failed to close client: {e}")
+
+
+client_pool = LLMClientPool()
+
+
+class ResponseCache:
+    """
+    In-process LRU cache (with TTL) of LLM responses, keyed by a hash of the full request.
+    Only the request types listed in LLM_CACHE["request_types"] are cached.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def enabled(self, request_type):
+        return request_type in settings.LLM_CACHE["request_types"]
+
+    @staticmethod
+    def key(messages, model, temperature, response_format):
+        normalized = [
+            {"role": msg["role"], "name": msg.get("name"), "content": " ".join(msg["content"].split())}
+            for msg in messages
+        ]
+        payload = json.dumps(
+            {"model": model, "temperature": temperature, "response_format": response_format, "messages": normalized},
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, response):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + settings.LLM_CACHE["ttl"], response)
+            self._entries.move_to_end(key)
+            while len(self._entries) > settings.LLM_CACHE["max_entries"]:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+response_cache = ResponseCache()
+
+
+def route_model(request_type, model=None):
+    """
+    Returns the tier and model a request should run on. Requests go to the model of the tier their type maps to,
+    except that a bot's own model (Bot.model) is used for the tiers in LLM_ROUTING["bot_override_tiers"]
+    if it is one the provider offers.
+    """
+    routing = settings.LLM_ROUTING
+    tier = routing["request_types"].get(request_type, routing["default_tier"])
+    if model and tier in routing["bot_override_tiers"]:
+        if model in routing["bot_models"]:
+            return tier, model
+        logger.warning(f"[LLM] Unknown model {model}, using the {tier} tier model instead")
+    return tier, routing["tiers"][tier]
+
+
+def cache_lookup(messages, model, temperature, response_format, request_type):
+    """
+    Returns the cache key of the request (None if its type is not cached) and the cached response, if any.
+    """
+    if not response_cache.enabled(request_type):
+        return None, None
+    key = response_cache.key(messages, model, temperature, response_format)
+    return key, response_cache.get(key)
+
+
+def log_llm_request(messages, model, temperature, bot_response, usage, request_type="llm_messages", cached=False, tier="", requested_model=None):
+    request = LLMRequest(
+        model=model,
+        tier=tier,
+        requested_model=requested_model or "",
+        temperature=temperature,
+        request_type=request_type,
+        response=bot_response,
+        total_tokens=usage.total_tokens if usage else 0,
+        completion_tokens=usage.completion_tokens if usage else 0,
+        cached=cached,
+    )
+    # Every message is stored, their repeated parts (system prompts, personas, history) only once
+    request.set_messages(messages)
+    request_buffer.append(request)
+
+
+def get_retry_delay(e, attempt, max_retries, model, deadline):
+    """
+    Logs a failed attempt and returns how long to wait before retrying it, or None if it is not worth retrying.
+    """
+    retry_delay = backoff_delay(attempt, e)
+    can_retry = attempt < max_retries and time.monotonic() + retry_delay <= deadline
+    if isinstance(e, mistralai.models.SDKError):
+        if "429" in str(e) or "Too Many Requests" in str(e):
+            pause(model, retry_delay)
+            logger.warning(f"[{attempt}/{max_retries}] Rate limit hit. Retrying in {retry_delay:.1f}s...")
+            if can_retry:
+                return retry_delay
+        logger.error(f"SDKError on attempt {attempt}: {e}")
+        return None
+    if "database is locked" in str(e):
+        logger.warning(f"[{attempt}/{max_retries}] Database locked. Retrying in {retry_delay:.1f}s...")
+        if can_retry:
+            return retry_delay
+    logger.error(f"Unhandled exception during LLM request (attempt {attempt}): {e}")
+    return None
+
+
+def complete(client, model, messages, temperature, response_format, on_delta=None):
+    """
+    Returns the content and usage of a completion. With `on_delta`, the completion is streamed
+    and `on_delta` is called with the content received so far after every chunk.
+    """
+    if on_delta is None:
+        response = client.chat.complete(
+            model=model,
+            temperature=temperature,
+            messages=messages,
+            response_format=response_format,
+        )
+        return response.choices[0].message.content, response.usage
+
+    content, usage = "", None
+    for event in client.chat.stream(
+        model=model,
+        temperature=temperature,
+        messages=messages,
+        response_format=response_format,
+    ):
+        content, usage = add_chunk(event.data, content, usage)
+        on_delta(content)
+    return content, usage
+
+
+async def acomplete(client, model, messages, temperature, response_format, on_delta=None):
+    """
+    Async variant of complete. `on_delta` is a sync callable and runs in a worker thread.
+    """
+    if on_delta is None:
+        response = await client.chat.complete_async(
+            model=model,
+            temperature=temperature,
+            messages=messages,
+            response_format=response_format,
+        )
+        return response.choices[0].message.content, response.usage
+
+    content, usage = "", None
+    async for event in await client.chat.stream_async(
+        model=model,
+        temperature=temperature,
+        messages=messages,
+        response_format=response_format,
+    ):
+        content, usage = add_chunk(event.data, content, usage)
+        await asyncio.to_thread(on_delta, content)
+    return content, usage
+
+
+def add_chunk(chunk, content, usage):
+    if chunk.choices and isinstance(chunk.choices[0].delta.content, str):
+        content += chunk.choices[0].delta.content
+    return content, chunk.usage or usage
+
+
 def prompt_llm_messages(
     messages,
-    model=settings.LLM["mistral_basic_model"],
+    model=None,
     response_format=None,
     temperature=0.8,
+    request_type="llm_messages",
+    on_delta=None,
 ):
-    client = mistralai.Mistral(api_key=settings.MISTRAL_API_KEY)
+    requested_model = model
+    tier, model = route_model(request_type, requested_model)
+    cache_key, cached_response = cache_lookup(messages, model, temperature, response_format, request_type)
+    if cached_response is not None:
+        log_llm_request(messages, model, temperature, cached_response, None, request_type, cached=True, tier=tier, requested_model=requested_model)
+        return cached_response
+
+    client = client_pool.get("mistral", model, settings.MISTRAL_API_KEY)
     max_retries = settings.MAX_RETRIES
-    retry_delay = settings.RETRY_DELAY
+    deadline = time.monotonic() + settings.LLM_RATE_LIMIT["max_wait"]
+    tokens = estimate_tokens(messages)
+    priority = get_priority(request_type)
     for attempt in range(1, max_retries + 1):
+        if not acquire(model, tokens, priority, deadline):
+            logger.error(f"No rate limit capacity for {request_type} on {model} within {settings.LLM_RATE_LIMIT['max_wait']}s.")
+            return False
         try:
-            response = client.chat.complete(
-                model=settings.LLM["mistral_basic_model"],
-                temperature=temperature,
-                messages=messages,
-                response_format=response_format,
-            )
-
-            bot_response = response.choices[0].message.content
-            print(f'[LLM] Bot response: {bot_response}')
-            # We store the last prompt/message
-            LLMRequest.objects.create(
-                model=model,
-                temperature=temperature,
-                request_type="llm_messages",
-                prompt=messages[-1]["content"],
-                response=bot_response,
-                total_tokens=response.usage.total_tokens,
-                completion_tokens=response.usage.completion_tokens,
-            )
+            bot_response, usage = complete(client, model, messages, temperature, response_format, on_delta)
+            logger.debug(f"[LLM] Bot response: {bot_response}")
+            settle(model, tokens, usage.total_tokens if usage else None, priority)
+            log_llm_request(messages, model, temperature, bot_response, usage, request_type, tier=tier, requested_model=requested_model)
+            if cache_key:
+                response_cache.set(cache_key, bot_response)
             return bot_response
 
-        except mistralai.models.SDKError as e:
-            if "429" in str(e) or "Too Many Requests" in str(e):
-                logger.warning(f"[{attempt}/{max_retries}] Rate limit hit. Retrying in {retry_delay}s...")
-                if attempt < max_retries:
-                    time.sleep(retry_delay)
-                    continue
-            logger.error(f"SDKError on attempt {attempt}: {e}")
-            return False
         except Exception as e:
-            if "database is locked" in str(e):
-                logger.warning(f"[{attempt}/{max_retries}] Database locked. Retrying in {retry_delay}s...")
-                if attempt < max_retries:
-                    time.sleep(retry_delay)
-                    continue
-            logger.error(f"Unhandled exception during LLM request (attempt {attempt}): {e}")
-            return False
+            retry_delay = get_retry_delay(e, attempt, max_retries, model, deadline)
+            if retry_delay is None:
+                return False
+            time.sleep(retry_delay)
     
     # If all retries failed
     logger.error("Failed to complete LLM prompt after all retries.")
     return False
 
 
+async def aprompt_llm_messages(
+    messages,
+    model=None,
+    response_format=None,
+    temperature=0.8,
+    request_type="llm_messages",
+    on_delta=None,
+):
+    """
+    Async variant of prompt_llm_messages. At most LLM_ASYNC["max_concurrency"] calls run at once per event loop.
+    """
+    requested_model = model
+    tier, model = route_model(request_type, requested_model)
+    cache_key, cached_response = cache_lookup(messages, model, temperature, response_format, request_type)
+    if cached_response is not None:
+        # Without LLM_AUDIT["write_behind"] the row is saved right away, which Django refuses in the event loop
+        await asyncio.to_thread(log_llm_request, messages, model, temperature, cached_response, None, request_type, cached=True, tier=tier, requested_model=requested_model)
+        return cached_response
+
+    client = client_pool.get("mistral", model, settings.MISTRAL_API_KEY)
+    max_retries = settings.MAX_RETRIES
+    deadline = time.monotonic() + settings.LLM_RATE_LIMIT["max_wait"]
+    tokens = estimate_tokens(messages)
+    priority = get_priority(request_type)
+    for attempt in range(1, max_retries + 1):
+        if not await aacquire(model, tokens, priority, deadline):
+            logger.error(f"No rate limit capacity for {request_type} on {model} within {settings.LLM_RATE_LIMIT['max_wait']}s.")
+            return False
+        try:
+            async with llm_semaphore():
+                bot_response, usage = await acomplete(client, model, messages, temperature, response_format, on_delta)
+
+            logger.debug(f"[LLM] Bot response: {bot_response}")
+            settle(model, tokens, usage.total_tokens if usage else None, priority)
+            await asyncio.to_thread(log_llm_request, messages, model, temperature, bot_response, usage, request_type, tier=tier, requested_model=requested_model)
+            if cache_key:
+                response_cache.set(cache_key, bot_response)
+            return bot_response
+
+        except Exception as e:
+            retry_delay = await asyncio.to_thread(get_retry_delay, e, attempt, max_retries, model, deadline)
+            if retry_delay is None:
+                return False
+            await asyncio.sleep(retry_delay)
+
+    # If all retries failed
+    logger.error("Failed to complete LLM prompt after all retries.")
+    return False
+
+
+_semaphores = weakref.WeakKeyDictionary()
+
+
+def llm_semaphore():
+    loop = asyncio.get_running_loop()
+    if loop not in _semaphores:
+        _semaphores[loop] = asyncio.Semaphore(settings.LLM_ASYNC["max_concurrency"])
+    return _semaphores[loop]
+
+
+class LLMEventLoop:
+    """
+    Background event loop on which the async LLM calls of a process run, so that the
+    async clients of the pool stay bound to a single, long-lived loop.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loop = None
+        self._pid = None
+
+    def get_loop(self):
+        with self._lock:
+            if self._loop is None or self._pid != os.getpid():
+                self._loop = asyncio.new_event_loop()
+                self._pid = os.getpid()
+                threading.Thread(target=self._loop.run_forever, name="llm-event-loop", daemon=True).start()
+            return self._loop
+
+    def run(self, coroutines):
+        """
+        Runs the coroutines concurrently and returns their results in the same order.
+        """
+        async def gather():
+            return await asyncio.gather(*coroutines)
+
+        return asyncio.run_coroutine_threadsafe(gather(), self.get_loop()).result()
+
+
+event_loop = LLMEventLoop()
+
+
+def run_concurrently(coroutines):
+    return event_loop.run(list(coroutines))
+
+
 def llm_conversation_title(conversation):
     try:
         conversation_text = "\n".join([msg.message for msg in conversation.messages.all()])
@@ -79,7 +428,7 @@ def llm_conversation_title(conversation):
             }
         ]
 
-        bot_response = prompt_llm_messages(messages)
+        bot_response = prompt_llm_messages(messages, request_type="conversation_summary")
 
         # Sanitized bot response with only ASCII characters
         bot_response_sanitized = bot_response
@@ -88,7 +437,8 @@ def llm_conversation_title(conversation):
 
         conversation.title = bot_response_sanitized
         conversation.title_update_date = timezone.now()
-        conversation.save()
+        # summary_update_date is auto_now too, a full save would make the summary look fresh
+        conversation.save(update_fields=["title", "title_update_date"])
 
         return bot_response_sanitized
     except Exception as e:
@@ -105,7 +455,7 @@ def llm_generate_segments(context, duration, format):
             }
         ]
 
-        bot_response = prompt_llm_messages(messages).strip()
+        bot_response = prompt_llm_messages(messages, request_type="generate_segments").strip()
 
         # Extract JSON block using regex
         json_match = re.search(r"```(?:json)?\s*(\[.*?\])\s*```", bot_response, re.DOTALL)
@@ -129,7 +479,7 @@ def llm_generate_subtopics(conversation):
             }
         ]
 
-        bot_response = prompt_llm_messages(messages)
+        bot_response = prompt_llm_messages(messages, request_type="generate_subtopics")
 
         for topic in bot_response.split(","):
             if topic is None:
@@ -0,0 +1,59 @@
+from django.apps import apps as global_apps
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from chat.evaluation import count_words
+from chat.models import Conversation
+
+
+def rebuild_activity(conversation_id, apps=global_apps):
+    """
+    Recomputes the counters of a conversation and the activity of its participants from its messages.
+    The conversation row is locked, so messages posted meanwhile are counted exactly once.
+    Migrations pass their historical `apps`.
+    """
+    Conversation = apps.get_model("chat", "Conversation")
+    ParticipantActivity = apps.get_model("chat", "ParticipantActivity")
+    with transaction.atomic():
+        conversation = Conversation.objects.select_for_update().get(id=conversation_id)
+        activity = {}
+        last = None
+        messages = conversation.messages.order_by("timestamp", "id").values_list("participant_id", "participant__participant_type", "message", "timestamp")
+        for participant_id, participant_type, message, timestamp in messages.iterator():
+            row = activity.setdefault(participant_id, ParticipantActivity(
+                conversation=conversation,
+                participant_id=participant_id,
+                first_message_at=timestamp,
+            ))
+            row.message_count += 1
+            row.word_count += count_words(message)
+            row.last_message_at = timestamp
+            last = (participant_id, participant_type, timestamp)
+
+        conversation.activity.all().delete()
+        ParticipantActivity.objects.bulk_create(activity.values())
+        Conversation.objects.filter(id=conversation.id).update(
+            message_count=sum(row.message_count for row in activity.values()),
+            first_message_at=min((row.first_message_at for row in activity.values()), default=None),
+            last_message_at=last[2] if last else None,
+            last_participant_id=last[0] if last else None,
+            last_participant_type=last[1] if last else "",
+        )
+    return len(activity)
+
+
+class Command(BaseCommand):
+    help = "Recompute the message counters and participant activity (used by the evaluation metrics) of existing conversations"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--conversation", type=int, action="append", help="Conversation id, can be repeated (defaults to all conversations)")
+
+    def handle(self, *args, **kwargs):
+        conversations = Conversation.objects.order_by("id")
+        if kwargs["conversation"]:
+            conversations = conversations.filter(id__in=kwargs["conversation"])
+
+        for conversation_id in conversations.values_list("id", flat=True).iterator():
+            participants = rebuild_activity(conversation_id)
+            self.stdout.write(f"Conversation {conversation_id}: {participants} participants")
+        self.stdout.write(self.style.SUCCESS("Done"))
@@ -0,0 +1,101 @@
+import statistics
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection, transaction
+from django.db.models.signals import post_save
+from django_q.models import OrmQ
+
+from chat.models import Conversation, LLMRequest, Message, Participant
+from chat.signals import on_message_created
+
+
+def simulate_conversation(conversation_id, participant_id, messages, results):
+    """
+    Writes like a busy conversation: the generation pipeline reads the recent messages and posts a reply,
+    the LLM request is logged and a follow-up task goes through the django-q ORM broker.
+    Appends (latency, locked) for every message to `results`.
+    """
+    try:
+        for i in range(messages):
+            started = time.monotonic()
+            locked = False
+            try:
+                with transaction.atomic():
+                    list(Message.objects.filter(conversation_id=conversation_id).order_by("-timestamp")[:12])
+                    Message.objects.create(conversation_id=conversation_id, participant_id=participant_id, message=f"Benchmark message {i}")
+                LLMRequest.objects.create(request_type="benchmark", model="benchmark", temperature=0, prompt="prompt " * 100, response="response " * 50)
+                task = OrmQ.objects.create(key="benchmark", payload="")
+                OrmQ.objects.filter(id=task.id).delete()
+            except OperationalError as e:
+                if "locked" not in str(e):
+                    raise
+                # What the LLM request logging retries on
+                locked = True
+            results.append((time.monotonic() - started, locked))
+    finally:
+        connection.close()
+
+
+class Command(BaseCommand):
+    help = "Measure write contention between concurrent conversations on a scratch copy of the database"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--conversations", type=int, default=8, help="Number of conversations written concurrently")
+        parser.add_argument("--messages", type=int, default=50, help="Messages per conversation")
+        parser.add_argument("--pragmas", choices=["tuned", "default", "both"], default="both",
+                            help="SQLite only: run with the tuned connection options of settings.py, SQLite's defaults, or both")
+
+    def handle(self, *args, **kwargs):
+        if connection.vendor != "sqlite":
+            self.run(kwargs["conversations"], kwargs["messages"])
+            return
+
+        runs = ["default", "tuned"] if kwargs["pragmas"] == "both" else [kwargs["pragmas"]]
+        options = connection.settings_dict["OPTIONS"]
+        try:
+            for run in runs:
+                connection.settings_dict["OPTIONS"] = options if run == "tuned" else {}
+                self.stdout.write(f"SQLite, {run} pragmas")
+                with tempfile.TemporaryDirectory() as directory:
+                    connection.settings_dict["TEST"]["NAME"] = str(Path(directory) / "benchmark.sqlite3")
+                    self.run(kwargs["conversations"], kwargs["messages"])
+        finally:
+            connection.settings_dict["OPTIONS"] = options
+            connection.settings_dict["TEST"]["NAME"] = None
+
+    def run(self, conversations, messages):
+        """Runs the benchmark on a freshly migrated test database"""
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        post_save.disconnect(on_message_created, sender=Message)
+        try:
+            user = Participant.objects.create(participant_type="user", user=User.objects.create(username="benchmark"))
+            workers = []
+            results = []
+            for _ in range(conversations):
+                conversation = Conversation.objects.create()
+                conversation.participants.add(user)
+                workers.append(threading.Thread(target=simulate_conversation, args=(conversation.id, user.id, messages, results)))
+
+            started = time.monotonic()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            elapsed = time.monotonic() - started
+        finally:
+            post_save.connect(on_message_created, sender=Message)
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        if not results:
+            raise CommandError("No message was written")
+        latencies = sorted(latency * 1000 for latency, _ in results)
+        locked = sum(1 for _, is_locked in results if is_locked)
+        self.stdout.write(f"  {len(results)} messages in {elapsed:.2f}s ({len(results) / elapsed:.0f}/s)")
+        self.stdout.write(f"  latency p50 {statistics.median(latencies):.1f}ms, p95 {latencies[int(len(latencies) * 0.95) - 1]:.1f}ms, max {latencies[-1]:.1f}ms")
+        style = self.style.WARNING if locked else self.style.SUCCESS
+        self.stdout.write(style(f"  {locked} 'database is locked' errors ({locked / len(results):.0%})"))
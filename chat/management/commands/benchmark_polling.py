@@ -0,0 +1,59 @@
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, setup_test_environment, teardown_test_environment
+from django.urls import reverse
+
+from chat.management.commands.backfill_activity import rebuild_activity
+from chat.models import Conversation, Message, Participant
+
+
+class Command(BaseCommand):
+    help = "Compare the cost of polling load_messages for the whole conversation and incrementally, for growing conversations"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 5000], help="Number of messages of the conversations")
+        parser.add_argument("--polls", type=int, default=20, help="Polls measured per case")
+
+    def handle(self, *args, **kwargs):
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            user = User.objects.create(username="benchmark")
+            participant = Participant.objects.create(participant_type="user", user=user)
+            client = Client()
+            client.force_login(user)
+
+            self.stdout.write(f"{'messages':>10} {'case':<16} {'status':>6} {'ms/poll':>8} {'queries':>8} {'bytes':>8}")
+            for size in kwargs["sizes"]:
+                conversation = Conversation.objects.create()
+                conversation.participants.add(participant)
+                messages = [Message(conversation=conversation, participant=participant, message=f"Message **{i}** for @benchmark") for i in range(size)]
+                for message in messages:
+                    message.render()
+                Message.objects.bulk_create(messages, batch_size=500)
+                rebuild_activity(conversation.id)
+                url = reverse("chat:load_messages", kwargs={"conversation_uuid": conversation.uuid})
+                last = conversation.messages.order_by("id").last()
+                etag = client.get(url, {"after": last.id})["ETag"]
+                cases = {
+                    "full": ({}, {}),
+                    "after last": ({"after": last.id}, {}),
+                    "if-none-match": ({"after": last.id}, {"HTTP_IF_NONE_MATCH": etag}),
+                }
+                for case, (params, headers) in cases.items():
+                    self.measure(client, url, params, headers, size, case, kwargs["polls"])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+    def measure(self, client, url, params, headers, size, case, polls):
+        started = time.perf_counter()
+        with CaptureQueriesContext(connection) as queries:
+            for _ in range(polls):
+                response = client.get(url, params, **headers)
+        elapsed = (time.perf_counter() - started) / polls * 1000
+        self.stdout.write(f"{size:>10} {case:<16} {response.status_code:>6} {elapsed:>8.2f} {len(queries) // polls:>8} {len(response.content):>8}")
@@ -0,0 +1,56 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count, Max, Min
+from django.utils import timezone
+
+from chat.models import Conversation, Participant
+
+# Plan fragments showing a table scan or a sort that the indexes should avoid, per database vendor
+FULL_SCAN = {
+    "sqlite": ("SCAN chat_", "USE TEMP B-TREE"),
+    "postgresql": ("Seq Scan", "Sort"),
+}
+
+
+def hot_queries(conversation):
+    """The queries run for every incoming message, by name"""
+    messages = conversation.messages.all()
+    return {
+        "last message": messages.order_by("-timestamp")[:1],
+        "recent messages": messages.select_related("participant__user", "participant__bot").order_by("-timestamp")[:settings.LONG_TERM_CONTEXT],
+        "history page": messages.filter(id__lt=2**31 - 1).order_by("-id")[:settings.MESSAGES_PAGE_SIZE],
+        "messages since": messages.filter(timestamp__gte=timezone.now() - timedelta(hours=1)),
+        "participant activity": messages.values("participant").annotate(count=Count("id"), first=Min("timestamp"), last=Max("timestamp")),
+        "bot messages": messages.filter(participant__participant_type="bot").order_by("timestamp"),
+        "subtopics by status": conversation.sub_topics.filter(status="Being Discussed"),
+        "updated subtopics": conversation.sub_topics.filter(status_updated_at__gt=timezone.now() - timedelta(hours=1)),
+        "human participants": Participant.objects.filter(participant_type="user").values_list("user__username", flat=True),
+    }
+
+
+class Command(BaseCommand):
+    help = "Show the query plans of the chat hot queries, to check that they use the indexes"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--conversation", type=int, help="Conversation id (defaults to the latest conversation)")
+        parser.add_argument("--analyze", action="store_true", help="Run the queries and show actual timings (PostgreSQL only)")
+
+    def handle(self, *args, **kwargs):
+        if kwargs["conversation"]:
+            conversation = Conversation.objects.filter(id=kwargs["conversation"]).first()
+        else:
+            conversation = Conversation.objects.order_by("id").last()
+        if conversation is None:
+            raise CommandError("No conversation to explain queries for")
+
+        options = {"analyze": True} if kwargs["analyze"] and connection.vendor == "postgresql" else {}
+        full_scan = FULL_SCAN.get(connection.vendor, ())
+        for name, queryset in hot_queries(conversation).items():
+            plan = queryset.explain(**options)
+            warning = any(fragment in plan for fragment in full_scan)
+            self.stdout.write(self.style.WARNING(f"{name} (no index)") if warning else self.style.SUCCESS(name))
+            self.stdout.write(plan)
+            self.stdout.write("")
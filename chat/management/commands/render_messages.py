@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from chat.models import Message
+from chat.rendering import RENDERER_VERSION
+
+
+class Command(BaseCommand):
+    help = "Render again the stored HTML of the messages rendered by an older renderer, or bulk created without it"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500, help="Messages updated per query")
+
+    def handle(self, *args, **kwargs):
+        stale = Message.objects.exclude(html_version=RENDERER_VERSION).only("id", "message").order_by("id")
+        rendered = 0
+        last_id = 0
+        while batch := list(stale.filter(id__gt=last_id)[:kwargs["batch_size"]]):
+            for message in batch:
+                message.render()
+            Message.objects.bulk_update(batch, ["html", "html_version"])
+            last_id = batch[-1].id
+            rendered += len(batch)
+            self.stdout.write(f"{rendered} messages rendered")
+        self.stdout.write(self.style.SUCCESS("Done"))
@@ -1,4 +1,6 @@
+from django.conf import settings
 from django.core.management.base import BaseCommand
+from django_q.models import Schedule
 from django_q.tasks import schedule
 
 from chat.models import Strategy
@@ -18,3 +20,23 @@ class Command(BaseCommand):
 
         for name in trigger_names:
             Strategy.objects.get_or_create(name=name)
+
+        # History retention
+        Schedule.objects.update_or_create(
+            name="prune_history",
+            defaults={"func": "chat.tasks.prune_history", "schedule_type": Schedule.HOURLY},
+        )
+
+        # Title, summary and metrics of the changed conversations, replacing the schedules of each conversation
+        Schedule.objects.update_or_create(
+            name="sweep_conversations",
+            defaults={"func": "chat.tasks.sweep_conversations", "schedule_type": Schedule.MINUTES, "minutes": settings.SWEEP["interval"]},
+        )
+        legacy = Schedule.objects.filter(func__in=[
+            "chat.tasks.update_conversation_title",
+            "chat.tasks.update_conversation_summary",
+            "chat.tasks.update_evaluation_metrics",
+        ])
+        deleted, _ = legacy.delete()
+        if deleted:
+            self.stdout.write(f"Deleted {deleted} per-conversation schedules")
@@ -0,0 +1,68 @@
+from django.apps import apps
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from chat.routers import SeparateDatabaseRouter
+
+
+def routed_models(alias):
+    """The concrete models stored in the separate database `alias`"""
+    router = SeparateDatabaseRouter()
+    return [
+        model for model in apps.get_models()
+        if not model._meta.proxy and model._meta.managed and router.database_for(model._meta.app_label, model._meta.model_name) == alias
+    ]
+
+
+def copy_rows(model, alias, batch_size, delete=False):
+    """Copies the rows of `model` from the default database to `alias` in batches, keeping their primary keys"""
+    source = connections[DEFAULT_DB_ALIAS]
+    if model._meta.db_table not in source.introspection.table_names():
+        return 0
+
+    copied = 0
+    rows = model._base_manager.using(DEFAULT_DB_ALIAS).order_by("pk")
+    last_pk = None
+    while True:
+        batch = list((rows if last_pk is None else rows.filter(pk__gt=last_pk))[:batch_size])
+        if not batch:
+            break
+        # Rows copied by an interrupted run are skipped
+        model._base_manager.using(alias).bulk_create(batch, ignore_conflicts=True)
+        last_pk = batch[-1].pk
+        copied += len(batch)
+
+    # Rows were inserted with explicit ids, move the sequences past them
+    target = connections[alias]
+    with target.cursor() as cursor:
+        for sql in target.ops.sequence_reset_sql(no_style(), [model]):
+            cursor.execute(sql)
+
+    if delete and last_pk is not None:
+        model._base_manager.using(DEFAULT_DB_ALIAS).filter(pk__lte=last_pk).delete()
+    return copied
+
+
+class Command(BaseCommand):
+    help = (
+        "Create the separate databases of settings.SEPARATE_DATABASES and copy their rows from the default database. "
+        "Stop the server and the task cluster while it runs"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000, help="Rows copied per query")
+        parser.add_argument("--delete", action="store_true", help="Delete the copied rows from the default database")
+
+    def handle(self, *args, **kwargs):
+        if not settings.SEPARATE_DATABASES:
+            raise CommandError("No separate database is enabled, set DB_SEPARATE (e.g. DB_SEPARATE=logs,tasks)")
+
+        for alias in settings.SEPARATE_DATABASES:
+            call_command("migrate", database=alias, verbosity=0)
+            for model in routed_models(alias):
+                copied = copy_rows(model, alias, kwargs["batch_size"], kwargs["delete"])
+                self.stdout.write(f"{model._meta.label}: {copied} rows copied to '{alias}'")
+        self.stdout.write(self.style.SUCCESS("Done"))
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.1 on 2026-10-17 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0017_alter_segment_prompt_alter_settings_name'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='llmrequest',
+            name='cached',
+            field=models.BooleanField(default=False),
+        ),
+    ]
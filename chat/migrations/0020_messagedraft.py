@@ -0,0 +1,27 @@
+# Generated by Django 5.1.1 on 2026-10-17 10:41
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0019_ratelimitbucket'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageDraft',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('message', models.TextField(blank=True, default='')),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('conversation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='drafts', to='chat.conversation')),
+                ('participant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='drafts', to='chat.participant')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('conversation', 'participant'), name='unique_draft_per_participant')],
+            },
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.1.1 on 2026-10-17 11:20
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0020_messagedraft'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='llmrequest',
+            name='timestamp',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+    ]
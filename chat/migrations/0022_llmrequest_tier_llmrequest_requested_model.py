@@ -0,0 +1,23 @@
+# Generated by Django 5.1.1 on 2026-10-17 11:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0021_alter_llmrequest_timestamp'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='llmrequest',
+            name='tier',
+            field=models.CharField(blank=True, default='', max_length=50),
+        ),
+        migrations.AddField(
+            model_name='llmrequest',
+            name='requested_model',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+    ]
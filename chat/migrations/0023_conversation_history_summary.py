@@ -0,0 +1,23 @@
+# Generated by Django 5.1.1 on 2026-10-17 12:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0022_llmrequest_tier_llmrequest_requested_model'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='history_summary',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='history_summary_cursor',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
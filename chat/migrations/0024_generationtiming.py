@@ -0,0 +1,26 @@
+# Generated by Django 5.1.1 on 2026-10-17 13:25
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0023_conversation_history_summary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GenerationTiming',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(choices=[('fused', 'Fused'), ('multi_step', 'Multi-step')], max_length=20)),
+                ('latency', models.FloatField()),
+                ('succeeded', models.BooleanField()),
+                ('timestamp', models.DateTimeField(auto_now_add=True)),
+                ('bot', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='generation_timings', to='chat.bot')),
+                ('conversation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='generation_timings', to='chat.conversation')),
+            ],
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.1.1 on 2026-10-17 14:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0024_generationtiming'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['conversation', 'timestamp'], name='message_conversation_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['conversation', 'participant', 'timestamp'], name='message_conv_participant_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='participant',
+            index=models.Index(fields=['participant_type', 'user'], name='participant_type_user_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='participant',
+            index=models.Index(fields=['participant_type', 'bot'], name='participant_type_bot_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='subtopic',
+            index=models.Index(fields=['conversation', 'status'], name='subtopic_conv_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='subtopic',
+            index=models.Index(fields=['conversation', 'status_updated_at'], name='subtopic_conv_updated_idx'),
+        ),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 5.1.1 on 2026-10-17 14:45
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0025_hot_query_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='message_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='first_message_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='last_participant',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chat.participant'),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='last_participant_type',
+            field=models.CharField(blank=True, default='', max_length=10),
+        ),
+        migrations.CreateModel(
+            name='ParticipantActivity',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('message_count', models.PositiveIntegerField(default=0)),
+                ('first_message_at', models.DateTimeField()),
+                ('last_message_at', models.DateTimeField()),
+                ('conversation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='activity', to='chat.conversation')),
+                ('participant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='activity', to='chat.participant')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='participantactivity',
+            constraint=models.UniqueConstraint(fields=('conversation', 'participant'), name='unique_activity_per_participant'),
+        ),
+    ]
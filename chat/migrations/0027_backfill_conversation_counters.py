@@ -0,0 +1,48 @@
+# Generated by Django 5.1.1 on 2026-10-17 14:45
+
+from django.db import migrations
+from django.db.models import Count, Max, Min
+
+
+def backfill_counters(apps, schema_editor):
+    Conversation = apps.get_model("chat", "Conversation")
+    Message = apps.get_model("chat", "Message")
+    ParticipantActivity = apps.get_model("chat", "ParticipantActivity")
+
+    for conversation in Conversation.objects.all().iterator():
+        rows = list(
+            Message.objects.filter(conversation=conversation)
+            .values("participant")
+            .annotate(count=Count("id"), first=Min("timestamp"), last=Max("timestamp"))
+        )
+        if not rows:
+            continue
+        ParticipantActivity.objects.bulk_create([
+            ParticipantActivity(
+                conversation=conversation,
+                participant_id=row["participant"],
+                message_count=row["count"],
+                first_message_at=row["first"],
+                last_message_at=row["last"],
+            )
+            for row in rows
+        ])
+        last_message = Message.objects.filter(conversation=conversation).select_related("participant").order_by("-timestamp").first()
+        Conversation.objects.filter(id=conversation.id).update(
+            message_count=sum(row["count"] for row in rows),
+            first_message_at=min(row["first"] for row in rows),
+            last_message_at=last_message.timestamp,
+            last_participant=last_message.participant,
+            last_participant_type=last_message.participant.participant_type,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0026_conversation_counters'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_counters, migrations.RunPython.noop),
+    ]
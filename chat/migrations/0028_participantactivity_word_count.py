@@ -0,0 +1,18 @@
+# Generated by Django 5.1.1 on 2026-10-17 15:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0027_backfill_conversation_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='participantactivity',
+            name='word_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.1.1 on 2026-10-17 15:20
+
+from django.db import migrations
+
+from chat.management.commands.backfill_activity import rebuild_activity
+
+
+def backfill_activity(apps, schema_editor):
+    Conversation = apps.get_model("chat", "Conversation")
+    for conversation_id in Conversation.objects.order_by("id").values_list("id", flat=True).iterator():
+        rebuild_activity(conversation_id, apps)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0028_participantactivity_word_count'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_activity, migrations.RunPython.noop),
+    ]
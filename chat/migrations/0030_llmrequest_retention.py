@@ -0,0 +1,22 @@
+# Generated by Django 5.1.1 on 2026-10-17 16:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0029_backfill_participant_activity'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='llmrequest',
+            name='body',
+            field=models.BinaryField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='llmrequest',
+            index=models.Index(fields=['request_type', 'timestamp'], name='llmrequest_type_time_idx'),
+        ),
+    ]
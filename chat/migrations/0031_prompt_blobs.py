@@ -0,0 +1,32 @@
+# Generated by Django 5.1.1 on 2026-10-17 16:40
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0030_llmrequest_retention'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PromptBlob',
+            fields=[
+                ('digest', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('text', models.TextField()),
+                ('last_used_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='llmrequest',
+            name='messages',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AlterField(
+            model_name='llmrequest',
+            name='prompt',
+            field=models.TextField(blank=True),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.1.1 on 2026-10-17 17:30
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0031_prompt_blobs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PushEvent',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('kind', models.CharField(choices=[('message', 'Message'), ('drafts', 'Drafts'), ('title', 'Title'), ('summary', 'Summary'), ('metrics', 'Metrics')], max_length=20)),
+                ('timestamp', models.DateTimeField(default=django.utils.timezone.now)),
+                ('conversation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='chat.conversation')),
+            ],
+        ),
+    ]
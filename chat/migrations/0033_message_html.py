@@ -0,0 +1,23 @@
+# Generated by Django 5.1.1 on 2026-10-17 18:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0032_pushevent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='html',
+            field=models.TextField(blank=True, default='', editable=False),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='html_version',
+            field=models.PositiveSmallIntegerField(default=0, editable=False),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.1.1 on 2026-10-17 21:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0035_conversation_generation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='needs_refresh',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(condition=models.Q(('needs_refresh', True)), fields=['last_message_at'], name='conversation_refresh_idx'),
+        ),
+    ]
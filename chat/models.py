@@ -1,8 +1,15 @@
+import hashlib
+import json
 import uuid
+import zlib
 
 from django.contrib.auth.models import User
 from django.db import models
 from django.urls import reverse
+from django.utils import timezone
+from django.utils.safestring import mark_safe
+
+from chat.rendering import RENDERER_VERSION, render_message
 
 
 class Bot(models.Model):
@@ -36,6 +43,12 @@ class SubTopic(models.Model):
     status = models.CharField(max_length=25, choices=STATUS_CHOICES)
     status_updated_at = models.DateTimeField(auto_now=True)
     conversation = models.ForeignKey("Conversation", on_delete=models.CASCADE, related_name="sub_topics", null=True,  blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["conversation", "status"], name="subtopic_conv_status_idx"),
+            models.Index(fields=["conversation", "status_updated_at"], name="subtopic_conv_updated_idx"),
+        ]
     
     def __str__(self):
         return f"{self.name}, {self.status}"
@@ -76,11 +89,43 @@ class Conversation(models.Model):
     summary_posted_date = models.DateTimeField(auto_now=True)
     subtopics_updated_at = models.DateTimeField(auto_now=True)
     settings = models.ForeignKey(Settings, null=True, blank=True, on_delete=models.SET_NULL, related_name="conversations")
-    
+    # Rolling summary of the messages that no longer fit in the prompt window (see chat.context)
+    history_summary = models.TextField(blank=True, default="")
+    history_summary_cursor = models.PositiveIntegerField(default=0)  # id of the last message covered by history_summary
+    HISTORY_FIELDS = ["history_summary", "history_summary_cursor"]
+    # Counters maintained on every new message (see chat.signals.update_conversation_counters)
+    message_count = models.PositiveIntegerField(default=0)
+    first_message_at = models.DateTimeField(null=True, blank=True)
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    last_participant = models.ForeignKey("Participant", null=True, blank=True, on_delete=models.SET_NULL, related_name="+")
+    last_participant_type = models.CharField(max_length=10, blank=True, default="")
+    COUNTER_FIELDS = ["message_count", "first_message_at", "last_message_at", "last_participant", "last_participant_type"]
+    # Generation scheduling state (see chat.scheduler): the token is bumped by every new human message,
+    # which makes the running generation obsolete
+    generation_token = models.PositiveIntegerField(default=0)
+    generation_queued = models.BooleanField(default=False)
+    generation_started_at = models.DateTimeField(null=True, blank=True)  # set while a generation runs
+    GENERATION_FIELDS = ["generation_token", "generation_queued", "generation_started_at"]
+    # Dirty flag set by new messages, cleared when the sweeper refreshes the title, summary and metrics (see chat.sweeper)
+    needs_refresh = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [
+            # Conversations to refresh: filter(needs_refresh=True), only the flagged rows are indexed
+            models.Index(fields=["last_message_at"], condition=models.Q(needs_refresh=True), name="conversation_refresh_idx"),
+        ]
 
     def __str__(self):
         return f"Conversation {self.uuid} created on {self.creation_date}"
 
+    def save(self, *args, **kwargs):
+        # Counters, the history summary, generation state and the dirty flag are only written with atomic updates,
+        # so saving a stale instance must not overwrite them
+        if not self._state.adding and kwargs.get("update_fields") is None:
+            excluded = self.COUNTER_FIELDS + self.HISTORY_FIELDS + self.GENERATION_FIELDS + ["needs_refresh"]
+            kwargs["update_fields"] = [field.name for field in self._meta.concrete_fields if not field.primary_key and field.name not in excluded]
+        super().save(*args, **kwargs)
+
     def list_of_bots(self):
         return ", ".join([participant.name() for participant in self.participants.filter(participant_type="bot")])
 
@@ -116,6 +161,12 @@ class Participant(models.Model):
         related_name="participant_bot",
     )
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["participant_type", "user"], name="participant_type_user_idx"),
+            models.Index(fields=["participant_type", "bot"], name="participant_type_bot_idx"),
+        ]
+
     def __str__(self):
         return f"Participant ({self.participant_type}) - {'User: ' + self.user.username if self.user else 'Bot: ' + self.bot.name}"
 
@@ -130,6 +181,19 @@ class Message(models.Model):
     timestamp = models.DateTimeField(auto_now_add=True)
     triggered_bots = models.ManyToManyField(Bot, related_name="responded_messages", blank=True)
     message = models.TextField()
+    # Rendered once when the message is saved, see rendered_html
+    html = models.TextField(blank=True, default="", editable=False)
+    html_version = models.PositiveSmallIntegerField(default=0, editable=False)
+
+    class Meta:
+        indexes = [
+            # Latest messages of a conversation: order_by("-timestamp")[:N], filter(timestamp__gte=...)
+            models.Index(fields=["conversation", "timestamp"], name="message_conversation_time_idx"),
+            # Messages of a conversation by participant, e.g. per-participant activity
+            models.Index(fields=["conversation", "participant", "timestamp"], name="message_conv_participant_idx"),
+            # Pages of the chat history by message id cursor: filter(id__lt=...).order_by("-id")[:N]
+            models.Index(fields=["conversation", "id"], name="message_conversation_id_idx"),
+        ]
 
     def __str__(self):
         return f"Message from {self.participant} at {self.timestamp} in conversation {self.conversation.uuid}"
@@ -137,17 +201,206 @@ class Message(models.Model):
     def participant_name(self):
         return self.participant.user.username if self.participant.participant_type == "user" else self.participant.bot.name
 
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get("update_fields")
+        if update_fields is None or "message" in update_fields:
+            self.render()
+            if update_fields is not None:
+                kwargs["update_fields"] = {*update_fields, "html", "html_version"}
+        super().save(*args, **kwargs)
+
+    def render(self):
+        self.html = render_message(self.message)
+        self.html_version = RENDERER_VERSION
+
+    @property
+    def rendered_html(self):
+        """The stored HTML of the message, rendered again if the renderer changed since (see the render_messages command)"""
+        if self.html_version != RENDERER_VERSION:
+            self.render()
+        return mark_safe(self.html)
+
+
+class ParticipantActivity(models.Model):
+    """Messages of a participant in a conversation, maintained on every new message"""
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name="activity")
+    participant = models.ForeignKey(Participant, on_delete=models.CASCADE, related_name="activity")
+    message_count = models.PositiveIntegerField(default=0)
+    word_count = models.PositiveIntegerField(default=0)  # total over all messages, see chat.evaluation
+    first_message_at = models.DateTimeField()
+    last_message_at = models.DateTimeField()
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=["conversation", "participant"], name="unique_activity_per_participant")]
+
+    def __str__(self):
+        return f"{self.participant} posted {self.message_count} messages in conversation {self.conversation_id}"
+
+
+class PushEvent(models.Model):
+    """Something that changed in a conversation, for the open chat pages (see chat.push)"""
+    KINDS = [
+        ("message", "Message"),
+        ("drafts", "Drafts"),
+        ("title", "Title"),
+        ("summary", "Summary"),
+        ("metrics", "Metrics"),
+    ]
+
+    id = models.BigAutoField(primary_key=True)
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name="+")
+    kind = models.CharField(max_length=20, choices=KINDS)
+    timestamp = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"PushEvent {self.kind} for conversation {self.conversation_id}"
+
+
+class MessageDraft(models.Model):
+    """Partial bot reply while it is being streamed; replaced by a Message once complete"""
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name="drafts")
+    participant = models.ForeignKey(Participant, on_delete=models.CASCADE, related_name="drafts")
+    message = models.TextField(blank=True, default="")
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=["conversation", "participant"], name="unique_draft_per_participant")]
+
+    def __str__(self):
+        return f"Draft from {self.participant} in conversation {self.conversation.uuid}"
+
+
+class RateLimitBucket(models.Model):
+    """Token bucket shared by all processes, see chat.rate_limit"""
+    name = models.CharField(max_length=255, unique=True)
+    tokens = models.FloatField()
+    updated_at = models.FloatField()
+
+    def __str__(self):
+        return f"{self.name}: {self.tokens:.0f}"
+
+
+class PromptBlob(models.Model):
+    """A distinct piece of prompt text, stored once and referenced by its SHA-256 digest (see LLMRequest.set_messages)"""
+    SEPARATOR = "\n\n"  # messages are split into paragraphs, so that templates and personas are shared between prompts
+
+    digest = models.CharField(max_length=64, primary_key=True)
+    text = models.TextField()
+    # Updated whenever a new request references the blob, so that unreferenced blobs can be pruned (see chat.retention)
+    last_used_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"PromptBlob {self.digest[:12]}"
+
+    @staticmethod
+    def digest_of(text):
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    @classmethod
+    def store(cls, blobs):
+        """Saves the missing blobs of {digest: text} and marks them all as used"""
+        if not blobs:
+            return
+        now = timezone.now()
+        cls.objects.bulk_create(
+            [cls(digest=digest, text=text, last_used_at=now) for digest, text in blobs.items()],
+            update_conflicts=True,
+            unique_fields=["digest"],
+            update_fields=["last_used_at"],
+        )
+
 
 class LLMRequest(models.Model):
     id = models.AutoField(primary_key=True)
     request_type = models.CharField(max_length=255)
     model = models.CharField(max_length=255)
+    # Routing decision: the tier the request type maps to and the model the caller asked for (e.g. Bot.model)
+    tier = models.CharField(max_length=50, blank=True, default="")
+    requested_model = models.CharField(max_length=255, blank=True, default="")
     temperature = models.FloatField()
-    timestamp = models.DateTimeField(auto_now_add=True)
-    prompt = models.TextField()
+    # Set when the request is made, not when the write-behind buffer flushes it
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)
+    prompt = models.TextField(blank=True)  # only the last message, for requests logged before `messages`
+    # Every message of the prompt as {"role", ..., "segments": [PromptBlob digests]}, see get_messages
+    messages = models.JSONField(default=list, blank=True)
     response = models.TextField()
     total_tokens = models.IntegerField(editable=False, default=0)
     completion_tokens = models.IntegerField(editable=False, default=0)
+    cached = models.BooleanField(default=False)
+    # Prompt and response compressed together once the row is old enough (see chat.retention), prompt and response are then empty
+    body = models.BinaryField(null=True, blank=True, editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["request_type", "timestamp"], name="llmrequest_type_time_idx"),
+        ]
+
+    def __str__(self):
+        return f"LLMRequest {self.id} at {self.timestamp}"
+
+    def save(self, *args, **kwargs):
+        PromptBlob.store(getattr(self, "_blobs", {}))
+        super().save(*args, **kwargs)
+
+    def set_messages(self, messages):
+        """Stores `messages` as references to prompt blobs. The new blobs are saved with the request (or with PromptBlob.store)"""
+        self.messages = []
+        self._blobs = {}
+        for message in messages:
+            segments = []
+            for text in message["content"].split(PromptBlob.SEPARATOR):
+                digest = PromptBlob.digest_of(text)
+                self._blobs[digest] = text
+                segments.append(digest)
+            self.messages.append({**{key: value for key, value in message.items() if key != "content"}, "segments": segments})
+
+    def get_messages(self, blobs=None):
+        """
+        The messages of the prompt as they were sent. `blobs` ({digest: text}, see load_blobs) saves a query per request
+        when reconstructing many of them. Requests logged before `messages` only have their last message.
+        """
+        if not self.messages:
+            return [{"role": "user", "content": self.bodies()[0]}]
+        if blobs is None:
+            blobs = LLMRequest.load_blobs([self])
+        return [
+            {**{key: value for key, value in message.items() if key != "segments"}, "content": PromptBlob.SEPARATOR.join(blobs[digest] for digest in message["segments"])}
+            for message in self.messages
+        ]
+
+    @staticmethod
+    def load_blobs(requests):
+        """The texts of the blobs referenced by `requests`, as {digest: text}"""
+        digests = {digest for request in requests for message in request.messages for digest in message["segments"]}
+        return dict(PromptBlob.objects.filter(digest__in=digests).values_list("digest", "text")) if digests else {}
+
+    def bodies(self, blobs=None):
+        """The prompt (last message) and response of the request, compressed or not. See get_messages for `blobs`"""
+        if self.body is None:
+            prompt, response = self.prompt, self.response
+        else:
+            data = json.loads(zlib.decompress(self.body))
+            prompt, response = data["prompt"], data["response"]
+        if self.messages:
+            prompt = self.get_messages(blobs)[-1]["content"]
+        return prompt, response
+
+    def compress(self):
+        """Moves the prompt and response to `body`, the row still has to be saved. Messages stay deduplicated in PromptBlob"""
+        self.body = zlib.compress(json.dumps({"prompt": self.prompt, "response": self.response}).encode(), 9)
+        self.prompt = self.response = ""
+
+
+class GenerationTiming(models.Model):
+    """Latency of one attempt at generating a strategy message, to compare the fused and multi-step paths"""
+    PATHS = [("fused", "Fused"), ("multi_step", "Multi-step")]
+
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name="generation_timings")
+    bot = models.ForeignKey(Bot, null=True, on_delete=models.SET_NULL, related_name="generation_timings")
+    path = models.CharField(max_length=20, choices=PATHS)
+    latency = models.FloatField()  # seconds
+    succeeded = models.BooleanField()  # False if the path failed and another one had to take over, or its reply was rejected
+    timestamp = models.DateTimeField(auto_now_add=True)
 
     def __str__(self):
-        return f"LLMRequest {self.id} at {self.timestamp}"
\ No newline at end of file
+        return f"{self.path} generation in {self.latency:.2f}s"
\ No newline at end of file
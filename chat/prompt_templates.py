@@ -19,9 +19,13 @@ prompts = {
     "chime_in_repetition": "Based on the system prompt, the previous messages, and the flow of the conversation, generate a suggestion to break conversational deadlock.",
     "combine_answers": "You are {bot_name}. Based on the system prompt and these messages, combine them all in a single response as {bot_name}. You can also @mention other participants if it makes sense, but don't overuse it; try to avoid bot-only conversations and side discussion i.e. it is a group chat. Avoid similar responses to the ones before and try to always drive the conversation forward. Make sure to stay within character. Keep your answer short. Don't ask more than one question.",
     "combine_strategies": "You are {bot_name}. Based on the system prompt and these messages, generate a single short answer combining {strategies_list}. You can also @mention other participants if it makes sense, but don't overuse it; try to avoid bot-only conversations and side discussion i.e. it is a group chat. Avoid similar responses to the ones before and try to always drive the conversation forward. Make sure to stay within character and keep your answer short. Don't ask more than one question.",
+    "fused_strategy": "You are {bot_name}. Based on the system prompt, segment, conversation settings and the previous messages, first decide whether it is your turn to speak. Be strict and don't speak if you have nothing new to say. If it is your turn, write a single short answer combining {strategies_list}. You can also @mention other participants if it makes sense, but don't overuse it; try to avoid bot-only conversations and side discussion i.e. it is a group chat. Make sure to stay within character and don't ask more than one question. Respond only with valid JSON similar to {format}. If it is not your turn, set speak to false and reply to an empty string.",
     "is_turn": "You are {bot_name}. Based on the system prompt, segment, conversation settings and last message, is it my turn to speak? Reply only by yes or no.",
     "evaluation": "Using the previous message and the conversation context {context}, select the most appropriate option from this list of options: {options} to evaluate the last message's {metric}. Never evaluate the users' messages, only the bots' responses using the list of bots' names {bots}. Be harsh. Only reply with the exact text of the option picked.",
     "overall_evaluation": "Using the bots' messages and the conversation context {context}, select the most appropriate option from this list of options: {options} to evaluate the bots' responses' overall {metric}. Be harsh. Only reply with the one option picked in the same format, nothing more.",
+    "history_summary": "The previous messages are part of a longer group chat. Here is the summary of everything that was said before them: ```{summary}```. Update this summary so that it also covers the previous messages. Keep who said what, the questions left open and the points participants agreed or disagreed on. Reply only with the updated summary, in at most {max_words} words.",
+    "previous_messages": "Summary of the earlier part of the conversation: {summary}",
+    "arbitrate_turns": "The following bots take part in this group chat: {personas}. Based on the previous messages, decide for every bot whether it should reply to the last message, and give each bot a priority from 1 (least relevant) to 5 (most relevant). A bot that is @mentioned should usually reply, unless the message does not need an answer from it. Avoid bot-only conversations and do not make several bots say the same thing. Respond only with valid JSON similar to {format}, with one entry per bot.",
     "baseline": "Given the previous message, generate an answer for all of the following bots {bots} using the following strategies {strategies}. If a bot should remain silent, make its answer an empty string. Keep your response short and in context. Reply in the following inline format 'bot_name: generated_answer' on the same line, and use a new line for each bot. Do not skip lines between the bot name and its answer."
 }
 
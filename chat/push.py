@@ -0,0 +1,97 @@
+import asyncio
+import logging
+from collections import defaultdict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import Max
+
+from chat.models import PushEvent
+
+logger = logging.getLogger(__name__)
+
+
+def publish(conversation_id, kind):
+    """
+    Tells the open chat pages of a conversation that something changed (see PushEvent.KINDS). Events go through
+    the database, as they are mostly published by task workers while pages are served by the web processes.
+    """
+    if not settings.PUSH["enabled"]:
+        return
+    PushEvent.objects.create(conversation_id=conversation_id, kind=kind)
+    push_hub.wake_up()
+
+
+class PushHub:
+    """
+    Fans out the events of the database to the pages of this process subscribed to their conversation.
+    A single query every PUSH["interval"] seconds serves all the open pages, and there is none when no page is open.
+    """
+
+    def __init__(self):
+        self._subscribers = defaultdict(set)  # {conversation id: queues}
+        self._task = None
+        self._loop = None
+        self._wakeup = None
+        self._last_id = None
+
+    def subscribe(self, conversation_id):
+        queue = asyncio.Queue()
+        self._subscribers[conversation_id].add(queue)
+        if self._task is None or self._loop is not asyncio.get_running_loop():
+            self._loop = asyncio.get_running_loop()
+            self._wakeup = asyncio.Event()
+            self._task = self._loop.create_task(self._run())
+        return queue
+
+    def unsubscribe(self, conversation_id, queue):
+        self._subscribers[conversation_id].discard(queue)
+        if not self._subscribers[conversation_id]:
+            del self._subscribers[conversation_id]
+
+    def wake_up(self):
+        """Checks for events right away, for the ones published by this process"""
+        if self._task is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def _run(self):
+        try:
+            if self._last_id is None:
+                # Earlier events are caught up by the page when it connects
+                self._last_id = (await PushEvent.objects.aaggregate(last=Max("id")))["last"] or 0
+            while self._subscribers:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), settings.PUSH["interval"])
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                await self.dispatch()
+        except Exception as e:
+            logger.error(f"[ERROR] Push events stopped: {e}")
+        finally:
+            self._task = None
+
+    async def dispatch(self):
+        """Hands the new events over to the subscribers of their conversation"""
+        events = await sync_to_async(list)(PushEvent.objects.filter(id__gt=self._last_id).order_by("id").values_list("id", "conversation_id", "kind"))
+        for id, conversation_id, kind in events:
+            for queue in self._subscribers.get(conversation_id, ()):
+                queue.put_nowait(kind)
+            self._last_id = id
+
+    async def stream(self, conversation_id):
+        """The server-sent events of a conversation, until the page is closed"""
+        queue = self.subscribe(conversation_id)
+        try:
+            yield f"retry: {settings.PUSH['retry']}\n\n"
+            while True:
+                try:
+                    kind = await asyncio.wait_for(queue.get(), settings.PUSH["keepalive"])
+                    yield f"event: {kind}\ndata: {conversation_id}\n\n"
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+        finally:
+            self.unsubscribe(conversation_id, queue)
+
+
+push_hub = PushHub()
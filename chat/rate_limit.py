@@ -0,0 +1,233 @@
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.db import DatabaseError, transaction
+
+import mistralai
+
+from chat.models import RateLimitBucket
+
+logger = logging.getLogger(__name__)
+
+BUCKETS = ("requests", "tokens")
+
+
+class Leases:
+    """
+    Capacity this process took from the shared buckets ahead of time, per (model, priority), so that most requests
+    are admitted without touching the database. Leftovers expire after LLM_RATE_LIMIT["lease_ttl"] seconds.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._leases = {}
+        self._pid = os.getpid()
+
+    def _reset_after_fork(self):
+        # django-q forks its workers; capacity leased by the parent must not be spent twice
+        if self._pid != os.getpid():
+            self._leases = {}
+            self._pid = os.getpid()
+
+    def get(self, model, priority):
+        """The lease of `model` for `priority`, expired leftovers are dropped but debts are kept"""
+        self._reset_after_fork()
+        lease = self._leases.setdefault((model, priority), {"requests": 0, "tokens": 0, "expires_at": 0})
+        if lease["expires_at"] <= time.time():
+            lease["requests"] = min(lease["requests"], 0)
+            lease["tokens"] = min(lease["tokens"], 0)
+        return lease
+
+    def drop(self, model):
+        with self.lock:
+            self._reset_after_fork()
+            for key in [key for key in self._leases if key[0] == model]:
+                del self._leases[key]
+
+    def clear(self):
+        with self.lock:
+            self._leases = {}
+
+
+leases = Leases()
+
+
+def get_limits(model):
+    return {**settings.LLM_RATE_LIMIT["default"], **settings.LLM_RATE_LIMIT["models"].get(model, {})}
+
+
+def get_priority(request_type):
+    return "background" if request_type in settings.LLM_RATE_LIMIT["background_request_types"] else "interactive"
+
+
+def count_tokens(messages):
+    """Rough token count (~4 characters per token) of a list of messages"""
+    return sum(len(msg["content"]) for msg in messages) // 4
+
+
+def estimate_tokens(messages):
+    """Rough token count of a request, including its expected completion"""
+    return count_tokens(messages) + settings.LLM_RATE_LIMIT["completion_tokens"]
+
+
+def try_acquire(model, tokens, priority):
+    """
+    Takes one request and `tokens` tokens, from this process' lease when it covers them, otherwise from the model's
+    shared buckets. Returns 0 on success, otherwise the number of seconds until both buckets could cover the request
+    (nothing is taken in that case).
+    """
+    costs = {"requests": 1, "tokens": tokens}
+    with leases.lock:
+        lease = leases.get(model, priority)
+        if any(lease[kind] < cost for kind, cost in costs.items()):
+            # Take a batch of LLM_RATE_LIMIT["lease"] of the capacity at once, or at least what this request misses
+            limits = get_limits(model)
+            capacities = {"requests": limits["requests_per_minute"], "tokens": limits["tokens_per_minute"]}
+            missing = {kind: max(cost - lease[kind], 0) for kind, cost in costs.items()}
+            batch = {kind: max(missing[kind], settings.LLM_RATE_LIMIT["lease"] * capacities[kind]) for kind in BUCKETS}
+            wait = take(model, batch, priority)
+            if wait:
+                if batch == missing:
+                    return wait
+                wait = take(model, missing, priority)
+                if wait:
+                    return wait
+                batch = missing
+            for kind in BUCKETS:
+                lease[kind] += batch[kind]
+            lease["expires_at"] = time.time() + settings.LLM_RATE_LIMIT["lease_ttl"]
+        for kind, cost in costs.items():
+            lease[kind] -= cost
+    return 0
+
+
+def take(model, amounts, priority):
+    """
+    Takes `amounts` from the model's shared buckets in one transaction. Returns 0 on success, otherwise the number
+    of seconds until both buckets could cover them (nothing is taken in that case).
+    Background requests may not dip into the share of capacity reserved for interactive ones.
+    """
+    limits = get_limits(model)
+    capacities = {"requests": limits["requests_per_minute"], "tokens": limits["tokens_per_minute"]}
+    reserve = settings.LLM_RATE_LIMIT["reserve"] if priority == "background" else 0
+    names = {kind: f"{model}:{kind}" for kind in BUCKETS}
+    now = time.time()
+
+    with transaction.atomic():
+        buckets = {bucket.name: bucket for bucket in RateLimitBucket.objects.select_for_update().filter(name__in=names.values())}
+        if len(buckets) < len(names):
+            RateLimitBucket.objects.bulk_create(
+                [RateLimitBucket(name=names[kind], tokens=capacities[kind], updated_at=now) for kind in BUCKETS],
+                ignore_conflicts=True,
+            )
+            buckets = {bucket.name: bucket for bucket in RateLimitBucket.objects.select_for_update().filter(name__in=names.values())}
+
+        wait = 0
+        levels = {}
+        for kind, cost in amounts.items():
+            bucket = buckets[names[kind]]
+            capacity = capacities[kind]
+            rate = capacity / 60
+            floor = reserve * capacity
+            cost = min(cost, capacity - floor)
+            if bucket.updated_at > now:
+                # Paused after the provider returned a 429
+                wait = max(wait, bucket.updated_at - now + cost / rate)
+                continue
+            levels[kind] = min(capacity, bucket.tokens + (now - bucket.updated_at) * rate) - cost
+            if levels[kind] < floor:
+                wait = max(wait, (floor - levels[kind]) / rate)
+
+        if wait:
+            return wait
+        for kind, level in levels.items():
+            bucket = buckets[names[kind]]
+            bucket.tokens = level
+            bucket.updated_at = now
+            bucket.save(update_fields=["tokens", "updated_at"])
+    return 0
+
+
+def acquire(model, tokens, priority, deadline):
+    """
+    Blocks until the request fits in the model's buckets. Returns False if that would take past `deadline` (monotonic time).
+    """
+    if not settings.LLM_RATE_LIMIT["enabled"]:
+        return True
+    while True:
+        try:
+            wait = try_acquire(model, tokens, priority)
+        except DatabaseError as e:
+            logger.error(f"[LLM] Rate limiter unavailable, proceeding without it: {e}")
+            return True
+        if not wait:
+            return True
+        if time.monotonic() + wait > deadline:
+            return False
+        logger.info(f"[LLM] Waiting {wait:.1f}s for {priority} capacity on {model}")
+        time.sleep(wait)
+
+
+async def aacquire(model, tokens, priority, deadline):
+    """
+    Async variant of acquire.
+    """
+    if not settings.LLM_RATE_LIMIT["enabled"]:
+        return True
+    while True:
+        try:
+            wait = await asyncio.to_thread(try_acquire, model, tokens, priority)
+        except DatabaseError as e:
+            logger.error(f"[LLM] Rate limiter unavailable, proceeding without it: {e}")
+            return True
+        if not wait:
+            return True
+        if time.monotonic() + wait > deadline:
+            return False
+        logger.info(f"[LLM] Waiting {wait:.1f}s for {priority} capacity on {model}")
+        await asyncio.sleep(wait)
+
+
+def settle(model, estimated_tokens, total_tokens, priority):
+    """
+    Corrects this process' lease once the actual usage of a request is known. An overrun is a debt that the next
+    batch taken from the shared buckets covers.
+    """
+    if settings.LLM_RATE_LIMIT["enabled"] and total_tokens is not None:
+        with leases.lock:
+            leases.get(model, priority)["tokens"] += estimated_tokens - total_tokens
+
+
+def pause(model, delay):
+    """
+    Empties the model's buckets for `delay` seconds so that every worker backs off after a 429.
+    Other processes keep spending their leases, which are small and short-lived.
+    """
+    if settings.LLM_RATE_LIMIT["enabled"]:
+        leases.drop(model)
+        RateLimitBucket.objects.filter(name__startswith=f"{model}:").update(tokens=0, updated_at=time.time() + delay)
+
+
+def get_retry_after(e):
+    if not isinstance(e, mistralai.models.SDKError) or e.raw_response is None:
+        return None
+    try:
+        return float(e.raw_response.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt, e=None):
+    """
+    Honors Retry-After when the provider sends one, otherwise exponential backoff with full jitter.
+    """
+    retry_after = get_retry_after(e)
+    if retry_after is not None:
+        return retry_after
+    base = settings.LLM_RATE_LIMIT["backoff_base"]
+    return random.uniform(0, min(settings.LLM_RATE_LIMIT["backoff_max"], base * 2 ** (attempt - 1)))
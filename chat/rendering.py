@@ -0,0 +1,37 @@
+import re
+import threading
+
+import markdown
+from django.utils.safestring import mark_safe
+
+# Bump when the output of highlight_mentions or render_markdown changes, then run the render_messages command
+# to render the stored message HTML again
+RENDERER_VERSION = 1
+
+_local = threading.local()
+
+
+def highlight_mentions(value):
+    """Wraps @mentions in <strong> tags."""
+    def replacer(match):
+        return f"<strong>{match.group(0)}</strong>"
+    
+    highlighted = re.sub(r'@\w+', replacer, value)
+    return mark_safe(highlighted)
+
+
+def render_markdown(text):
+    """Convert markdown to safe HTML with line breaks and basic formatting."""
+    # One converter per thread, as they are not thread-safe
+    md = getattr(_local, "md", None)
+    if md is None:
+        md = _local.md = markdown.Markdown(
+            extensions=["nl2br", "sane_lists"],
+            output_format="html5"
+        )
+    return mark_safe(md.reset().convert(text))
+
+
+def render_message(text):
+    """The HTML of a message, as stored on Message.html"""
+    return render_markdown(highlight_mentions(text))
@@ -0,0 +1,131 @@
+import gzip
+import json
+import logging
+from datetime import timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.db.models import Min, Q
+from django.utils import timezone
+from django_q.models import Task
+
+from chat.models import LLMRequest, PromptBlob, PushEvent
+
+logger = logging.getLogger(__name__)
+
+
+def batches(queryset):
+    """
+    Yields the rows of `queryset` by primary key, RETENTION["batch_size"] at a time and at most RETENTION["max_batches"]
+    times. Handled rows must leave the queryset (compressed or deleted), as every batch starts from the first row.
+    """
+    for _ in range(settings.RETENTION["max_batches"]):
+        batch = list(queryset.order_by("pk")[:settings.RETENTION["batch_size"]])
+        if not batch:
+            return
+        yield batch
+
+
+def expired_llm_requests(now):
+    """LLM requests older than the TTL of their request type"""
+    ttls = settings.RETENTION["ttls"]
+    expired = Q(timestamp__lt=now - timedelta(days=settings.RETENTION["ttl"])) & ~Q(request_type__in=list(ttls))
+    for request_type, ttl in ttls.items():
+        expired |= Q(request_type=request_type, timestamp__lt=now - timedelta(days=ttl))
+    return LLMRequest.objects.filter(expired)
+
+
+def archive_path(timestamp):
+    return Path(settings.RETENTION["archive_dir"]) / f"llm_requests-{timestamp:%Y-%m}.jsonl.gz"
+
+
+def to_record(request, blobs):
+    """The request as a self-contained archive record, with its messages reconstructed from `blobs`"""
+    record = {field.attname: getattr(request, field.attname) for field in LLMRequest._meta.concrete_fields if field.name != "body"}
+    record["messages"] = request.get_messages(blobs)
+    record["prompt"], record["response"] = request.bodies(blobs)
+    record["timestamp"] = request.timestamp.isoformat()
+    return record
+
+
+def archive_llm_requests(now):
+    """
+    Appends the expired LLM requests to the monthly archives, then deletes them. A row archived by a run
+    interrupted before the delete is archived again by the next one: readers should deduplicate by id.
+    """
+    archived = 0
+    for batch in batches(expired_llm_requests(now)):
+        by_path = {}
+        blobs = LLMRequest.load_blobs(batch)
+        for request in batch:
+            by_path.setdefault(archive_path(request.timestamp), []).append(to_record(request, blobs))
+        for path, records in by_path.items():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # Each append adds a gzip member, the file stays readable as a whole (e.g. with zcat)
+            with gzip.open(path, "at", encoding="utf-8") as archive:
+                archive.writelines(json.dumps(record) + "\n" for record in records)
+        LLMRequest.objects.filter(pk__in=[request.pk for request in batch]).delete()
+        archived += len(batch)
+    return archived
+
+
+def compress_llm_requests(now):
+    """Compresses the prompts and responses of the LLM requests older than RETENTION["compress_after"]"""
+    compressed = 0
+    rows = LLMRequest.objects.filter(body__isnull=True, timestamp__lt=now - timedelta(days=settings.RETENTION["compress_after"]))
+    for batch in batches(rows):
+        for request in batch:
+            request.compress()
+        LLMRequest.objects.bulk_update(batch, ["body", "prompt", "response"])
+        compressed += len(batch)
+    return compressed
+
+
+def prune_blobs(now):
+    """
+    Deletes the prompt blobs no remaining LLM request references: requests reference a blob when they are written,
+    which also marks it as used, so blobs last used before the oldest request are unreferenced.
+    """
+    pruned = 0
+    oldest = LLMRequest.objects.aggregate(oldest=Min("timestamp"))["oldest"]
+    # Requests still in the write-behind buffer mark their blobs when they are written
+    cutoff = min(oldest or now, now - timedelta(hours=1))
+    rows = PromptBlob.objects.filter(last_used_at__lt=cutoff).values_list("pk", flat=True)
+    for batch in batches(rows):
+        PromptBlob.objects.filter(pk__in=batch).delete()
+        pruned += len(batch)
+    return pruned
+
+
+def prune_tasks(now):
+    """Deletes the django-q task results older than RETENTION["task_ttl"]"""
+    pruned = 0
+    rows = Task.objects.filter(stopped__lt=now - timedelta(days=settings.RETENTION["task_ttl"])).values_list("pk", flat=True)
+    for batch in batches(rows):
+        Task.objects.filter(pk__in=batch).delete()
+        pruned += len(batch)
+    return pruned
+
+
+def prune_push_events(now):
+    """Deletes the push events older than PUSH["event_ttl"], all pages have been told about them by then"""
+    pruned = 0
+    rows = PushEvent.objects.filter(timestamp__lt=now - timedelta(seconds=settings.PUSH["event_ttl"])).values_list("pk", flat=True)
+    for batch in batches(rows):
+        PushEvent.objects.filter(pk__in=batch).delete()
+        pruned += len(batch)
+    return pruned
+
+
+def prune_history():
+    """Archives, compresses and prunes the histories, a bounded amount at a time. Returns the number of rows handled per step"""
+    now = timezone.now()
+    counts = {
+        "archived": archive_llm_requests(now),
+        "compressed": compress_llm_requests(now),
+        "blobs_pruned": prune_blobs(now),
+        "tasks_pruned": prune_tasks(now),
+        "push_events_pruned": prune_push_events(now),
+    }
+    logger.info(f"[INFO] History retention: {counts}")
+    return counts
@@ -0,0 +1,34 @@
+from django.conf import settings
+
+# Models of each separate database: (app label, model name, or None for the whole app)
+ROUTES = {
+    "logs": [("chat", "llmrequest"), ("chat", "promptblob")],
+    "tasks": [("django_q", None)],
+}
+
+
+class SeparateDatabaseRouter:
+    """
+    Sends the LLM request log and the django-q tables to their own databases when they are enabled
+    in settings.SEPARATE_DATABASES. Everything else stays in the default database.
+    """
+
+    def database_for(self, app_label, model_name=None):
+        for alias in settings.SEPARATE_DATABASES:
+            if any(app_label == label and name in (None, model_name) for label, name in ROUTES[alias]):
+                return alias
+        return None
+
+    def db_for_read(self, model, **hints):
+        return self.database_for(model._meta.app_label, model._meta.model_name)
+
+    def db_for_write(self, model, **hints):
+        return self.database_for(model._meta.app_label, model._meta.model_name)
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        alias = self.database_for(app_label, model_name)
+        if alias:
+            return db == alias
+        if db in ROUTES:
+            return False
+        return None
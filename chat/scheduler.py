@@ -0,0 +1,96 @@
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import F, Q
+from django.utils import timezone
+from django_q.models import Schedule
+from django_q.tasks import async_task
+
+from chat.models import Conversation
+
+logger = logging.getLogger(__name__)
+
+
+class GenerationObsolete(Exception):
+    """A newer message made the running generation obsolete"""
+
+
+def running(conversation_id):
+    """Whether a generation of the conversation is running. One that ran longer than the task timeout was killed"""
+    stale = timezone.now() - timedelta(seconds=settings.Q_CLUSTER["timeout"])
+    return Conversation.objects.filter(id=conversation_id, generation_started_at__gte=stale).exists()
+
+
+def enqueue_generation(conversation_id):
+    """
+    Queues the generation task, once the conversation has been quiet for GENERATION["quiet_window"] seconds.
+    Delayed runs go through a django-q schedule, which the cluster only checks every 30 seconds or so.
+    """
+    uuid, last_message_at = Conversation.objects.values_list("uuid", "last_message_at").get(id=conversation_id)
+    quiet_window = settings.GENERATION["quiet_window"]
+    next_run = last_message_at + timedelta(seconds=quiet_window) if last_message_at else timezone.now()
+    # Tasks run inline in the caller in sync mode, there is nothing to delay
+    if quiet_window and next_run > timezone.now() and not settings.Q_CLUSTER.get("sync"):
+        logger.info(f"[INFO] Scheduling generate_messages for {uuid} at {next_run}")
+        Schedule.objects.create(
+            name=f"generate_messages_{uuid}",
+            func="chat.tasks.generate_messages",
+            args=f"{conversation_id}",
+            schedule_type=Schedule.ONCE,
+            next_run=next_run,
+        )
+    else:
+        logger.info(f"[INFO] Queueing generate_messages for {uuid}")
+        async_task("chat.tasks.generate_messages", conversation_id, task_name=f"generate_messages_{uuid}")
+
+
+def request_generation(conversation, obsolete=True):
+    """
+    Asks for a generation for a new message. It is coalesced with the generation already queued, if any, and queued
+    by the running generation when it finishes. With `obsolete`, the running generation stops before posting anything.
+    """
+    if obsolete:
+        Conversation.objects.filter(id=conversation.id).update(generation_token=F("generation_token") + 1)
+    queued = Conversation.objects.filter(id=conversation.id, generation_queued=False).update(generation_queued=True)
+    if running(conversation.id):
+        return
+    # Also when a generation was already queued but its run was killed before it could queue it
+    if queued or Conversation.objects.filter(id=conversation.id, generation_started_at__isnull=False).exists():
+        enqueue_generation(conversation.id)
+
+
+def start_generation(conversation_id):
+    """
+    Starts the queued generation and returns its token. Returns None if none is queued (another task started it)
+    or one is still running, which queues it again when it finishes (see finish_generation). Never waits.
+    """
+    if settings.GENERATION["quiet_window"] and not settings.Q_CLUSTER.get("sync"):
+        last_message_at = Conversation.objects.values_list("last_message_at", flat=True).get(id=conversation_id)
+        if last_message_at and timezone.now() - last_message_at < timedelta(seconds=settings.GENERATION["quiet_window"]):
+            # More messages arrived since it was queued, it stays queued until they stop
+            enqueue_generation(conversation_id)
+            return None
+    now = timezone.now()
+    stale = now - timedelta(seconds=settings.Q_CLUSTER["timeout"])
+    started = Conversation.objects.filter(
+        Q(generation_started_at__isnull=True) | Q(generation_started_at__lt=stale), id=conversation_id, generation_queued=True,
+    ).update(generation_queued=False, generation_started_at=now)
+    if not started:
+        return None
+    return Conversation.objects.values_list("generation_token", flat=True).get(id=conversation_id)
+
+
+def finish_generation(conversation_id):
+    """Ends the running generation, and queues the generation requested meanwhile"""
+    Conversation.objects.filter(id=conversation_id).update(generation_started_at=None)
+    # After clearing the run, so that a request either sees it finished or is seen here
+    if Conversation.objects.filter(id=conversation_id, generation_queued=True).exists():
+        enqueue_generation(conversation_id)
+
+
+def check_generation(conversation):
+    """Raises GenerationObsolete if a newer message arrived since the generation of `conversation` started"""
+    token = getattr(conversation, "_generation_token", None)
+    if token is not None and not Conversation.objects.filter(id=conversation.id, generation_token=token).exists():
+        raise GenerationObsolete()
@@ -1,28 +1,56 @@
 from django.db.models.signals import post_save
 from django.dispatch import receiver
-from django_q.models import Schedule, Task
+from django_q.models import Schedule
+from django_q.signals import post_execute_in_worker
 from django_q.tasks import async_task
 from django.core.cache import cache
-from chat.models import Message
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Value
+from django.db.models.functions import Coalesce
+from chat.audit import request_buffer
+from chat.evaluation import count_words
+from chat.models import Conversation, Message, ParticipantActivity
+from chat.push import publish
+from chat.scheduler import request_generation
 import logging
 
 logger = logging.getLogger(__name__)
 
-@receiver(post_save, sender=Message)
-def on_message_created(sender, instance, created, **kwargs):
-    if not created:
-        return
+def count_messages(conversation, messages):
+    """Adds the new `messages` of `conversation`, in posting order, to its counters and the activity of their participants"""
+    first, last = messages[0], messages[-1]
+    by_participant = {}
+    for message in messages:
+        by_participant.setdefault(message.participant, []).append(message)
+    with transaction.atomic():
+        Conversation.objects.filter(id=conversation.id).update(
+            message_count=F("message_count") + len(messages),
+            first_message_at=Coalesce("first_message_at", Value(first.timestamp)),
+            last_message_at=last.timestamp,
+            last_participant=last.participant,
+            last_participant_type=last.participant.participant_type,
+            # Title, summary and metrics are refreshed by the next sweep, see chat.sweeper
+            needs_refresh=True,
+        )
+        for participant, sent in by_participant.items():
+            ParticipantActivity.objects.get_or_create(
+                conversation=conversation,
+                participant=participant,
+                defaults={"first_message_at": sent[0].timestamp, "last_message_at": sent[0].timestamp},
+            )
+            ParticipantActivity.objects.filter(conversation=conversation, participant=participant).update(
+                message_count=F("message_count") + len(sent),
+                word_count=F("word_count") + sum(count_words(message.message) for message in sent),
+                last_message_at=sent[-1].timestamp,
+            )
+    conversation.refresh_from_db(fields=Conversation.COUNTER_FIELDS)
 
-    conversation = instance.conversation
-    schedule_name = f"generate_messages_{conversation.uuid}"
-
-    # Cancel any previously scheduled task for this conversation
-    gen_tasks = Task.objects.filter(name=schedule_name)
-    if gen_tasks:
-        for task in gen_tasks:
-            task.delete()
-        logger.info(f"[INFO] Cancelling existing scheduled task for {schedule_name}")
-    
+def evaluate_conversation(conversation, obsolete):
+    """
+    Runs the pipeline that follows new messages: generation, subtopics and history summary.
+    With `obsolete`, the running generation stops before posting anything (see chat.scheduler).
+    """
     # Cancel any previously scheduled task for this conversation
     chime_tasks = Schedule.objects.filter(name=f"chime_fallback_{conversation.id}")
     if chime_tasks:
@@ -30,7 +58,37 @@ def on_message_created(sender, instance, created, **kwargs):
             task.delete()
         logger.info(f"[INFO] Cancelled fallback chime task for conversation {conversation.id} due to new message")
 
-    # Trigger a new async task
-    logger.info(f"[INFO] Triggering new generate_messages task for {conversation.uuid}")
-    async_task("chat.tasks.generate_messages", conversation.id, task_name=schedule_name)
-    async_task("chat.tasks.update_conversation_subtopics", conversation.id)
\ No newline at end of file
+    # Coalesced with the generation already queued
+    request_generation(conversation, obsolete=obsolete)
+    async_task("chat.tasks.update_conversation_subtopics", conversation.id)
+
+    # Fold older messages into the rolling history summary once enough have left the prompt window
+    pending = conversation.messages.filter(id__gt=conversation.history_summary_cursor).count()
+    if pending >= settings.CONTEXT["window"] + settings.CONTEXT["summary_batch"]:
+        async_task("chat.tasks.update_history_summary", conversation.id, task_name=f"history_summary_{conversation.uuid}")
+
+@receiver(post_save, sender=Message)
+def update_conversation_counters(sender, instance, created, **kwargs):
+    # Connected before on_message_created, so that the generation it triggers sees the new counters
+    if created:
+        count_messages(instance.conversation, [instance])
+
+@receiver(post_save, sender=Message)
+def on_message_created(sender, instance, created, **kwargs):
+    # Messages posted by a generation run are batched instead, see chat.bot.batch_messages
+    if created:
+        # Human messages obsolete the running generation
+        evaluate_conversation(instance.conversation, obsolete=instance.participant.participant_type == "user")
+
+
+@receiver(post_save, sender=Message)
+def publish_new_message(sender, instance, created, **kwargs):
+    if created:
+        # Once committed, so that the pages told about it can load it
+        transaction.on_commit(lambda: publish(instance.conversation_id, "message"))
+
+
+@receiver(post_execute_in_worker)
+def flush_llm_requests(sender, **kwargs):
+    # Write the task's LLM requests before the worker can be recycled
+    request_buffer.flush()
\ No newline at end of file
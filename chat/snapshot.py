@@ -0,0 +1,147 @@
+from contextlib import contextmanager
+from functools import cached_property
+
+from django.conf import settings
+from django.db.models import F
+
+from chat.models import Participant
+
+
+def message_window():
+    """Number of recent messages kept in a snapshot, enough for every check of the generation pipeline"""
+    return max(
+        10,  # check_turn looks at the last 10 messages
+        settings.CONTEXT["max_messages"],
+        settings.SHORT_TERM_CONTEXT,
+        settings.LONG_TERM_CONTEXT,
+        settings.STAGNATION_PERIOD,
+        settings.REPETITION_THRESHOLD,
+        settings.WAITING_MESSAGE_NB + 1,
+    )
+
+
+class ConversationSnapshot:
+    """
+    Read-only view of a conversation shared by the steps of a generation run. Each part (participants,
+    recent messages, per-participant activity, settings and segments, subtopics) is loaded with a single
+    query on first use, so the number of queries does not grow with the conversation or the number of bots.
+    Counts and first/last message times come from the counters maintained on Conversation and ParticipantActivity.
+    """
+
+    def __init__(self, conversation):
+        self.conversation = conversation
+        self.window = message_window()
+
+    @cached_property
+    def participants(self):
+        return list(self.conversation.participants.select_related("user", "bot"))
+
+    @cached_property
+    def bots(self):
+        return [participant.bot for participant in self.participants if participant.participant_type == "bot"]
+
+    def names(self, participant_type):
+        return ", ".join(participant.name() for participant in self.participants if participant.participant_type == participant_type)
+
+    @cached_property
+    def human_usernames(self):
+        # Every human of the platform, as in detect_human_mention
+        return list(Participant.objects.filter(participant_type="user").values_list("user__username", flat=True))
+
+    def participant_for(self, bot):
+        for participant in self.participants:
+            if participant.bot_id == bot.id:
+                return participant
+        return self.conversation.participants.get(bot__id=bot.id)
+
+    def participants_by_id(self, ids):
+        known = {participant.id: participant for participant in self.participants}
+        missing = [id for id in ids if id not in known]
+        if missing:
+            # Participants who posted but have since left the conversation
+            known.update(Participant.objects.select_related("user", "bot").in_bulk(missing))
+        return [known[id] for id in ids]
+
+    @cached_property
+    def messages(self):
+        """The last `window` messages, oldest first"""
+        recent = self.conversation.messages.select_related("participant__user", "participant__bot").order_by("-timestamp")[:self.window]
+        return list(recent)[::-1]
+
+    def recent_messages(self, n):
+        """The last `n` messages, oldest first"""
+        if n > self.window:
+            recent = self.conversation.messages.select_related("participant__user", "participant__bot").order_by("-timestamp")[:n]
+            return list(recent)[::-1]
+        return self.messages[-n:] if n > 0 else []
+
+    @property
+    def last_message(self):
+        return self.messages[-1] if self.messages else None
+
+    @cached_property
+    def activity(self):
+        """{participant id: {"count", "first", "last"}} for every participant who posted"""
+        rows = self.conversation.activity.values("participant", count=F("message_count"), first=F("first_message_at"), last=F("last_message_at"))
+        return {row["participant"]: row for row in rows}
+
+    @property
+    def message_count(self):
+        return self.conversation.message_count
+
+    @property
+    def first_message_at(self):
+        return self.conversation.first_message_at
+
+    def active_participants(self, since=None):
+        """Participants who posted at or after `since`, or at all"""
+        ids = [id for id, row in self.activity.items() if since is None or row["last"] >= since]
+        return set(self.participants_by_id(ids))
+
+    def has_participated(self, bot):
+        return any(participant.bot_id == bot.id for participant in self.participants_by_id(list(self.activity)))
+
+    def last_active_bot(self):
+        """The bot who posted last, if any"""
+        bots = [participant for participant in self.participants_by_id(list(self.activity)) if participant.participant_type == "bot"]
+        if not bots:
+            return None
+        return max(bots, key=lambda participant: self.activity[participant.id]["last"]).bot
+
+    @cached_property
+    def conversation_settings(self):
+        return self.conversation.settings
+
+    @cached_property
+    def segments(self):
+        if not self.conversation_settings:
+            return []
+        return list(self.conversation_settings.segments.order_by("order"))
+
+    @cached_property
+    def sub_topics(self):
+        return list(self.conversation.sub_topics.all())
+
+    def add_message(self, message):
+        """Keeps the loaded parts current after a message is posted during the run (counters are kept by the post_save signal)"""
+        if "messages" in self.__dict__:
+            self.messages = (self.messages + [message])[-self.window:]
+        if "activity" in self.__dict__:
+            row = self.activity.setdefault(message.participant_id, {"participant": message.participant_id, "count": 0, "first": message.timestamp})
+            row["count"] += 1
+            row["last"] = message.timestamp
+
+
+def get_snapshot(conversation):
+    """Returns the snapshot of the run `conversation` is used in (see use_snapshot), or a new one"""
+    return getattr(conversation, "_snapshot", None) or ConversationSnapshot(conversation)
+
+
+@contextmanager
+def use_snapshot(conversation):
+    """Shares one snapshot between all the steps that handle `conversation` within the block"""
+    conversation._snapshot = snapshot = ConversationSnapshot(conversation)
+    try:
+        yield snapshot
+    finally:
+        del conversation._snapshot
@@ -3,28 +3,51 @@ import numpy as np
 
 from django.conf import settings
 from django.utils import timezone
-from chat.bot import generate_message, check_turn_mention
+from chat.bot import generate_message, prepare_message, finalize_message, turn_mention_messages, acheck_and_generate, arbitrate_turns, draft_writer, discard_draft
+from chat.llm import run_concurrently
 from chat.helpers import detect_mention, check_waiting, detect_human_mention, get_random_bot
 from chat.dialog_analyzer import extract_utterance_features, extract_participant_features, get_active_participants
-from chat.models import Message, Conversation, Strategy
+from chat.models import Conversation, Strategy
+from chat.snapshot import get_snapshot, use_snapshot
 from datetime import datetime
 import random
 
 logger = logging.getLogger(__name__)
 
 def mention(conversation):
-    bots = [participant.bot for participant in conversation.participants.filter(participant_type="bot")]
+    """
+    Replies as every bot mentioned in the last message. Mentioned bots are not arbitrated: the turn
+    checks and replies of all of them run concurrently; answers keep the (shuffled) order of the bots.
+    """
+    snapshot = get_snapshot(conversation)
+    bots = list(snapshot.bots)
     random.shuffle(bots)
-    answers = {}
-    
+    last_message = snapshot.last_message
+    if not last_message:
+        return False
+
+    pending = []
     for bot in bots:
-        last_message = conversation.messages.order_by('timestamp').last()
-        if detect_mention(bot.name, last_message):
-            logger.info(f'[INFO] Mention detected: {bot.name}')
-            if check_turn_mention(conversation, bot):
-                response = generate_message(conversation, bot, "mention")
-                if response: 
-                    answers[bot] = response
+        if not detect_mention(bot.name, last_message):
+            continue
+        logger.info(f'[INFO] Mention detected: {bot.name}')
+        messages = prepare_message(conversation, bot, "mention")
+        if not messages:
+            continue
+        turn_messages = turn_mention_messages(bot, last_message)
+        pending.append((bot, acheck_and_generate(bot, turn_messages, messages, "is_turn_mention", "mention", draft_writer(conversation, bot))))
+    if not pending:
+        return False
+
+    answers = {}
+    responses = run_concurrently(coroutine for _, coroutine in pending)
+    for (bot, _), bot_response in zip(pending, responses):
+        if bot_response is False:
+            discard_draft(conversation, bot)
+            continue
+        response = finalize_message(conversation, bot, "mention", bot_response)
+        if response:
+            answers[bot] = response
     return answers if answers else False
     
 
@@ -32,7 +55,8 @@ def indirect(conversation):
     """
     Replies to indirect questions i.e. without explicit mentions. Makes bots reply when general question is asked.
     """
-    last_message = conversation.messages.order_by("timestamp").last()
+    snapshot = get_snapshot(conversation)
+    last_message = snapshot.last_message
     if not last_message:
         return False
     
@@ -46,7 +70,7 @@ def indirect(conversation):
         #     return {bot: response} if response else False
         return False
     
-    if detect_human_mention(last_message):
+    if detect_human_mention(last_message, snapshot.human_usernames):
         logger.info(f"[INFO] Human Mention detected, not bot turn")
         return False
     
@@ -59,6 +83,11 @@ def indirect(conversation):
     #             answers[bot] = response
     #     return answers if answers else False
     if last_message.participant.user:
+        # Let the bot with the highest arbitration priority answer, if any should speak
+        decisions = arbitrate_turns(conversation)
+        speakers = [b for b, decision in decisions.items() if decision["speak"]] if decisions else []
+        if speakers:
+            bot = max(speakers, key=lambda b: decisions[b]["priority"])
         response = generate_message(conversation, bot, "indirect")
         return {bot: response} if response else False
     
@@ -72,17 +101,18 @@ def chime_in_silence(conversation):
 def fallback_chime(conversation_id, start_time):
     start_time = datetime.fromisoformat(start_time)
     conversation = Conversation.objects.get(id=conversation_id)
-    latest_message = conversation.messages.order_by("timestamp").last()
-    if latest_message and latest_message.timestamp >= start_time:
+    if conversation.last_message_at and conversation.last_message_at >= start_time:
         logger.info(f"[INFO] New message detected, aborting chime")
         return
-    elif detect_human_mention(latest_message):
-        logger.info(f"[INFO] Human Mention detected, aborting chime")
-        return
-    elif conversation.messages.all().count() >=2 and latest_message.participant.bot and len(set([msg.participant for msg in conversation.messages.order_by("-timestamp")[:2]]))==1:
-        logger.info(f"[INFO] Already Chimed in Silence, aborting chime")
-        return
-    chime_in_silence(conversation)
+    with use_snapshot(conversation) as snapshot:
+        latest_message = snapshot.last_message
+        if detect_human_mention(latest_message, snapshot.human_usernames):
+            logger.info(f"[INFO] Human Mention detected, aborting chime")
+            return
+        elif snapshot.message_count >=2 and conversation.last_participant_type == "bot" and len(set([msg.participant for msg in snapshot.recent_messages(2)]))==1:
+            logger.info(f"[INFO] Already Chimed in Silence, aborting chime")
+            return
+        chime_in_silence(conversation)
     
 def summarize(conversation):
     """
@@ -94,7 +124,7 @@ def summarize(conversation):
     if len(active_participants) - conversation.count_old_participants >= settings.ACTIVE_PARTICIPANT_THRESHOLD:
         logger.info(f"[INFO] Initiative Summarization triggered with {len(active_participants)} active participants.")
 
-        conversation.summary_posted_date = conversation.messages.latest("timestamp").timestamp
+        conversation.summary_posted_date = get_snapshot(conversation).last_message.timestamp
         conversation.count_old_participants = len(active_participants)
         conversation.save()
 
@@ -129,7 +159,7 @@ def encourage(conversation):
         length = stats['len']
         if (freq < avg_freq - settings.LURKER_THRESHOLD_RATIO * freq_variance and 
            length < avg_len - settings.LURKER_THRESHOLD_RATIO * len_variance):
-            conversation_messages = Message.objects.filter(conversation=conversation).order_by("-timestamp")[:N]
+            conversation_messages = get_snapshot(conversation).recent_messages(N)
             recent_participation = [msg for msg in conversation_messages if msg.participant.user]
             if len(recent_participation) < settings.LURKER_THRESHOLD_COUNT:
                 lurkers.append(user.user.username if user.user else user.bot.name)
@@ -170,13 +200,15 @@ def resolve(conversation):
     Helps users reach a consensus in a timely manner, thereby providing an efficient discussion procedure
     """
     # Check if stagnation occurred
-    recent_messages = list(conversation.messages.order_by("-timestamp")[:settings.STAGNATION_PERIOD])
+    snapshot = get_snapshot(conversation)
+    recent_messages = snapshot.recent_messages(settings.STAGNATION_PERIOD)
     if len(recent_messages) < settings.STAGNATION_PERIOD:
         return False
-    earliest_timestamp = recent_messages[-1].timestamp
+    earliest_timestamp = recent_messages[0].timestamp
     strat_object = Strategy.objects.get(name="Resolve")
     
-    if not conversation.sub_topics.filter(status_updated_at__gt=earliest_timestamp).exists() and check_waiting(conversation, strat_object.triggered_at):
+    updated_topics = [topic for topic in snapshot.sub_topics if topic.status_updated_at > earliest_timestamp]
+    if not updated_topics and check_waiting(conversation, strat_object.triggered_at):
         logger.info("[INFO] Conflict detected. Suggesting resolution.")
         strat_object.triggered_at = timezone.now()
         strat_object.save()
@@ -192,9 +224,10 @@ def chime_in(conversation):
     - Advancing stuck scenarios
     Triggered by semantic Factor: Activated when conversation gets stuck (repetitive or unresolved issues).
     """
-    messages_count = conversation.messages.count()
+    snapshot = get_snapshot(conversation)
+    messages_count = snapshot.message_count
     if messages_count >= settings.REPETITION_THRESHOLD:
-        last_messages = conversation.messages.order_by("-timestamp")[:settings.REPETITION_THRESHOLD]
+        last_messages = snapshot.recent_messages(settings.REPETITION_THRESHOLD)
         if len(set(msg.message for msg in last_messages)) == 1:
             logger.info("[INFO] Chime-in triggered due to repetitive conversation.")
             return True
@@ -0,0 +1,33 @@
+import logging
+
+from django.conf import settings
+from django_q.tasks import async_task
+
+from chat.models import Conversation
+
+logger = logging.getLogger(__name__)
+
+
+def claim_changed_conversations():
+    """
+    Takes up to SWEEP["batch_size"] conversations flagged by new messages, the ones waiting the longest first,
+    and clears their flag. It is cleared before the refresh, so that messages posted meanwhile flag them again.
+    """
+    flagged = Conversation.objects.filter(needs_refresh=True).order_by("last_message_at").values_list("id", flat=True)
+    # Each conversation is claimed by a single sweep, should sweeps overlap
+    return [
+        conversation_id for conversation_id in flagged[:settings.SWEEP["batch_size"]]
+        if Conversation.objects.filter(id=conversation_id, needs_refresh=True).update(needs_refresh=False)
+    ]
+
+
+def sweep():
+    """
+    Refreshes the title, summary and metrics of the conversations changed since the last sweep, one task each so that
+    the task workers handle them in parallel. Idle conversations cost nothing. Returns the number of conversations queued.
+    """
+    claimed = claim_changed_conversations()
+    for conversation_id in claimed:
+        async_task("chat.tasks.refresh_conversation", conversation_id, task_name=f"refresh_conversation_{conversation_id}")
+    logger.info(f"[INFO] Sweep: refreshing {len(claimed)} conversations")
+    return len(claimed)
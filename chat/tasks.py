@@ -4,10 +4,16 @@ from django.conf import settings
 from chat.llm import llm_conversation_title
 from chat.models import Conversation
 from chat.strategies import mention, summarize, encourage, transition, resolve, chime_in, indirect
-from chat.bot import synthesize, post_message, generate_strategy_message
+from chat.bot import batch_messages, synthesize, post_message, generate_strategy_message
 from chat.helpers import estimate_delay, get_random_bot
+from chat.snapshot import use_snapshot
 from chat.dialog_analyzer import update_sub_topics_status, update_accumulative_summary
+from chat.context import update_history_summary as fold_history_summary
 from chat.evaluation import get_metrics
+from chat.retention import prune_history as apply_retention
+from chat.push import publish
+from chat.sweeper import sweep
+from chat.scheduler import GenerationObsolete, check_generation, finish_generation, start_generation
 from django.utils import timezone
 from datetime import timedelta
 
@@ -30,8 +36,11 @@ def update_conversation_title(conversation_id):
     conversation = Conversation.objects.get(id=conversation_id)
     
     try:
-        if conversation.messages.last().timestamp > conversation.title_update_date or conversation.title is None:
+        if conversation.last_message_at and (conversation.last_message_at > conversation.title_update_date or conversation.title is None):
+            title = conversation.title
             llm_conversation_title(conversation)
+            if conversation.title != title:
+                publish(conversation.id, "title")
     except AttributeError as e:
         logger.info(f"[ERROR] Failed to update title: {e}")
         pass
@@ -44,8 +53,12 @@ def update_conversation_title(conversation_id):
 def update_conversation_subtopics(conversation_id):
     conversation = Conversation.objects.get(id=conversation_id)
     try:
+        subtopics = list(conversation.sub_topics.values_list("name", "status"))
         update_sub_topics_status(conversation)
         logger.info("[INFO] Updated subtopics")
+        # Subtopics are shown with the metrics
+        if list(conversation.sub_topics.values_list("name", "status")) != subtopics:
+            publish(conversation.id, "metrics")
     except AttributeError as e:
         logger.info(f"[ERROR] Failed to update subtopics: {e}")
         pass
@@ -59,8 +72,11 @@ def update_conversation_subtopics(conversation_id):
 def update_conversation_summary(conversation_id):
     conversation = Conversation.objects.get(id=conversation_id)
     try:
-        if conversation.messages.last().timestamp > conversation.summary_update_date or conversation.summary is None:
+        if conversation.last_message_at and (conversation.last_message_at > conversation.summary_update_date or conversation.summary is None):
+            summary = conversation.summary
             update_accumulative_summary(conversation)
+            if conversation.summary != summary:
+                publish(conversation.id, "summary")
     except AttributeError as e:
         logger.info(f"[ERROR] Failed to update summary: {e}")
         pass
@@ -70,14 +86,47 @@ def update_conversation_summary(conversation_id):
 
     return True
 
+def update_history_summary(conversation_id):
+    conversation = Conversation.objects.get(id=conversation_id)
+    try:
+        # One batch at a time until the summary has caught up
+        while fold_history_summary(conversation):
+            pass
+    except Exception as e:
+        logger.info(f"[ERROR] Unexpected error updating history summary: {e}")
+        pass
+
+    return True
+
+def prune_history():
+    """Scheduled hourly by the setup command, see RETENTION in settings.py"""
+    return apply_retention()
+
+def sweep_conversations():
+    """Scheduled every SWEEP["interval"] minutes by the setup command"""
+    return sweep()
+
+def refresh_conversation(conversation_id):
+    """Queued by the sweeper for a conversation changed since the last sweep"""
+    update_conversation_title(conversation_id)
+    update_conversation_summary(conversation_id)
+    update_evaluation_metrics(conversation_id)
+    return True
+
 def update_evaluation_metrics(conversation_id):
     conversation = Conversation.objects.get(id=conversation_id)
     try:
         metrics = get_metrics(conversation)
         # Save to a local file
         file_path = os.path.join(settings.BASE_DIR, f"metrics_{conversation.id}.json")
+        previous = None
+        if os.path.exists(file_path):
+            with open(file_path) as f:
+                previous = f.read()
         with open(file_path, "w") as f:
             json.dump(metrics, f)
+        if json.dumps(metrics) != previous:
+            publish(conversation.id, "metrics")
         
     except AttributeError as e:
         logger.info(f"[ERROR] Failed to update metrics: {e}")
@@ -112,36 +161,55 @@ def detect_triggers(conversation):
     return strategies
 
 def generate_messages(conversation_id): 
-    conversation = Conversation.objects.get(id=conversation_id)
-    responses = reply(conversation)
-    strategies = detect_triggers(conversation) #format: [{strategy.name : kwargs}]
-    logger.info(f"[INFO] Detected triggers: {strategies}")
-    random_bot = random.choice(list(responses.keys())) if responses else get_random_bot(conversation)
+    # Debounced, and at most one run at a time per conversation, see chat.scheduler
+    token = start_generation(conversation_id)
+    if token is None:
+        return
+    try:
+        run_generation(conversation_id, token)
+    except GenerationObsolete:
+        logger.info(f"[INFO] A newer message made the generation for conversation {conversation_id} obsolete, stopping")
+    finally:
+        finish_generation(conversation_id)
+
+def run_generation(conversation_id, token):
+    conversation = Conversation.objects.select_related("settings").get(id=conversation_id)
+    # Checked before posting anything (see chat.bot.post_message)
+    conversation._generation_token = token
+    # All steps of the run share one snapshot of the conversation, see chat.snapshot,
+    # and its messages are inserted together at the end, see chat.bot.batch_messages
+    with use_snapshot(conversation), batch_messages(conversation):
+        responses = reply(conversation)
+        check_generation(conversation)
+        strategies = detect_triggers(conversation) #format: [{strategy.name : kwargs}]
+        logger.info(f"[INFO] Detected triggers: {strategies}")
+        random_bot = random.choice(list(responses.keys())) if responses else get_random_bot(conversation)
     
-    response_strat = generate_strategy_message(conversation, random_bot, strategies) if strategies else None
+        response_strat = generate_strategy_message(conversation, random_bot, strategies) if strategies else None
+        check_generation(conversation)
     
-    if responses:
-        for bot, response_reply in responses.items():
-            if response_strat and bot is random_bot:
-                synthesize(conversation, bot, response_reply, response_strat)
-            else:
-                post_message(conversation, bot, response_reply)
-        return
+        if responses:
+            for bot, response_reply in responses.items():
+                if response_strat and bot is random_bot:
+                    synthesize(conversation, bot, response_reply, response_strat)
+                else:
+                    post_message(conversation, bot, response_reply)
+            return
     
-    if response_strat:
-        post_message(conversation, random_bot, response_strat)
-        return
+        if response_strat:
+            post_message(conversation, random_bot, response_strat)
+            return
     
-    logger.info(f'[INFO] No responses returned for conversation {conversation.id}')
+        logger.info(f'[INFO] No responses returned for conversation {conversation.id}')
     
-    delay = estimate_delay(conversation) # in minutes
+        delay = estimate_delay(conversation) # in minutes
     
-    logger.info(f'[INFO] Estimated delay: {delay}')
+        logger.info(f'[INFO] Estimated delay: {delay}')
     
-    Schedule.objects.create(
-        name=f"chime_fallback_{conversation.id}",
-        func="chat.strategies.fallback_chime",
-        args=f"{conversation.id}, '{timezone.now().isoformat()}'",
-        schedule_type='O',
-        next_run=timezone.now() + timedelta(minutes=delay)
-    )
\ No newline at end of file
+        Schedule.objects.create(
+            name=f"chime_fallback_{conversation.id}",
+            func="chat.strategies.fallback_chime",
+            args=f"{conversation.id}, '{timezone.now().isoformat()}'",
+            schedule_type='O',
+            next_run=timezone.now() + timedelta(minutes=delay)
+        )
\ No newline at end of file
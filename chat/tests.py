@@ -3,7 +3,42 @@ from django.db.models.signals import post_save
 from chat.signals import on_message_created
 from chat.models import Conversation, Message, Participant, Bot, User, SubTopic
 from chat.strategies import mention, summarize, encourage, transition, resolve, chime_in, indirect
-from chat.dialog_analyzer import update_sub_topics_status, extract_utterance_features, update_accumulative_summary, extract_participant_features
+from chat.dialog_analyzer import update_sub_topics_status, extract_utterance_features, update_accumulative_summary, extract_participant_features, get_active_participants
+from chat.llm import LLMClientPool, ResponseCache, aprompt_llm_messages, prompt_llm_messages, response_cache, route_model, run_concurrently
+from chat.models import GenerationTiming, LLMRequest, MessageDraft, PromptBlob, PushEvent
+from chat.push import PushHub, publish
+from chat.rendering import RENDERER_VERSION
+from asgiref.sync import async_to_sync, sync_to_async
+from chat.audit import LLMRequestBuffer
+from chat.bot import batch_messages, draft_writer, generate_strategy_message, parse_arbitration, parse_fused_response, post_message
+from chat.context import build_history, update_history_summary
+from chat.snapshot import use_snapshot
+from chat.models import Strategy
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.core.management import call_command
+from io import StringIO
+from chat.evaluation import get_metrics
+from chat.models import ParticipantActivity
+from chat.routers import SeparateDatabaseRouter
+from django_q.models import Schedule, Task
+from chat.retention import archive_path, prune_history
+import gzip
+import json
+import tempfile
+from django.urls import reverse
+from types import SimpleNamespace
+from chat.rate_limit import backoff_delay, leases, pause, settle, try_acquire
+from chat.sweeper import sweep
+from chat.tasks import refresh_conversation
+from chat.scheduler import GenerationObsolete, check_generation, finish_generation, request_generation, start_generation
+import httpx
+import mistralai
+from django.test import override_settings
+from django.conf import settings
+from unittest import mock
+import asyncio
+import numpy as np
 from django.utils import timezone
 from datetime import timedelta
 import time
@@ -162,4 +197,1049 @@ class DialogAnalyzerTestCase(TestCase):
         
         features = extract_participant_features(self.conversation)
         expected = {self.user: {'freq': 1, 'len': 5}, self.bot_participant: {'freq': 1, 'len': 6}}
-        self.assertEqual(features, expected)
\ No newline at end of file
+        self.assertEqual(features, expected)
+
+class LLMClientPoolTestCase(TestCase):
+    def test_reuses_client(self):
+        """Test that clients are reused per provider, model and API key"""
+        pool = LLMClientPool()
+        client = pool.get("mistral", "mistral-small-latest", "key")
+
+        self.assertIs(client, pool.get("mistral", "mistral-small-latest", "key"))
+        self.assertIsNot(client, pool.get("mistral", "mistral-small-latest", "other-key"))
+        self.assertEqual(pool.stats(), {"hits": 1, "misses": 2, "clients": 2})
+        pool.close()
+
+    def test_reset_after_fork(self):
+        """Test that a forked worker does not reuse the parent's clients"""
+        pool = LLMClientPool()
+        client = pool.get("mistral", "mistral-small-latest", "key")
+        pool._pid = -1
+
+        self.assertIsNot(client, pool.get("mistral", "mistral-small-latest", "key"))
+        pool.close()
+
+    def test_unknown_provider(self):
+        """Test that an unknown provider is rejected"""
+        with self.assertRaises(ValueError):
+            LLMClientPool().get("unknown", "model", "key")
+
+
+class ConcurrentLLMTestCase(TestCase):
+    def setUp(self):
+        self.conversation = Conversation.objects.create()
+        self.user = Participant.objects.create(participant_type="user", user=User.objects.create(username="active"))
+        self.bots = [Bot.objects.create(name=f"Bot{i}") for i in range(3)]
+        self.conversation.participants.add(self.user, *[Participant.objects.create(participant_type="bot", bot=bot) for bot in self.bots])
+        post_save.disconnect(on_message_created, sender=Message)
+
+    def tearDown(self):
+        post_save.connect(on_message_created, sender=Message)
+
+    def test_run_concurrently_keeps_order(self):
+        """Test that results are returned in the order of the coroutines"""
+        async def delayed(value, delay):
+            await asyncio.sleep(delay)
+            return value
+
+        self.assertEqual(run_concurrently([delayed(1, 0.2), delayed(2, 0), delayed(3, 0.1)]), [1, 2, 3])
+
+    @override_settings(TURN_ARBITRATION={"enabled": False})
+    def test_mention_concurrent(self):
+        """Test that all mentioned bots are checked and answered in one concurrent batch"""
+        Message.objects.create(conversation=self.conversation, participant=self.user, message="@Bot0 @Bot2 what do you think?")
+
+        async def fake_prompt(messages, **kwargs):
+            if "answer 'yes'" in messages[-1]["content"]:
+                return "yes" if messages[-1]["content"].startswith("You are Bot0.") else "no"
+            return "Sounds good"
+
+        with mock.patch("chat.bot.aprompt_llm_messages", fake_prompt):
+            response = mention(self.conversation)
+
+        self.assertEqual(response, {self.bots[0]: "Sounds good"})
+
+
+class TurnArbitrationTestCase(TestCase):
+    def setUp(self):
+        self.conversation = Conversation.objects.create()
+        self.user = Participant.objects.create(participant_type="user", user=User.objects.create(username="active"))
+        self.bots = [Bot.objects.create(name=f"Bot{i}", prompt="A bot") for i in range(3)]
+        self.conversation.participants.add(self.user, *[Participant.objects.create(participant_type="bot", bot=bot) for bot in self.bots])
+        post_save.disconnect(on_message_created, sender=Message)
+
+    def tearDown(self):
+        post_save.connect(on_message_created, sender=Message)
+
+    def test_parse_arbitration(self):
+        """Test that every bot gets a decision and invalid answers are rejected"""
+        decisions = parse_arbitration('{"bots": [{"name": "@bot1", "speak": true, "priority": 4}]}', self.bots)
+        self.assertEqual(decisions[self.bots[1]], {"speak": True, "priority": 4})
+        self.assertEqual(decisions[self.bots[0]], {"speak": False, "priority": 0})
+        self.assertIsNone(parse_arbitration("Bot1 should speak", self.bots))
+        self.assertIsNone(parse_arbitration('{"bots": "Bot1"}', self.bots))
+
+    def test_mention_not_arbitrated(self):
+        """Test that mentioned bots only check their own turn, without waiting for an arbitration"""
+        Message.objects.create(conversation=self.conversation, participant=self.user, message="@Bot0 @Bot1 what do you think?")
+
+        async def fake_prompt(messages, **kwargs):
+            return "yes" if kwargs["request_type"] == "is_turn_mention" else "Sounds good"
+
+        with mock.patch("chat.bot.prompt_llm_messages") as arbitrate, mock.patch("chat.bot.aprompt_llm_messages", fake_prompt):
+            response = mention(self.conversation)
+
+        arbitrate.assert_not_called()
+        self.assertEqual(set(response), {self.bots[0], self.bots[1]})
+
+
+SYNC_AUDIT = {"write_behind": False, "batch_size": 50, "interval": 2, "max_queued": 5000}
+
+
+@override_settings(LLM_CACHE={"request_types": ["is_turn"], "max_entries": 2, "ttl": 60}, LLM_AUDIT=SYNC_AUDIT)
+class ResponseCacheTestCase(TestCase):
+    def setUp(self):
+        response_cache.clear()
+
+    def test_lru_eviction(self):
+        """Test that the least recently used entry is evicted"""
+        cache = ResponseCache()
+        cache.set("a", "yes")
+        cache.set("b", "no")
+        cache.get("a")
+        cache.set("c", "yes")
+
+        self.assertEqual(cache.get("a"), "yes")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.stats(), {"hits": 2, "misses": 1, "entries": 2})
+
+    def test_ttl(self):
+        """Test that expired entries are not served"""
+        cache = ResponseCache()
+        with override_settings(LLM_CACHE={"request_types": [], "max_entries": 2, "ttl": -1}):
+            cache.set("a", "yes")
+
+        self.assertIsNone(cache.get("a"))
+
+    def test_key_normalization(self):
+        """Test that whitespace differences do not change the cache key"""
+        messages = [{"role": "user", "name": "System", "content": "Is it  your turn?\n"}]
+        normalized = [{"role": "user", "name": "System", "content": "Is it your turn?"}]
+
+        self.assertEqual(ResponseCache.key(messages, "model", 0.8, None), ResponseCache.key(normalized, "model", 0.8, None))
+        self.assertNotEqual(ResponseCache.key(messages, "model", 0.8, None), ResponseCache.key(messages, "model", 0.2, None))
+
+    def test_prompt_cache_hit(self):
+        """Test that an opted-in request type is answered from the cache and logged as such"""
+        messages = [{"role": "user", "name": "System", "content": "Is it your turn?"}]
+        _, model = route_model("is_turn")
+        response_cache.set(ResponseCache.key(messages, model, 0.8, None), "yes")
+
+        with mock.patch("chat.llm.client_pool") as client_pool:
+            self.assertEqual(prompt_llm_messages(messages, request_type="is_turn"), "yes")
+            client_pool.get.assert_not_called()
+
+        self.assertTrue(LLMRequest.objects.get(request_type="is_turn").cached)
+
+
+@override_settings(LLM_RATE_LIMIT={
+    "enabled": True,
+    "default": {"requests_per_minute": 4, "tokens_per_minute": 1000},
+    "models": {},
+    "completion_tokens": 0,
+    "reserve": 0.5,
+    "background_request_types": [],
+    "max_wait": 1,
+    "backoff_base": 1,
+    "backoff_max": 8,
+    "lease": 0,
+    "lease_ttl": 10,
+})
+class RateLimitTestCase(TestCase):
+    def setUp(self):
+        leases.clear()
+
+    def test_background_reserve(self):
+        """Test that background requests leave the reserved capacity to interactive ones"""
+        self.assertEqual(try_acquire("model", 10, "background"), 0)
+        self.assertEqual(try_acquire("model", 10, "background"), 0)
+        self.assertGreater(try_acquire("model", 10, "background"), 0)
+        self.assertEqual(try_acquire("model", 10, "interactive"), 0)
+
+    def test_token_bucket(self):
+        """Test that a request larger than the remaining tokens has to wait"""
+        self.assertEqual(try_acquire("model", 900, "interactive"), 0)
+        self.assertGreater(try_acquire("model", 200, "interactive"), 0)
+
+    def test_pause(self):
+        """Test that a 429 pauses the model's buckets for every worker"""
+        self.assertEqual(try_acquire("model", 10, "interactive"), 0)
+        pause("model", 30)
+
+        self.assertGreaterEqual(try_acquire("model", 10, "interactive"), 30)
+
+    def test_lease(self):
+        """Test that requests are served from the leased capacity without touching the shared buckets"""
+        with override_settings(LLM_RATE_LIMIT={**settings.LLM_RATE_LIMIT, "lease": 0.5}):
+            self.assertEqual(try_acquire("model", 100, "interactive"), 0)
+            with self.assertNumQueries(0):
+                self.assertEqual(try_acquire("model", 100, "interactive"), 0)
+                settle("model", 100, 500, "interactive")
+            # The 100 tokens overrun are owed on top of the request, more than the 500 left in the shared bucket
+            self.assertGreater(try_acquire("model", 450, "interactive"), 0)
+
+    def test_backoff_delay(self):
+        """Test that Retry-After is honored and backoff is otherwise capped"""
+        response = httpx.Response(429, headers={"Retry-After": "7"})
+        error = mistralai.models.SDKError("Too Many Requests", 429, "", response)
+
+        self.assertEqual(backoff_delay(1, error), 7)
+        self.assertLessEqual(backoff_delay(10), 8)
+
+
+@override_settings(LLM_AUDIT=SYNC_AUDIT)
+class StreamingTestCase(TestCase):
+    def setUp(self):
+        self.conversation = Conversation.objects.create()
+        self.user_active = User.objects.create(username="active")
+        self.user = Participant.objects.create(participant_type="user", user=self.user_active)
+        self.bot = Bot.objects.create(name="TestBot")
+        self.bot_participant = Participant.objects.create(participant_type="bot", bot=self.bot)
+        self.conversation.participants.add(self.user, self.bot_participant)
+        post_save.disconnect(on_message_created, sender=Message)
+
+    def tearDown(self):
+        post_save.connect(on_message_created, sender=Message)
+
+    def test_stream_into_draft(self):
+        """Test that streamed chunks end up in the draft and the final reply is returned"""
+        chunks = ["Hello", " there", "!"]
+        events = [
+            SimpleNamespace(data=SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=chunk))], usage=None))
+            for chunk in chunks
+        ]
+        client = mock.Mock()
+        client.chat.stream.return_value = iter(events)
+
+        with mock.patch("chat.llm.client_pool") as client_pool, override_settings(STREAMING={"enabled": True, "interval": 0, "stale_after": 120}):
+            client_pool.get.return_value = client
+            response = prompt_llm_messages([{"role": "user", "content": "Hi"}], on_delta=draft_writer(self.conversation, self.bot))
+
+        self.assertEqual(response, "Hello there!")
+        self.assertEqual(MessageDraft.objects.get(conversation=self.conversation).message, "Hello there!")
+
+    def test_post_message_replaces_draft(self):
+        """Test that posting the final message removes the draft"""
+        MessageDraft.objects.create(conversation=self.conversation, participant=self.bot_participant, message="Hel")
+
+        post_message(self.conversation, self.bot, "Hello!")
+
+        self.assertFalse(MessageDraft.objects.exists())
+        self.assertEqual(self.conversation.messages.last().message, "Hello!")
+
+    def test_load_drafts(self):
+        """Test that the drafts endpoint renders the partial replies"""
+        MessageDraft.objects.create(conversation=self.conversation, participant=self.bot_participant, message="Hel")
+        self.client.force_login(self.user_active)
+
+        response = self.client.get(reverse("chat:load_drafts", kwargs={"conversation_uuid": self.conversation.uuid}))
+
+        self.assertContains(response, "Hel")
+        self.assertContains(response, "typing...")
+
+    def test_draft_polling(self):
+        """Test that the chat page only polls drafts while a generation is queued or running"""
+        self.client.force_login(self.user_active)
+        url = reverse("chat:chat", kwargs={"conversation_uuid": self.conversation.uuid})
+
+        response = self.client.get(url)
+        self.assertContains(response, 'hx-trigger="every 500ms [window.draftsActive]"')
+        self.assertNotContains(response, "watchDrafts();")
+
+        Conversation.objects.filter(id=self.conversation.id).update(generation_queued=True)
+        self.assertContains(self.client.get(url), "watchDrafts();", count=1)
+
+
+@override_settings(LLM_AUDIT={"write_behind": True, "batch_size": 100, "interval": 3600, "max_queued": 3})
+class LLMRequestBufferTestCase(TestCase):
+    def test_flush(self):
+        """Test that queued requests are only written when the buffer is flushed"""
+        buffer = LLMRequestBuffer()
+        for i in range(2):
+            buffer.append(LLMRequest(request_type="is_turn", model="model", temperature=0.8, prompt=f"prompt {i}", response="yes"))
+
+        self.assertEqual(LLMRequest.objects.count(), 0)
+        self.assertEqual(buffer.stats()["queued"], 2)
+        self.assertEqual(buffer.flush(), 2)
+        self.assertEqual(LLMRequest.objects.count(), 2)
+        self.assertEqual(buffer.stats(), {"queued": 0, "flushed": 2, "dropped": 0, "failed_flushes": 0})
+
+    def test_max_queued(self):
+        """Test that the oldest requests are dropped when the queue is full"""
+        buffer = LLMRequestBuffer()
+        for i in range(5):
+            buffer.append(LLMRequest(request_type="is_turn", model="model", temperature=0.8, prompt=f"prompt {i}", response="yes"))
+
+        buffer.flush()
+        self.assertEqual(list(LLMRequest.objects.order_by("id").values_list("prompt", flat=True)), ["prompt 2", "prompt 3", "prompt 4"])
+        self.assertEqual(buffer.stats()["dropped"], 2)
+
+    @override_settings(LLM_AUDIT={"write_behind": True, "batch_size": 100, "interval": 3600, "max_queued": 100})
+    def test_prompt_blobs(self):
+        """Test that full message lists are stored once per distinct paragraph and reconstructed as they were sent"""
+        buffer = LLMRequestBuffer()
+        system = {"role": "system", "content": "You are a bot.\n\n" + "Persona. " * 200 + "\n\nBe brief."}
+        history = [{"role": "user", "name": "active", "content": f"Message {i} " + "words " * 15} for i in range(40)]
+        sent = []
+        for i in range(30):
+            messages = [system] + history[i:i + 10]
+            request = LLMRequest(request_type="is_turn", model="model", temperature=0.8, response="yes")
+            request.set_messages(messages)
+            buffer.append(request)
+            sent.append(messages)
+        buffer.flush()
+
+        requests = list(LLMRequest.objects.order_by("id"))
+        blobs = LLMRequest.load_blobs(requests)
+        self.assertEqual([request.get_messages(blobs) for request in requests], sent)
+        self.assertEqual(requests[-1].bodies(), (history[38]["content"], "yes"))
+        stored = sum(len(text) for text in PromptBlob.objects.values_list("text", flat=True))
+        self.assertLess(stored * 10, sum(len(message["content"]) for messages in sent for message in messages))
+
+    @override_settings(LLM_AUDIT=SYNC_AUDIT, LLM_RATE_LIMIT={**settings.LLM_RATE_LIMIT, "enabled": False})
+    def test_async_without_buffer(self):
+        """Test that async requests are logged outside the event loop when rows are written right away"""
+        client = mock.Mock()
+        client.chat.complete_async = mock.AsyncMock(return_value=SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content="Hello!"))], usage=None,
+        ))
+        saved_in_loop = []
+
+        def save():
+            try:
+                asyncio.get_running_loop()
+                saved_in_loop.append(True)
+            except RuntimeError:
+                saved_in_loop.append(False)
+
+        with mock.patch("chat.llm.client_pool") as client_pool, mock.patch("chat.llm.settle"), mock.patch("chat.audit.LLMRequest.save", side_effect=save):
+            client_pool.get.return_value = client
+            response = async_to_sync(aprompt_llm_messages)([{"role": "user", "content": "Hi"}], request_type="is_turn")
+
+        self.assertEqual(response, "Hello!")
+        # Django refuses queries from the event loop thread
+        self.assertEqual(saved_in_loop, [False])
+
+
+class ModelRoutingTestCase(TestCase):
+    def test_request_type_tiers(self):
+        """Test that request types are routed to the model of their tier"""
+        self.assertEqual(route_model("is_turn_mention", "mistral-large-latest"), ("classifier", settings.LLM_ROUTING["tiers"]["classifier"]))
+        self.assertEqual(route_model("summarize"), ("analysis", settings.LLM_ROUTING["tiers"]["analysis"]))
+        self.assertEqual(route_model("mention"), ("reply", settings.LLM_ROUTING["tiers"]["reply"]))
+
+    def test_bot_override(self):
+        """Test that a bot's model overrides the reply tier only if the provider offers it"""
+        self.assertEqual(route_model("mention", "mistral-large-latest"), ("reply", "mistral-large-latest"))
+        self.assertEqual(route_model("mention", "gpt-3.5-turbo"), ("reply", settings.LLM_ROUTING["tiers"]["reply"]))
+
+    @override_settings(LLM_AUDIT=SYNC_AUDIT)
+    def test_routing_logged(self):
+        """Test that the routing decision is stored on the LLMRequest"""
+        response = SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content="Hi!"))], usage=SimpleNamespace(total_tokens=10, completion_tokens=2))
+        with mock.patch("chat.llm.client_pool") as client_pool:
+            client_pool.get.return_value.chat.complete.return_value = response
+            prompt_llm_messages([{"role": "user", "content": "Hi"}], model="mistral-large-latest", request_type="mention")
+
+        request = LLMRequest.objects.get()
+        self.assertEqual((request.tier, request.model, request.requested_model), ("reply", "mistral-large-latest", "mistral-large-latest"))
+        client_pool.get.return_value.chat.complete.assert_called_once()
+        self.assertEqual(client_pool.get.return_value.chat.complete.call_args.kwargs["model"], "mistral-large-latest")
+
+
+@override_settings(CONTEXT={"window": 4, "summary_batch": 3, "max_messages": 10, "token_budget": 1000})
+class ContextBuilderTestCase(TestCase):
+    def setUp(self):
+        self.conversation = Conversation.objects.create()
+        self.user = Participant.objects.create(participant_type="user", user=User.objects.create(username="active"))
+        self.conversation.participants.add(self.user)
+        post_save.disconnect(on_message_created, sender=Message)
+        self.messages = [Message.objects.create(conversation=self.conversation, participant=self.user, message=f"Message {i}") for i in range(8)]
+
+    def tearDown(self):
+        post_save.connect(on_message_created, sender=Message)
+
+    def test_history_without_summary(self):
+        """Test that unsummarized messages are kept verbatim and in order"""
+        history = build_history(self.conversation)
+        self.assertEqual([msg["content"] for msg in history], [f"Message {i}" for i in range(8)])
+        self.assertEqual(history[0], {"role": "user", "name": "active", "content": "Message 0"})
+
+    def test_token_budget(self):
+        """Test that the oldest messages are dropped to fit the token budget"""
+        history = build_history(self.conversation, reserved_tokens=1000 - 6)
+        self.assertEqual([msg["content"] for msg in history], ["Message 5", "Message 6", "Message 7"])
+
+    def test_rolling_summary(self):
+        """Test that messages outside the window are folded into the summary and replaced by it"""
+        with mock.patch("chat.context.prompt_llm_messages", return_value="They counted to three.") as prompt:
+            self.assertTrue(update_history_summary(self.conversation))
+
+        folded = [msg["content"] for msg in prompt.call_args.args[0][:-1]]
+        self.assertEqual(folded, [f"Message {i}" for i in range(4)])
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.history_summary_cursor, self.messages[3].id)
+
+        history = build_history(self.conversation)
+        self.assertIn("They counted to three.", history[0]["content"])
+        self.assertEqual([msg["content"] for msg in history[1:]], [f"Message {i}" for i in range(4, 8)])
+
+        # Not enough messages have left the window for another update
+        with mock.patch("chat.context.prompt_llm_messages") as prompt:
+            self.assertFalse(update_history_summary(self.conversation))
+        prompt.assert_not_called()
+
+    def test_summary_catches_up(self):
+        """Test that a summary lagging far behind folds every message, in order from its cursor"""
+        self.messages += [Message.objects.create(conversation=self.conversation, participant=self.user, message=f"Message {i}") for i in range(8, 20)]
+        with mock.patch("chat.context.prompt_llm_messages", return_value="They counted.") as prompt:
+            while update_history_summary(self.conversation):
+                pass
+
+        folded = [msg["content"] for call in prompt.call_args_list for msg in call.args[0][:-1]]
+        self.assertEqual(folded, [f"Message {i}" for i in range(16)])
+        self.assertEqual(self.conversation.history_summary_cursor, self.messages[15].id)
+
+
+class FusedGenerationTestCase(TestCase):
+    def setUp(self):
+        self.conversation = Conversation.objects.create()
+        self.user = Participant.objects.create(participant_type="user", user=User.objects.create(username="active"))
+        self.bot = Bot.objects.create(name="TestBot", prompt="A bot")
+        self.conversation.participants.add(self.user, Participant.objects.create(participant_type="bot", bot=self.bot))
+        post_save.disconnect(on_message_created, sender=Message)
+        Message.objects.create(conversation=self.conversation, participant=self.user, message="Anyone there?")
+
+    def tearDown(self):
+        post_save.connect(on_message_created, sender=Message)
+
+    def test_parse_fused_response(self):
+        """Test that only well-formed decisions are accepted"""
+        self.assertEqual(parse_fused_response('{"speak": true, "reply": " Hello! "}'), (True, "Hello!"))
+        self.assertEqual(parse_fused_response('{"speak": false, "reply": ""}'), (False, ""))
+        self.assertIsNone(parse_fused_response('{"speak": true, "reply": ""}'))
+        self.assertIsNone(parse_fused_response('{"speak": "yes", "reply": "Hello!"}'))
+        self.assertIsNone(parse_fused_response("Hello!"))
+
+    def test_fused_path(self):
+        """Test that a valid fused answer is used without any other request"""
+        with mock.patch("chat.bot.prompt_llm_messages", return_value='{"speak": true, "reply": "Hello!"}') as prompt:
+            response = generate_strategy_message(self.conversation, self.bot, {"Chime-in": {}})
+
+        self.assertEqual(response, "Hello!")
+        prompt.assert_called_once()
+        self.assertEqual(prompt.call_args.kwargs["response_format"], {"type": "json_object"})
+        timing = GenerationTiming.objects.get()
+        self.assertEqual((timing.path, timing.succeeded), ("fused", True))
+
+    def test_fallback_to_multi_step(self):
+        """Test that an invalid fused answer falls back to the separate decide and generate calls"""
+        responses = {
+            "fused_strategy": "Hello!",
+            "arbitrate_turns": '{"bots": [{"name": "TestBot", "speak": true, "priority": 3}]}',
+            "combine_strategies": "Hello again!",
+        }
+        with mock.patch("chat.bot.prompt_llm_messages", side_effect=lambda messages, **kwargs: responses[kwargs["request_type"]]):
+            response = generate_strategy_message(self.conversation, self.bot, {"Chime-in": {}})
+
+        self.assertEqual(response, "Hello again!")
+        timings = GenerationTiming.objects.order_by("id")
+        self.assertEqual([(timing.path, timing.succeeded) for timing in timings], [("fused", False), ("multi_step", True)])
+
+    def test_rejected_reply(self):
+        """Test that a reply rejected by check_message is not timed as a success"""
+        with mock.patch("chat.bot.prompt_llm_messages", return_value='{"speak": true, "reply": "Hello!"}'), mock.patch("chat.bot.check_message", return_value=False):
+            response = generate_strategy_message(self.conversation, self.bot, {"Chime-in": {}})
+
+        self.assertFalse(response)
+        timing = GenerationTiming.objects.get()
+        self.assertEqual((timing.path, timing.succeeded), ("fused", False))
+
+
+@override_settings(TURN_ARBITRATION={"enabled": False}, STREAMING={"enabled": False, "interval": 0.25, "stale_after": 120})
+class ConversationSnapshotTestCase(TestCase):
+    def setUp(self):
+        self.user = Participant.objects.create(participant_type="user", user=User.objects.create(username="active"))
+        self.bots = [Bot.objects.create(name=f"Bot{i}", prompt="A bot") for i in range(3)]
+        self.bot_participants = [Participant.objects.create(participant_type="bot", bot=bot) for bot in self.bots]
+        Strategy.objects.create(name="Resolve")
+        post_save.disconnect(on_message_created, sender=Message)
+
+    def tearDown(self):
+        post_save.connect(on_message_created, sender=Message)
+
+    def create_conversation(self, size):
+        conversation = Conversation.objects.create()
+        conversation.participants.add(self.user, *self.bot_participants)
+        for i in range(size):
+            participant = self.user if i % 2 else self.bot_participants[i % 3]
+            Message.objects.create(conversation=conversation, participant=participant, message=f"Message {i}")
+        Message.objects.create(conversation=conversation, participant=self.user, message="@Bot0 @Bot1 @Bot2 what do you think?")
+        return conversation
+
+    def count_queries(self, conversation):
+        async def fake_prompt(messages, **kwargs):
+            return "yes" if kwargs["request_type"] == "is_turn_mention" else "Sounds good"
+
+        with mock.patch("chat.bot.aprompt_llm_messages", fake_prompt), CaptureQueriesContext(connection) as queries:
+            with use_snapshot(conversation):
+                response = mention(conversation)
+                resolve(conversation)
+                chime_in(conversation)
+                get_active_participants(conversation, conversation.summary_posted_date)
+        self.assertEqual(len(response), 3)
+        return len(queries)
+
+    def test_flat_query_count(self):
+        """Test that the number of queries does not grow with the conversation"""
+        self.assertEqual(self.count_queries(self.create_conversation(12)), self.count_queries(self.create_conversation(60)))
+
+    def test_snapshot_follows_posted_messages(self):
+        """Test that messages posted during a run are seen by the following steps"""
+        conversation = self.create_conversation(2)
+        with use_snapshot(conversation) as snapshot:
+            count = snapshot.message_count
+            post_message(conversation, self.bots[0], "Hello!")
+            self.assertEqual(snapshot.last_message.message, "Hello!")
+            self.assertEqual(snapshot.message_count, count + 1)
+
+
+class ExplainQueriesTestCase(TestCase):
+    def test_hot_queries_use_indexes(self):
+        """Test that the hot queries are planned on the composite indexes"""
+        conversation = Conversation.objects.create()
+        user = Participant.objects.create(participant_type="user", user=User.objects.create(username="active"))
+        conversation.participants.add(user)
+        post_save.disconnect(on_message_created, sender=Message)
+        try:
+            Message.objects.create(conversation=conversation, participant=user, message="Hello")
+        finally:
+            post_save.connect(on_message_created, sender=Message)
+
+        out = StringIO()
+        call_command("explain_queries", conversation=conversation.id, stdout=out)
+
+        self.assertIn("message_conversation_time_idx", out.getvalue())
+        self.assertNotIn("(no index)", out.getvalue())
+
+
+class ConversationCountersTestCase(TestCase):
+    def setUp(self):
+        self.conversation = Conversation.objects.create()
+        self.user = Participant.objects.create(participant_type="user", user=User.objects.create(username="active"))
+        self.bot = Participant.objects.create(participant_type="bot", bot=Bot.objects.create(name="TestBot"))
+        self.conversation.participants.add(self.user, self.bot)
+        post_save.disconnect(on_message_created, sender=Message)
+
+    def tearDown(self):
+        post_save.connect(on_message_created, sender=Message)
+
+    def test_counters(self):
+        """Test that the counters follow new messages"""
+        first = Message.objects.create(conversation=self.conversation, participant=self.user, message="Hello")
+        Message.objects.create(conversation=self.conversation, participant=self.user, message="Anyone?")
+        last = Message.objects.create(conversation=self.conversation, participant=self.bot, message="Hi!")
+
+        conversation = Conversation.objects.get(id=self.conversation.id)
+        self.assertEqual(conversation.message_count, 3)
+        self.assertEqual((conversation.first_message_at, conversation.last_message_at), (first.timestamp, last.timestamp))
+        self.assertEqual((conversation.last_participant, conversation.last_participant_type), (self.bot, "bot"))
+        self.assertEqual(self.conversation.message_count, 3)
+        activity = {row.participant: row.message_count for row in conversation.activity.all()}
+        self.assertEqual(activity, {self.user: 2, self.bot: 1})
+        self.assertEqual(get_active_participants(conversation, last.timestamp), {self.bot})
+
+    def test_save_keeps_counters(self):
+        """Test that saving a stale conversation does not overwrite the counters"""
+        stale = Conversation.objects.get(id=self.conversation.id)
+        Message.objects.create(conversation=self.conversation, participant=self.user, message="Hello")
+        stale.title = "Renamed"
+        stale.save()
+
+        conversation = Conversation.objects.get(id=self.conversation.id)
+        self.assertEqual((conversation.title, conversation.message_count), ("Renamed", 1))
+
+    def test_save_keeps_history_summary(self):
+        """Test that saving a stale conversation does not move the history summary cursor back"""
+        stale = Conversation.objects.get(id=self.conversation.id)
+        Conversation.objects.filter(id=self.conversation.id).update(history_summary="Earlier", history_summary_cursor=42)
+        stale.title = "Renamed"
+        stale.save()
+
+        conversation = Conversation.objects.get(id=self.conversation.id)
+        self.assertEqual((conversation.history_summary, conversation.history_summary_cursor), ("Earlier", 42))
+
+
+class IncrementalMetricsTestCase(TestCase):
+    def setUp(self):
+        self.conversation = Conversation.objects.create()
+        self.user = Participant.objects.create(participant_type="user", user=User.objects.create(username="active"))
+        self.bot = Participant.objects.create(participant_type="bot", bot=Bot.objects.create(name="TestBot"))
+        self.conversation.participants.add(self.user, self.bot)
+        post_save.disconnect(on_message_created, sender=Message)
+        Message.objects.create(conversation=self.conversation, participant=self.user, message="one two three four")
+        Message.objects.create(conversation=self.conversation, participant=self.bot, message="one two")
+        Message.objects.create(conversation=self.conversation, participant=self.bot, message="one two three four five six")
+
+    def tearDown(self):
+        post_save.connect(on_message_created, sender=Message)
+
+    def test_metrics(self):
+        """Test that the metrics are computed from the aggregates maintained on insert"""
+        metrics = get_metrics(self.conversation)
+        self.assertEqual(metrics["Avg words/conv: "], 8)
+        self.assertEqual(metrics["Avg words/utterance: "], 4.0)
+        # Words per participant: 4 and 8
+        self.assertEqual(metrics["Evenness: "], f"6.0±{round(float(np.std([4, 8], ddof=1) / 6 * 100), 2)}%")
+
+    def test_backfill(self):
+        """Test that the backfill command rebuilds the aggregates from the messages"""
+        ParticipantActivity.objects.all().delete()
+        Conversation.objects.filter(id=self.conversation.id).update(message_count=0)
+
+        call_command("backfill_activity", conversation=[self.conversation.id], stdout=StringIO())
+
+        conversation = Conversation.objects.get(id=self.conversation.id)
+        self.assertEqual((conversation.message_count, conversation.last_participant_type), (3, "bot"))
+        self.assertEqual(dict(conversation.activity.values_list("participant", "word_count")), {self.user.id: 4, self.bot.id: 8})
+        self.assertEqual(get_metrics(conversation)["Avg words/conv: "], 8)
+
+
+class DatabaseTuningTestCase(TestCase):
+    def test_sqlite_pragmas(self):
+        """Test that new SQLite connections get the pragmas of settings.SQLITE_PRAGMAS"""
+        if connection.vendor != "sqlite":
+            self.skipTest("SQLite only")
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA busy_timeout")
+            self.assertEqual(cursor.fetchone()[0], settings.SQLITE_PRAGMAS["busy_timeout"])
+            cursor.execute("PRAGMA synchronous")
+            self.assertEqual(cursor.fetchone()[0], 1)  # NORMAL
+
+
+class DatabaseRouterTestCase(TestCase):
+    def setUp(self):
+        self.router = SeparateDatabaseRouter()
+
+    def test_disabled(self):
+        """Test that everything stays in the default database by default"""
+        with override_settings(SEPARATE_DATABASES=[]):
+            self.assertIsNone(self.router.db_for_write(LLMRequest))
+            self.assertIsNone(self.router.db_for_read(Schedule))
+
+    @override_settings(SEPARATE_DATABASES=["logs", "tasks"])
+    def test_routes(self):
+        """Test that LLM requests and django-q tables are read, written and migrated in their own databases"""
+        self.assertEqual(self.router.db_for_write(LLMRequest), "logs")
+        self.assertEqual(self.router.db_for_read(Schedule), "tasks")
+        self.assertIsNone(self.router.db_for_write(Message))
+        self.assertTrue(self.router.allow_migrate("logs", "chat", "llmrequest"))
+        self.assertFalse(self.router.allow_migrate("default", "chat", "llmrequest"))
+        self.assertFalse(self.router.allow_migrate("logs", "chat", "message"))
+        self.assertFalse(self.router.allow_migrate("default", "django_q", "ormq"))
+        self.assertIsNone(self.router.allow_migrate("default", "chat", "message"))
+
+
+class RetentionTestCase(TestCase):
+    def setUp(self):
+        self.archive_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.archive_dir.cleanup)
+        now = timezone.now()
+        self.old = LLMRequest.objects.create(request_type="is_turn", model="m", temperature=0, prompt="old prompt", response="yes", timestamp=now - timedelta(days=8))
+        self.aged = LLMRequest.objects.create(request_type="mention", model="m", temperature=0, prompt="aged prompt", response="hello", timestamp=now - timedelta(days=8))
+        self.recent = LLMRequest.objects.create(request_type="mention", model="m", temperature=0, prompt="recent prompt", response="hi", timestamp=now)
+        Task.objects.create(id="old", name="old", func="f", started=now - timedelta(days=8), stopped=now - timedelta(days=8), success=True)
+        Task.objects.create(id="new", name="new", func="f", started=now, stopped=now, success=True)
+        PromptBlob.objects.create(digest="unused", text="unused", last_used_at=now - timedelta(days=9))
+
+    def test_prune_history(self):
+        """Test that expired requests are archived, aged ones compressed and old task results deleted, in bounded batches"""
+        retention = {**settings.RETENTION, "archive_dir": self.archive_dir.name, "batch_size": 1, "max_batches": 5}
+        with override_settings(RETENTION=retention):
+            counts = prune_history()
+            with gzip.open(archive_path(self.old.timestamp), "rt") as archive:
+                self.assertEqual([json.loads(line)["prompt"] for line in archive], ["old prompt"])
+
+        self.assertEqual(counts, {"archived": 1, "compressed": 1, "blobs_pruned": 1, "tasks_pruned": 1, "push_events_pruned": 0})
+        self.assertEqual(list(Task.objects.values_list("id", flat=True)), ["new"])
+        self.assertFalse(LLMRequest.objects.filter(id=self.old.id).exists())
+
+        aged = LLMRequest.objects.get(id=self.aged.id)
+        self.assertEqual((aged.prompt, aged.bodies()), ("", ("aged prompt", "hello")))
+        self.assertIsNone(LLMRequest.objects.get(id=self.recent.id).body)
+
+    def test_bounded(self):
+        """Test that a run stops after max_batches batches"""
+        retention = {**settings.RETENTION, "archive_dir": self.archive_dir.name, "ttls": {}, "ttl": 1, "batch_size": 1, "max_batches": 1}
+        with override_settings(RETENTION=retention):
+            self.assertEqual(prune_history()["archived"], 1)
+            self.assertEqual(prune_history()["archived"], 1)
+        self.assertEqual(list(LLMRequest.objects.values_list("id", flat=True)), [self.recent.id])
+
+
+class MessagePollingTestCase(TestCase):
+    def setUp(self):
+        self.conversation = Conversation.objects.create()
+        self.user_active = User.objects.create(username="active")
+        self.user = Participant.objects.create(participant_type="user", user=self.user_active)
+        self.conversation.participants.add(self.user)
+        post_save.disconnect(on_message_created, sender=Message)
+        self.first = Message.objects.create(conversation=self.conversation, participant=self.user, message="Hello")
+        self.client.force_login(self.user_active)
+        self.url = reverse("chat:load_messages", kwargs={"conversation_uuid": self.conversation.uuid})
+
+    def tearDown(self):
+        post_save.connect(on_message_created, sender=Message)
+
+    def test_new_messages(self):
+        """Test that polls only return the messages after the cursor, and nothing when there are none"""
+        response = self.client.get(self.url, {"after": self.first.id})
+        self.assertEqual((response.status_code, response.content), (200, b""))
+
+        second = Message.objects.create(conversation=self.conversation, participant=self.user, message="Anyone there?")
+        response = self.client.get(self.url, {"after": self.first.id})
+        self.assertContains(response, f'data-id="{second.id}"')
+        self.assertNotContains(response, f'data-id="{self.first.id}"')
+
+    def test_not_modified(self):
+        """Test that a poll with the ETag of the current state gets a 304, and a new message changes the ETag"""
+        etag = self.client.get(self.url, {"after": self.first.id})["ETag"]
+        self.assertEqual(self.client.get(self.url, {"after": self.first.id}, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        Message.objects.create(conversation=self.conversation, participant=self.user, message="Anyone there?")
+        self.assertEqual(self.client.get(self.url, {"after": self.first.id}, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_constant_cost(self):
+        """Test that the cost of a poll does not depend on the length of the conversation"""
+        def poll_queries():
+            last = self.conversation.messages.order_by("id").last()
+            with CaptureQueriesContext(connection) as queries:
+                self.client.get(self.url, {"after": last.id})
+            return len(queries)
+
+        short = poll_queries()
+        for i in range(50):
+            Message.objects.create(conversation=self.conversation, participant=self.user, message=f"Message {i}")
+        self.assertEqual(poll_queries(), short)
+
+    def test_send_message(self):
+        """Test that sending a message triggers a poll instead of returning the whole conversation"""
+        response = self.client.post(reverse("chat:send_message", kwargs={"conversation_uuid": self.conversation.uuid}), {"message": "Hi"})
+        self.assertEqual((response.status_code, response["HX-Trigger"]), (204, "messageSent"))
+        self.assertEqual(self.conversation.messages.count(), 2)
+
+
+@override_settings(PUSH={**settings.PUSH, "enabled": True, "interval": 0.05})
+class PushTestCase(TestCase):
+    def setUp(self):
+        self.conversation = Conversation.objects.create()
+        self.user_active = User.objects.create(username="active")
+        self.user = Participant.objects.create(participant_type="user", user=self.user_active)
+        self.conversation.participants.add(self.user)
+        post_save.disconnect(on_message_created, sender=Message)
+
+    def tearDown(self):
+        post_save.connect(on_message_created, sender=Message)
+
+    def test_publish_message(self):
+        """Test that a new message is published once committed"""
+        with self.captureOnCommitCallbacks(execute=True):
+            Message.objects.create(conversation=self.conversation, participant=self.user, message="Hello")
+        self.assertEqual(list(PushEvent.objects.values_list("conversation", "kind")), [(self.conversation.id, "message")])
+
+    def test_stream(self):
+        """Test that the subscribers of a conversation receive its events, and only its events"""
+        hub = PushHub()
+        other = Conversation.objects.create()
+
+        async def receive():
+            stream = hub.stream(self.conversation.id)
+            self.assertTrue((await stream.__anext__()).startswith("retry:"))
+            # Let the hub start from the latest event
+            await asyncio.sleep(0.2)
+            await sync_to_async(publish)(other.id, "title")
+            await sync_to_async(publish)(self.conversation.id, "title")
+            event = await asyncio.wait_for(stream.__anext__(), 2)
+            await stream.aclose()
+            return event
+
+        self.assertEqual(async_to_sync(receive)(), f"event: title\ndata: {self.conversation.id}\n\n")
+
+    def test_fallback(self):
+        """Test that the events endpoint tells non-ASGI clients to keep polling"""
+        self.client.force_login(self.user_active)
+        response = self.client.get(reverse("chat:conversation_events", kwargs={"conversation_uuid": self.conversation.uuid}))
+        self.assertEqual(response.status_code, 204)
+
+
+class MessageRenderingTestCase(TestCase):
+    def setUp(self):
+        self.conversation = Conversation.objects.create()
+        self.user = Participant.objects.create(participant_type="user", user=User.objects.create(username="active"))
+        self.conversation.participants.add(self.user)
+        post_save.disconnect(on_message_created, sender=Message)
+
+    def tearDown(self):
+        post_save.connect(on_message_created, sender=Message)
+
+    def test_render_once(self):
+        """Test that messages are rendered when saved, not when they are shown"""
+        message = Message.objects.create(conversation=self.conversation, participant=self.user, message="Hi @active, **welcome**")
+        self.assertEqual(message.html, "<p>Hi <strong>@active</strong>, <strong>welcome</strong></p>")
+
+        with mock.patch("chat.models.render_message") as render:
+            self.assertEqual(Message.objects.get(id=message.id).rendered_html, message.html)
+        render.assert_not_called()
+
+        message.message = "Edited"
+        message.save(update_fields=["message"])
+        self.assertEqual(Message.objects.get(id=message.id).html, "<p>Edited</p>")
+
+    def test_renderer_version(self):
+        """Test that messages rendered by an older renderer, or bulk created, are shown rendered and stored by render_messages"""
+        Message.objects.bulk_create([Message(conversation=self.conversation, participant=self.user, message="*new*")])
+        message = Message.objects.get()
+        with self.assertNumQueries(0):
+            self.assertEqual(message.rendered_html, "<p><em>new</em></p>")
+
+        call_command("render_messages", stdout=StringIO())
+        message = Message.objects.get()
+        self.assertEqual((message.html, message.html_version), ("<p><em>new</em></p>", RENDERER_VERSION))
+
+
+@override_settings(MESSAGES_PAGE_SIZE=3)
+class MessageHistoryTestCase(TestCase):
+    def setUp(self):
+        self.conversation = Conversation.objects.create()
+        self.user_active = User.objects.create(username="active")
+        self.user = Participant.objects.create(participant_type="user", user=self.user_active)
+        self.conversation.participants.add(self.user)
+        post_save.disconnect(on_message_created, sender=Message)
+        self.messages = [Message.objects.create(conversation=self.conversation, participant=self.user, message=f"Message {i}") for i in range(7)]
+        self.client.force_login(self.user_active)
+        self.url = reverse("chat:load_messages", kwargs={"conversation_uuid": self.conversation.uuid})
+
+    def tearDown(self):
+        post_save.connect(on_message_created, sender=Message)
+
+    def shown(self, response):
+        return [message.id for message in response.context["messages"]]
+
+    def test_latest_page(self):
+        """Test that the chat page only renders the latest messages, with a loader for the older ones"""
+        response = self.client.get(reverse("chat:chat", kwargs={"conversation_uuid": self.conversation.uuid}))
+        self.assertEqual(self.shown(response), [message.id for message in self.messages[-3:]])
+        self.assertContains(response, f"?before={self.messages[4].id}")
+
+    def test_older_pages(self):
+        """Test that older pages are loaded by message id cursor until the first message"""
+        response = self.client.get(self.url, {"before": self.messages[4].id})
+        self.assertEqual(self.shown(response), [message.id for message in self.messages[1:4]])
+        self.assertContains(response, f"?before={self.messages[1].id}")
+
+        response = self.client.get(self.url, {"before": self.messages[1].id})
+        self.assertEqual(self.shown(response), [self.messages[0].id])
+        self.assertNotContains(response, "older-messages")
+
+
+@override_settings(Q_CLUSTER={**settings.Q_CLUSTER, "sync": False}, GENERATION={"quiet_window": 0})
+class GenerationSchedulerTestCase(TestCase):
+    def setUp(self):
+        self.conversation = Conversation.objects.create()
+        self.user = Participant.objects.create(participant_type="user", user=User.objects.create(username="active"))
+        self.bot = Bot.objects.create(name="TestBot", prompt="A bot")
+        self.bot_participant = Participant.objects.create(participant_type="bot", bot=self.bot)
+        self.conversation.participants.add(self.user, self.bot_participant)
+
+    def generation(self):
+        return Conversation.objects.values_list("generation_token", "generation_queued", "generation_started_at").get(id=self.conversation.id)
+
+    def test_coalesce(self):
+        """Test that a burst of messages queues a single generation, and that only human messages obsolete the running one"""
+        with mock.patch("chat.scheduler.async_task") as enqueue:
+            request_generation(self.conversation)
+            request_generation(self.conversation)
+            request_generation(self.conversation, obsolete=False)
+        enqueue.assert_called_once()
+        self.assertEqual(self.generation(), (2, True, None))
+
+    def test_single_run(self):
+        """Test that a generation requested during a run is queued by the run when it finishes"""
+        with mock.patch("chat.scheduler.async_task") as enqueue:
+            request_generation(self.conversation)
+            self.assertEqual(start_generation(self.conversation.id), 1)
+            enqueue.reset_mock()
+            request_generation(self.conversation)
+            enqueue.assert_not_called()
+            self.assertIsNone(start_generation(self.conversation.id))
+            self.assertTrue(self.generation()[1])
+
+            finish_generation(self.conversation.id)
+            enqueue.assert_called_once_with("chat.tasks.generate_messages", self.conversation.id, task_name=f"generate_messages_{self.conversation.uuid}")
+        self.assertEqual(start_generation(self.conversation.id), 2)
+
+    def test_killed_run(self):
+        """Test that a run killed before it finished does not hold the queued generation back"""
+        stale = timezone.now() - timedelta(seconds=settings.Q_CLUSTER["timeout"] + 1)
+        Conversation.objects.filter(id=self.conversation.id).update(generation_queued=True, generation_started_at=stale)
+        with mock.patch("chat.scheduler.async_task") as enqueue:
+            request_generation(self.conversation)
+        enqueue.assert_called_once()
+        self.assertEqual(start_generation(self.conversation.id), 1)
+
+    @override_settings(GENERATION={"quiet_window": 30})
+    def test_quiet_window(self):
+        """Test that a generation is delayed until no message arrived for the quiet window, without waiting in the worker"""
+        last_message_at = timezone.now()
+        Conversation.objects.filter(id=self.conversation.id).update(last_message_at=last_message_at)
+        with mock.patch("chat.scheduler.async_task") as enqueue:
+            request_generation(self.conversation)
+        enqueue.assert_not_called()
+        schedule = Schedule.objects.get(name=f"generate_messages_{self.conversation.uuid}")
+        self.assertEqual((schedule.schedule_type, schedule.next_run), (Schedule.ONCE, last_message_at + timedelta(seconds=30)))
+
+        # Started early, e.g. queued by a finished run: scheduled again
+        self.assertIsNone(start_generation(self.conversation.id))
+        self.assertEqual(Schedule.objects.count(), 2)
+        self.assertTrue(self.generation()[1])
+
+        Conversation.objects.filter(id=self.conversation.id).update(last_message_at=last_message_at - timedelta(seconds=30))
+        self.assertEqual(start_generation(self.conversation.id), 1)
+
+    def test_obsolete(self):
+        """Test that a generation overtaken by a human message drops its reply"""
+        self.conversation._generation_token = 0
+        check_generation(self.conversation)
+        MessageDraft.objects.create(conversation=self.conversation, participant=self.bot_participant, message="Hel")
+        with mock.patch("chat.scheduler.async_task"):
+            request_generation(self.conversation)
+
+        with self.assertRaises(GenerationObsolete):
+            post_message(self.conversation, self.bot, "Hello!")
+        self.assertFalse(MessageDraft.objects.exists())
+        self.assertFalse(Message.objects.exists())
+
+
+class MessageBatchTestCase(TestCase):
+    def setUp(self):
+        self.conversation = Conversation.objects.create()
+        self.bots = [Bot.objects.create(name=name, prompt="A bot") for name in ["Alice", "Bob"]]
+        self.participants = [Participant.objects.create(participant_type="bot", bot=bot) for bot in self.bots]
+        self.conversation.participants.add(*self.participants)
+
+    def generation_token(self):
+        return Conversation.objects.values_list("generation_token", flat=True).get(id=self.conversation.id)
+
+    def test_single_evaluation(self):
+        """Test that the messages of a batch are inserted together and trigger the pipeline once, after the commit"""
+        MessageDraft.objects.create(conversation=self.conversation, participant=self.participants[0], message="Hel")
+        with mock.patch("chat.signals.async_task") as tasks, mock.patch("chat.scheduler.async_task") as generations:
+            with self.captureOnCommitCallbacks(execute=True):
+                with batch_messages(self.conversation):
+                    post_message(self.conversation, self.bots[0], "Hello!")
+                    post_message(self.conversation, self.bots[1], "Hi **there**")
+                    post_message(self.conversation, self.bots[0], "How are you?")
+                    self.assertFalse(Message.objects.exists())
+                    self.assertTrue(MessageDraft.objects.exists())
+                generations.assert_not_called()
+
+        generations.assert_called_once()
+        tasks.assert_called_once_with("chat.tasks.update_conversation_subtopics", self.conversation.id)
+        self.assertEqual(self.generation_token(), 0)
+        self.assertEqual(list(Message.objects.order_by("timestamp").values_list("message", flat=True)), ["Hello!", "Hi **there**", "How are you?"])
+        self.assertEqual(Message.objects.get(participant=self.participants[1]).html, "<p>Hi <strong>there</strong></p>")
+        self.assertFalse(MessageDraft.objects.exists())
+
+        conversation = Conversation.objects.get(id=self.conversation.id)
+        self.assertEqual((conversation.message_count, conversation.last_participant_id), (3, self.participants[0].id))
+        activity = {row.participant_id: row.message_count for row in ParticipantActivity.objects.filter(conversation=self.conversation)}
+        self.assertEqual(activity, {self.participants[0].id: 2, self.participants[1].id: 1})
+
+    def test_history(self):
+        """Test that the replies posted earlier in the batch are part of the history of the run"""
+        with use_snapshot(self.conversation) as snapshot, batch_messages(self.conversation):
+            # Loaded by the first steps of a run
+            self.assertEqual(snapshot.messages, [])
+            post_message(self.conversation, self.bots[0], "Hello!")
+            history = build_history(self.conversation)
+        self.assertEqual([msg["content"] for msg in history], ["Hello!"])
+
+    def test_obsolete(self):
+        """Test that an obsolete batch is dropped with its drafts"""
+        MessageDraft.objects.create(conversation=self.conversation, participant=self.participants[0], message="Hel")
+        self.conversation._generation_token = 0
+        with self.assertRaises(GenerationObsolete):
+            with batch_messages(self.conversation):
+                post_message(self.conversation, self.bots[0], "Hello!")
+                Conversation.objects.filter(id=self.conversation.id).update(generation_token=1)
+                check_generation(self.conversation)
+        self.assertFalse(Message.objects.exists())
+        self.assertFalse(MessageDraft.objects.exists())
+
+
+@override_settings(SWEEP={"interval": 2, "batch_size": 2})
+class SweeperTestCase(TestCase):
+    def setUp(self):
+        self.user = Participant.objects.create(participant_type="user", user=User.objects.create(username="active"))
+        self.conversations = [Conversation.objects.create() for _ in range(4)]
+        post_save.disconnect(on_message_created, sender=Message)
+
+    def tearDown(self):
+        post_save.connect(on_message_created, sender=Message)
+
+    def flagged(self):
+        return set(Conversation.objects.filter(needs_refresh=True).values_list("id", flat=True))
+
+    def test_flag(self):
+        """Test that new messages flag their conversation, and that saving a stale instance keeps the flag"""
+        conversation = Conversation.objects.get(id=self.conversations[0].id)
+        Message.objects.create(conversation=self.conversations[0], participant=self.user, message="Hello")
+        self.assertEqual(self.flagged(), {conversation.id})
+
+        conversation.title = "Greetings"
+        conversation.save()
+        self.assertEqual(self.flagged(), {conversation.id})
+
+    def test_sweep(self):
+        """Test that a sweep refreshes a bounded batch of changed conversations, those waiting the longest first"""
+        for conversation in reversed(self.conversations[1:]):
+            Message.objects.create(conversation=conversation, participant=self.user, message="Hello")
+
+        with mock.patch("chat.sweeper.async_task") as enqueue:
+            self.assertEqual(sweep(), 2)
+            refreshed = [call.args[1] for call in enqueue.call_args_list]
+            self.assertEqual(refreshed, [self.conversations[3].id, self.conversations[2].id])
+            self.assertEqual(self.flagged(), {self.conversations[1].id})
+
+            enqueue.reset_mock()
+            self.assertEqual(sweep(), 1)
+            self.assertEqual(sweep(), 0)
+        enqueue.assert_called_once_with("chat.tasks.refresh_conversation", self.conversations[1].id, task_name=f"refresh_conversation_{self.conversations[1].id}")
+
+    def test_refresh(self):
+        """Test that the title and the summary are both refreshed after every new message"""
+        bot = Bot.objects.create(name="TestBot")
+        self.conversations[0].participants.add(self.user, Participant.objects.create(participant_type="bot", bot=bot))
+        with mock.patch("chat.llm.prompt_llm_messages", return_value="Greetings") as title, \
+                mock.patch("chat.dialog_analyzer.prompt_llm_messages", return_value="They said hello.") as summary, \
+                mock.patch("chat.tasks.update_evaluation_metrics"):
+            for i in range(3):
+                Message.objects.create(conversation=self.conversations[0], participant=self.user, message=f"Hello {i}")
+                refresh_conversation(self.conversations[0].id)
+        self.assertEqual((title.call_count, summary.call_count), (3, 3))
+
+    def test_setup(self):
+        """Test that the setup command replaces the schedules of each conversation with the sweeper"""
+        Schedule.objects.create(name=f"update_conversation_title_{self.conversations[0].id}", func="chat.tasks.update_conversation_title", schedule_type=Schedule.MINUTES, minutes=2)
+        call_command("setup", stdout=StringIO())
+        self.assertEqual(list(Schedule.objects.order_by("name").values_list("name", flat=True)), ["prune_history", "sweep_conversations"])
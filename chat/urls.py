@@ -16,6 +16,16 @@ urlpatterns = [
         views.load_messages,
         name="load_messages",
     ),
+    path(
+        "<uuid:conversation_uuid>/events/",
+        views.conversation_events,
+        name="conversation_events",
+    ),
+    path(
+        "<uuid:conversation_uuid>/load_drafts/",
+        views.load_drafts,
+        name="load_drafts",
+    ),
     path(
         "<uuid:conversation_uuid>/send_message/",
         views.send_message,
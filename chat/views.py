@@ -1,19 +1,22 @@
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
-from django.http import HttpResponseBadRequest
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse, HttpResponseBadRequest, StreamingHttpResponse
 from django.contrib.auth import login
-from django.shortcuts import get_object_or_404, redirect, render
+from django.shortcuts import aget_object_or_404, get_object_or_404, redirect, render
 from django.views.decorators.http import require_http_methods, require_POST
 from django_q.models import Schedule
-from django_q.tasks import schedule
 from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
 from django.forms import modelformset_factory
+from datetime import timedelta
 
 from chat.forms import ManageBotsForm, ManageStrategiesForm, CreateBotForm, CreateSegmentForm, ManageSettingsForm, CreateSettingsForm
 from chat.llm import llm_generate_subtopics, llm_generate_segments
-from chat.models import Conversation, Message, Participant, User, Strategy, Segment, Settings
+from chat.models import Conversation, Message, MessageDraft, Participant, User, Strategy, Segment, Settings
 from chat.evaluation import get_metrics
 from chat.helpers import render_summary
+from chat.push import push_hub
 
 import json
 import markdown
@@ -42,12 +45,7 @@ def chat_new(request):
     for strat in Strategy.objects.all():
         conversation.strategies.add(strat)
     
-    schedule("chat.tasks.update_conversation_title",
-        conversation.id,
-        schedule_type="I",
-        minutes=2,
-        name=f"update_conversation_title_{conversation.id}",
-    )
+    # Title, summary and metrics are refreshed by the sweeper once the conversation has messages, see chat.sweeper
     
     # schedule("chat.tasks.update_conversation_subtopics",
     #     conversation.id,
@@ -56,20 +54,6 @@ def chat_new(request):
     #     name=f"update_conversation_subtopics_{conversation.id}",
     # )
     
-    schedule("chat.tasks.update_conversation_summary",
-        conversation.id,
-        schedule_type="I",
-        minutes=2,
-        name=f"update_conversation_summary_{conversation.id}",
-    )
-    
-    schedule("chat.tasks.update_evaluation_metrics",
-        conversation.id,
-        schedule_type="I",
-        minutes=5,
-        name=f"update_evaluation_metrics_{conversation.id}",
-    )
-    
     return redirect("chat:setup_conversation", conversation_uuid=conversation.uuid)
 
 @login_required
@@ -101,16 +85,21 @@ def chat(request, conversation_uuid=False):
     # Retrieve all participants (both users and bots) from the conversation
     participants = conversation.participants.select_related("user", "bot").all()
 
-    # Retrieve all messages for the conversation
-    messages = Message.objects.filter(conversation=conversation).select_related("participant__user", "participant__bot").order_by("timestamp")
+    # Retrieve the latest messages of the conversation, older ones are loaded when scrolling up
+    messages, older = message_page(conversation)
 
     # Create the context to pass to the template
     context = {
         "conversations": Conversation.objects.all(),
         "conversation": conversation,
         "messages": messages,
+        "older": older,
         "participants": participants,
         "version": settings.VERSION,
+        "push": settings.PUSH["enabled"],
+        # Drafts are only polled while a bot may be typing
+        "generating": conversation.generation_queued or conversation.generation_started_at is not None,
+        "draft_watch": settings.STREAMING["watch"],
     }
 
     return render(request, "chat/chat.html", context)
@@ -126,11 +115,79 @@ def user(request):
     return render(request, "chat/user.html", context)
 
 
+def message_page(conversation, before=None):
+    """
+    The latest MESSAGES_PAGE_SIZE messages, or the ones before the message `before`, oldest first,
+    and whether there are older ones.
+    """
+    messages = Message.objects.filter(conversation=conversation).select_related("participant__user", "participant__bot").order_by("-id")
+    if before is not None:
+        messages = messages.filter(id__lt=before)
+    page = list(messages[:settings.MESSAGES_PAGE_SIZE + 1])
+    return page[:settings.MESSAGES_PAGE_SIZE][::-1], len(page) > settings.MESSAGES_PAGE_SIZE
+
+
+def messages_etag(request, conversation):
+    """Changes whenever a message is posted (from the counters maintained on Conversation), per user as messages are rendered per user"""
+    last_message_at = conversation.last_message_at.timestamp() if conversation.last_message_at else 0
+    return f'"{request.user.id}-{conversation.message_count}-{last_message_at}"'
+
+
 @login_required
 def load_messages(request, conversation_uuid):
+    """
+    The latest page of messages, or the page before the message `before` when the user scrolls up, or with `after`
+    (the id of the last message the page has) only the newer ones, to append. Polls that find nothing new cost
+    a single query: an empty page, which the browser revalidates with its ETag on the next poll and gets a 304.
+    """
     conversation = get_object_or_404(Conversation, uuid=conversation_uuid)
-    messages = Message.objects.filter(conversation=conversation).select_related("participant__user", "participant__bot").order_by("timestamp")
-    return render(request, "chat/partials/messages.html", {"messages": messages})
+    try:
+        after = int(request.GET["after"]) if "after" in request.GET else None
+        before = int(request.GET["before"]) if "before" in request.GET else None
+    except ValueError:
+        return HttpResponseBadRequest("Invalid message id")
+
+    if before is not None:
+        # Older messages do not change, no need for the ETag
+        messages, older = message_page(conversation, before)
+        return render(request, "chat/partials/message_page.html", {"conversation": conversation, "messages": messages, "older": older})
+
+    etag = messages_etag(request, conversation)
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        if after is None:
+            messages, older = message_page(conversation)
+            response = render(request, "chat/partials/messages.html", {"conversation": conversation, "messages": messages, "older": older})
+        else:
+            messages = list(Message.objects.filter(conversation=conversation, id__gt=after).select_related("participant__user", "participant__bot").order_by("timestamp"))
+            response = render(request, "chat/partials/new_messages.html", {"messages": messages}) if messages else HttpResponse()
+    response["ETag"] = etag
+    # Revalidated on every poll, never shared between users
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+@login_required
+async def conversation_events(request, conversation_uuid):
+    """
+    Server-sent events telling the chat page what changed (see chat.push). Answers 204, which makes the
+    browser give up and the page keep polling, when push is disabled or the server is not ASGI.
+    """
+    if not settings.PUSH["enabled"] or not isinstance(request, ASGIRequest):
+        return HttpResponse(status=204)
+    conversation = await aget_object_or_404(Conversation, uuid=conversation_uuid)
+    return StreamingHttpResponse(
+        push_hub.stream(conversation.id),
+        content_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@login_required
+def load_drafts(request, conversation_uuid):
+    stale = timezone.now() - timedelta(seconds=settings.STREAMING["stale_after"])
+    drafts = MessageDraft.objects.filter(conversation__uuid=conversation_uuid, updated_at__gte=stale).select_related("participant__bot").order_by("id")
+    return render(request, "chat/partials/drafts.html", {"drafts": drafts})
 
 
 @login_required
@@ -171,9 +228,8 @@ def send_message(request, conversation_uuid):
         # if conversation.triggers.filter(name="mention").exists():
         #     mention(conversation)
 
-    # Return updated messages list
-    messages = Message.objects.filter(conversation=conversation).select_related("participant__user", "participant__bot").order_by("timestamp")
-    return render(request, "chat/partials/messages.html", {"messages": messages})
+    # The page appends the new message with its next poll of load_messages, triggered right away
+    return HttpResponse(status=204, headers={"HX-Trigger": "messageSent"})
 
 
 @login_required